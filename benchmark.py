@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+Usage:
+  benchmark.py save -u REDIS_URL [-s SID] [-n ROWS] [-b BATCH] [-w WIDTH] [-k KEYS]
+  benchmark.py dump -u REDIS_URL [-s SID] [-n ROWS] [-w WIDTH] [-f BATCHES]
+  benchmark.py memory -u REDIS_URL [-s SID] [-n ROWS] [-w WIDTH]
+  benchmark.py suite [-u REDIS_URL] [-s SID] [-n ROWS] [-b BATCH] [-w WIDTH] [-k KEYS] [--skew=EXP] [--mix=MIX] [-r FORMAT] [-m COUNT] [--seed=SEED] [-o FILE]
+  benchmark.py compress [-u REDIS_URL] [-s SID] [-n ROWS] [-w WIDTH] [-m COUNT] [-z CODECS] [--seed=SEED]
+  benchmark.py (-h | --help | --version)
+
+Commands:
+  save                          Compare rows/sec of the row by row save path
+                                and the batched merge script of Rcache.save
+  dump                          Compare rows/sec of iterating cached rows
+                                with different fetch batch sizes
+  memory                        Compare redis memory used by the rows of
+                                the hash and packed row formats
+  suite                         Run synthetic binlog events through
+                                cdc._get_row_values, Rcache.save, and
+                                Rcache.dump_stream with dump2csv.stream2csv.
+                                Report rows/sec, p50/p99 latency and bytes
+                                per row as json. Without -u it runs on
+                                fakeredis in process
+  compress                      Compare wall time and bytes written of
+                                Rcache.dump_stream with dump2csv.stream2csv
+                                for every compression of csv files.
+                                Without -u it runs on fakeredis in process
+Options:
+  -h --help                     Show this help message and exit
+  --version                     Show version and exit
+  -u --cache_url=REDIS_URL      Specify the redis url for benchmarking like:
+                                "redis://host:port/db". It will be flushed!
+  -s --server_id=SID            Specify the mysql server id of keys [default: 999]
+  -n --rows=ROWS                Specify count of rows to save [default: 100000]
+  -b --batch=BATCH              Specify rows of one binlog event [default: 10]
+  -w --width=WIDTH              Specify columns of one row [default: 10]
+  -k --keys=KEYS                Specify count of distinct primary keys [default: 10000]
+  -f --fetch_batches=BATCHES    Specify fetch batch sizes to compare
+                                [default: 1,10,100,1000,5000]
+  --skew=EXP                    Specify skew of primary keys, key is
+                                KEYS * random() ** EXP, 1 is uniform
+                                and larger is hotter [default: 1]
+  --mix=MIX                     Specify weights of event actions
+                                [default: insert:1,update:2,delete:1]
+  -r --row_format=FORMAT        Specify the row format of cache [default: hash]
+  -m --max_rows=COUNT           Specify rows of one dumped file [default: 10000]
+  -z --codecs=CODECS            Specify compressions of csv files to compare
+                                [default: none,gzip,zstd]
+  --seed=SEED                   Specify the random seed [default: 1]
+  -o --output=FILE              Write json results to FILE, "-" for stdout
+'''
+
+import os
+import random
+import time
+import json
+import shutil
+import tempfile
+from functools import partial
+from docopt import docopt
+import redis
+
+import rcache
+
+__version__ = "v0.1"
+
+TABLE = "benchdb.benchtable"
+
+
+def gen_rows(count, width, keys):
+    '''
+    yield rows like the after image of binlog events
+    '''
+    actions = ("insert", "update", "update", "delete")
+    for _ in xrange(count):
+        row = {"id": random.randint(1, keys),
+               "cdc_action": random.choice(actions),
+               "cdc_ts": int(time.time())}
+        for col in xrange(width):
+            row["col{}".format(col)] = "value{}".format(col)
+        yield row
+
+
+def gen_batches(count, width, keys, batch):
+    rows = []
+    for row in gen_rows(count, width, keys):
+        rows.append(row)
+        if len(rows) >= batch:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+
+def legacy_save(client, server_id, table, primary_key, rows):
+    '''
+    the row by row save path: lock, HGETALL, HMSET/SADD or DEL/SREM, unlock
+    '''
+    locking_key = "{}#locking".format(server_id)
+    table_key = "{}#{}".format(server_id, table)
+    row_ids_key = "{}#row_ids#{}".format(server_id, table)
+    while not client.set(locking_key, "", ex=60, nx=True):
+        time.sleep(1)
+    try:
+        for row in rows:
+            rid = rcache.Rcache._gen_rid(row, primary_key)
+            key = "{}.{}".format(table_key, rid)
+            merged_row = rcache.Rcache._merge_row(client.hgetall(key), row)
+            if merged_row:
+                client.hmset(key, merged_row)
+                client.sadd(row_ids_key, rid)
+            else:
+                client.delete(key)
+                client.srem(row_ids_key, rid)
+    finally:
+        client.delete(locking_key)
+
+
+def timeit(func, batches):
+    rows = 0
+    start = time.time()
+    for batch in batches:
+        func(batch)
+        rows += len(batch)
+    return rows, time.time() - start
+
+
+def bench_save(cache_url, server_id, count, batch, width, keys):
+    client = redis.from_url(cache_url)
+    cache = rcache.Rcache(cache_url, server_id)
+    # generate all rows before timing, save() changes cdc_action in place
+    batches = list(gen_batches(count, width, keys, batch))
+
+    client.flushdb()
+    rows, cost = timeit(lambda rows: legacy_save(
+        client, server_id, TABLE, "id", [dict(r) for r in rows]), batches)
+    print "row by row: {} rows in {:.2f}s, {:.0f} rows/sec".format(
+        rows, cost, rows / cost)
+
+    client.flushdb()
+    rows, cost = timeit(lambda rows: cache.save(
+        TABLE, "id", [dict(r) for r in rows]), batches)
+    print "merge script: {} rows in {:.2f}s, {:.0f} rows/sec".format(
+        rows, cost, rows / cost)
+    client.flushdb()
+
+
+def fill_cache(cache, count, width):
+    '''
+    save distinct inserted rows, every generated row is cached
+    '''
+    rid = 0
+    for rows in gen_batches(count, width, count, 1000):
+        for row in rows:
+            rid += 1
+            row["id"] = rid
+            row["cdc_action"] = "insert"
+        cache.save(TABLE, "id", rows)
+
+
+def bench_dump(cache_url, server_id, count, width, fetch_batches):
+    client = redis.from_url(cache_url)
+    client.flushdb()
+    cache = rcache.Rcache(cache_url, server_id)
+    fill_cache(cache, count, width)
+    for fetch_batch in fetch_batches:
+        cache = rcache.Rcache(cache_url, server_id, fetch_batch)
+        start = time.time()
+        rows = sum(len(rows) for _, rows in cache.iter_rows_by_table(TABLE))
+        cost = time.time() - start
+        print "fetch batch {}: {} rows in {:.2f}s, {:.0f} rows/sec".format(
+            fetch_batch, rows, cost, rows / cost)
+    client.flushdb()
+
+
+def bench_memory(cache_url, server_id, count, width):
+    client = redis.from_url(cache_url)
+    for row_format in sorted(rcache.ROW_FORMATS):
+        client.flushdb()
+        used = client.info("memory")["used_memory"]
+        fill_cache(rcache.create(cache_url, server_id, row_format),
+                   count, width)
+        used = client.info("memory")["used_memory"] - used
+        print "{}: {} rows, {} bytes, {:.1f} bytes/row".format(
+            row_format, count, used, float(used) / count)
+    client.flushdb()
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100.0), len(values) - 1)]
+
+
+def summary(rows, cost, latencies):
+    '''
+    latencies: seconds of every call, reported in milliseconds
+    '''
+    return {"rows": rows,
+            "seconds": round(cost, 6),
+            "rows_per_sec": round(rows / cost, 1) if cost else None,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3)
+                      if latencies else None,
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3)
+                      if latencies else None}
+
+
+def event_class(base):
+    '''
+    a binlog event class of pymysqlreplication without parsing packets
+    '''
+    def __init__(self, schema, table, primary_key, rows, timestamp):
+        self.schema = schema
+        self.table = table
+        self.primary_key = primary_key
+        self.rows = rows
+        self.timestamp = timestamp
+
+    # the class attribute hides the lazy rows property of RowsEvent
+    return type("Bench" + base.__name__, (base,),
+                {"__init__": __init__, "rows": None})
+
+
+def gen_events(count, batch, width, keys, skew, mix):
+    '''
+    yield Write/Update/DeleteRowsEvent-shaped events of count rows
+    mix: {"insert": weight, "update": weight, "delete": weight}
+    '''
+    from pymysqlreplication.row_event import (
+        DeleteRowsEvent, UpdateRowsEvent, WriteRowsEvent)
+    classes = {"insert": event_class(WriteRowsEvent),
+               "update": event_class(UpdateRowsEvent),
+               "delete": event_class(DeleteRowsEvent)}
+    actions = []
+    for action, weight in mix.iteritems():
+        actions.extend([action] * weight)
+    actions.sort()
+    schema, table = TABLE.split(".")
+    while count > 0:
+        action = random.choice(actions)
+        rows = []
+        for _ in xrange(min(batch, count)):
+            values = {"id": int(keys * random.random() ** skew) + 1}
+            for col in xrange(width):
+                values["col{}".format(col)] = "value{}".format(
+                    random.randint(0, 999999))
+            if action == "update":
+                rows.append({"before_values": dict(values),
+                             "after_values": values})
+            else:
+                rows.append({"values": values})
+        count -= len(rows)
+        yield classes[action](schema, table, "id", rows, int(time.time()))
+
+
+def used_memory(client):
+    '''
+    return None if the server, like fakeredis, does not report it
+    '''
+    try:
+        return client.info("memory")["used_memory"]
+    except Exception:
+        return None
+
+
+def connect(cache_url):
+    '''
+    return (client, cache_url), fakeredis in process if cache_url is None
+    '''
+    if cache_url:
+        return redis.from_url(cache_url), cache_url
+    import fakeredis
+    return fakeredis.FakeStrictRedis(), "redis://fakeredis"
+
+
+def dump_files(cache, dump_dir, max_rows, compression=None):
+    '''
+    drain the cache by dump2csv.stream2csv like dump2csv.py without
+    uploading, the md5 and manifest of every file are included
+    return (started, seconds, [(rows, bytes, closed time) of files])
+    '''
+    import dump2csv
+    import manifest
+    import mwlogger
+
+    # set up like dump2csv.main
+    dump2csv.glogger = mwlogger.MwLogger(
+        "dump", os.path.join(dump_dir, "dump.log"))
+    dump2csv.dump_manifest = manifest.Manifest(dump_dir)
+    output = (dump_dir, max_rows, 0, compression, "csv", None)
+    started = time.time()
+    cache.dump_stream(partial(dump2csv.stream2csv, output, None))
+    cost = time.time() - started
+    files = []
+    for path, _ in dump2csv.dump_manifest.files(manifest.WRITTEN):
+        info = dump2csv.dump_manifest.get(path)
+        files.append((info["rows"], info["bytes"], os.path.getmtime(path)))
+    dump2csv.dump_manifest.close()
+    return started, cost, sorted(files, key=lambda info: info[2])
+
+
+def bench_suite(cache_url, server_id, count, batch, width, keys, skew, mix,
+                row_format, max_rows, seed):
+    # cdc reads cdc_config and the binlog event classes, only
+    # _get_row_values of it is called
+    import cdc
+
+    random.seed(seed)
+    client, cache_url = connect(cache_url)
+    client.flushdb()
+    cache = rcache.create(cache_url, server_id, row_format, client=client)
+    events = list(gen_events(count, batch, width, keys, skew, mix))
+    results = {}
+
+    latencies, batches = [], []
+    start = time.time()
+    for event in events:
+        started = time.time()
+        batches.append(cdc._get_row_values(event))
+        latencies.append(time.time() - started)
+    results["decode"] = summary(count, time.time() - start, latencies)
+
+    memory = used_memory(client)
+    latencies = []
+    start = time.time()
+    for rows in batches:
+        started = time.time()
+        cache.save(TABLE, "id", rows)
+        latencies.append(time.time() - started)
+    results["save"] = summary(count, time.time() - start, latencies)
+
+    cached = cache.refresh_size()
+    if memory is not None:
+        memory = used_memory(client) - memory
+    results["memory"] = {
+        "cached_rows": cached, "bytes": memory,
+        "bytes_per_row": round(float(memory) / cached, 1)
+                         if memory is not None and cached else None}
+
+    dump_dir = tempfile.mkdtemp(prefix="benchmark")
+    try:
+        started, cost, files = dump_files(cache, dump_dir, max_rows)
+        # latency of every dumped file, by the time it is closed
+        closed = [started] + [info[2] for info in files]
+        latencies = [closed[i + 1] - closed[i] for i in xrange(len(files))]
+        results["dump"] = summary(sum(info[0] for info in files), cost,
+                                  latencies)
+    finally:
+        shutil.rmtree(dump_dir)
+    client.flushdb()
+    return results
+
+
+def bench_compress(cache_url, server_id, count, width, max_rows, codecs,
+                   seed):
+    '''
+    the same rows are cached and dumped for every codec
+    '''
+    import csvwriter
+
+    client, cache_url = connect(cache_url)
+    cache = rcache.Rcache(cache_url, server_id, client=client)
+    for codec in codecs:
+        try:
+            csvwriter.check_compression(codec)
+        except ImportError as err:
+            print "{}: {}".format(codec, err)
+            continue
+        client.flushdb()
+        random.seed(seed)
+        for start in xrange(0, count, 1000):
+            rows = []
+            for rid in xrange(start + 1, min(start + 1000, count) + 1):
+                row = {"id": rid, "cdc_action": "insert",
+                       "cdc_ts": int(time.time())}
+                for col in xrange(width):
+                    row["col{}".format(col)] = "value{}".format(
+                        random.randint(0, 999999))
+                rows.append(row)
+            cache.save(TABLE, "id", rows)
+        dump_dir = tempfile.mkdtemp(prefix="benchmark")
+        try:
+            _, cost, files = dump_files(cache, dump_dir, max_rows, codec)
+            dumped = [sum(info[0] for info in files),
+                      sum(info[1] for info in files)]
+        finally:
+            shutil.rmtree(dump_dir)
+        print "{}: {} rows in {:.2f}s, {:.0f} rows/sec, {} bytes, " \
+              "{:.1f} bytes/row".format(codec, dumped[0], cost,
+                                        dumped[0] / cost, dumped[1],
+                                        float(dumped[1]) / dumped[0])
+    client.flushdb()
+
+
+def main():
+    options = docopt(__doc__, version=__version__)
+    if options['save']:
+        bench_save(options['--cache_url'], options['--server_id'],
+                   int(options['--rows']), int(options['--batch']),
+                   int(options['--width']), int(options['--keys']))
+    elif options['dump']:
+        bench_dump(options['--cache_url'], options['--server_id'],
+                   int(options['--rows']), int(options['--width']),
+                   [int(b) for b in options['--fetch_batches'].split(',')])
+    elif options['memory']:
+        bench_memory(options['--cache_url'], options['--server_id'],
+                     int(options['--rows']), int(options['--width']))
+    elif options['compress']:
+        bench_compress(options['--cache_url'], options['--server_id'],
+                       int(options['--rows']), int(options['--width']),
+                       int(options['--max_rows']),
+                       options['--codecs'].split(','), int(options['--seed']))
+    elif options['suite']:
+        mix = dict((action, int(weight)) for action, weight in
+                   (item.split(':') for item in options['--mix'].split(',')))
+        settings = {"cache_url": options['--cache_url'] or "fakeredis",
+                    "rows": int(options['--rows']),
+                    "batch": int(options['--batch']),
+                    "width": int(options['--width']),
+                    "keys": int(options['--keys']),
+                    "skew": float(options['--skew']),
+                    "mix": mix,
+                    "row_format": options['--row_format'],
+                    "max_rows": int(options['--max_rows']),
+                    "seed": int(options['--seed'])}
+        results = bench_suite(
+            options['--cache_url'], options['--server_id'],
+            settings["rows"], settings["batch"], settings["width"],
+            settings["keys"], settings["skew"], mix, settings["row_format"],
+            settings["max_rows"], settings["seed"])
+        for name in ("decode", "save", "dump"):
+            result = results[name]
+            print "{}: {} rows in {:.2f}s, {} rows/sec, p50:{}ms, p99:{}ms".format(
+                name, result["rows"], result["seconds"],
+                result["rows_per_sec"], result["p50_ms"], result["p99_ms"])
+        print "memory: {} rows, {} bytes/row".format(
+            results["memory"]["cached_rows"],
+            results["memory"]["bytes_per_row"])
+        output = options['--output']
+        if output:
+            report = json.dumps({"version": __version__,
+                                 "time": int(time.time()),
+                                 "settings": settings,
+                                 "results": results},
+                                indent=2, sort_keys=True)
+            if output == "-":
+                print report
+            else:
+                with open(output, "w") as fp:
+                    fp.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@
 
 '''
 Usage:
-  bq_schema_from_mysql.py [-h HOST] -u USER -p PASSWORD [-P PORT] <database> [<table>...] -s SID -S SYSTEM
+  bq_schema_from_mysql.py [-h HOST] -u USER -p PASSWORD [-P PORT] <database> [<table>...] -s SID -S SYSTEM [-c FILE]
   bq_schema_from_mysql.py (--help | --version)
 
 Arguments:
@@ -19,6 +19,8 @@ Options:
   -P --port=PORT            Specify mysqld server port [default: 3306]
   -s --server_id=SID        Specify mysqld server id
   -S --system=SYSTEM        Specify the app system. etc: VTWeb, MediaWise.
+  -c --schema_cache=FILE    Specify the schema cache file shared with cdc.py,
+                            only tables not cached are queried
 '''
 
 __author__ = 'deng_lingfei'
@@ -47,6 +49,8 @@ import json
 from docopt import docopt
 from collections import defaultdict
 
+import schemacache
+
 schema_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bq_schema")
 
 print schema_dir
@@ -118,6 +122,15 @@ def trans_schema(cur):
         table_schema.append({"name": column, "type": type_trans(data_type)})
     yield (cur_table, table_schema)
 
+def trans_cached_schema(cli, database, tables, cache):
+    for table in tables:
+        columns = cache.fetch(cli, database, table)
+        if columns:
+            yield (table, [{"name": column["COLUMN_NAME"],
+                            "type": type_trans(schemacache.data_type(
+                                column["COLUMN_TYPE"]))}
+                           for column in columns])
+
 
 
 if __name__ == '__main__':
@@ -130,6 +143,7 @@ if __name__ == '__main__':
     tables = args['<table>']
     sid = args['--server_id']
     system = args['--system']
+    schema_cache = args['--schema_cache']
 
     cli = pymysql.connect(host=host, port=port, user=user, password=password, database=database)
     cur = cli.cursor()
@@ -145,12 +159,17 @@ if __name__ == '__main__':
     if not os.path.exists(db_path):
         os.makedirs(db_path)
 
-    tables = ["'{}'".format(t) for t in tables]
-
-    sql = "SELECT column_name, data_type, table_name, table_schema FROM information_schema.columns  where " \
-          "table_schema='{}' and table_name in ({});".format(database, ','.join(tables))
-    cur.execute(sql)
-    for table, schema in trans_schema(cur):
+    if schema_cache:
+        table_schemas = trans_cached_schema(
+            cli, database, tables, schemacache.SchemaCache(schema_cache))
+    else:
+        tables = ["'{}'".format(t) for t in tables]
+
+        sql = "SELECT column_name, data_type, table_name, table_schema FROM information_schema.columns  where " \
+              "table_schema='{}' and table_name in ({});".format(database, ','.join(tables))
+        cur.execute(sql)
+        table_schemas = trans_schema(cur)
+    for table, schema in table_schemas:
         with open(os.path.join(db_path, table), 'w') as fp:
             schema.append({"name": "cdc_action", "type": "string"})
             schema.append({"name": "cdc_ts", "type": "string"})
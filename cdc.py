@@ -17,29 +17,80 @@ mysql configures: /etc/mysql/my.cnf
  
 from __future__ import absolute_import
 from pymysqlreplication import BinLogStreamReader
-from pymysqlreplication.event import RotateEvent
+from pymysqlreplication.event import RotateEvent, XidEvent, QueryEvent
 from pymysqlreplication.row_event import (
     DeleteRowsEvent,
     UpdateRowsEvent,
     WriteRowsEvent
 )
+import os
 import redis
-import commands
 import time
  
+import cdc_config
 import rcache
+import wbuffer
+import partition
+import dumper
+import metrics
+import eventlog
+import rowfilter
+import schemacache
 from cdc_config import (
-    redis_url, cache_url, server_id,
+    redis_url, cache_url, cache_cluster, cache_row_format,
+    cache_change_index, server_id,
     mysql_settings, schemas, tables,
     tables_without_primary_key,
     blocking, events, dump_command,
-    log_level, cache_max_rows, binlog_max_latency
+    log_level, cache_max_rows, binlog_max_latency,
+    buffer_max_rows, buffer_max_delay, buffer_max_transactions,
+    workers, worker_partition, metrics_address, capture_file,
+    table_filters, schema_cache_file
     )
 import mwlogger
  
 logger = mwlogger.MwLogger('mysql-cdc', 'syslog',
             log_level=log_level, facility='local0')
  
+registry = metrics.Registry()
+events_total = registry.register(metrics.Counter(
+    "cdc_events_total", "binlog row events", ("table",)))
+rows_total = registry.register(metrics.Counter(
+    "cdc_rows_total", "changed rows of binlog events", ("table",)))
+binlog_lag = registry.register(metrics.Histogram(
+    "cdc_binlog_lag_seconds", "latency of binlog events",
+    buckets=(1, 5, 10, 30, 60, 300, 600, 1800, 3600)))
+save_seconds = registry.register(metrics.Histogram(
+    "cdc_save_seconds", "latency of saving buffered rows to cache"))
+binlog_position = registry.register(metrics.Gauge(
+    "cdc_binlog_position", "position of the last read transaction",
+    ("log_file",)))
+cache_rows = registry.register(metrics.Gauge(
+    "cdc_cache_rows", "cached rows waiting for dumping", ("table",)))
+dump_triggers = registry.register(metrics.Counter(
+    "cdc_dump_triggers_total", "dump triggers", ("result",)))
+dump_running = registry.register(metrics.Gauge(
+    "cdc_dump_running", "1 if dumping"))
+dump_last_seconds = registry.register(metrics.Gauge(
+    "cdc_dump_last_duration_seconds", "duration of the last dump"))
+dump_last_rows = registry.register(metrics.Gauge(
+    "cdc_dump_last_rows", "rows drained by the last dump"))
+ 
+class CachedBinLogStreamReader(BinLogStreamReader):
+    '''
+    read column schemas of tables from the local schema cache,
+    information_schema is queried only for tables not cached
+    '''
+    schema_cache = None
+ 
+    def _BinLogStreamReader__get_table_information(self, schema, table):
+        columns = self.schema_cache.get(schema, table)
+        if columns is None:
+            columns = BinLogStreamReader._BinLogStreamReader__get_table_information(
+                self, schema, table)
+            self.schema_cache.put(schema, table, columns)
+        return columns
+ 
 def _trans_events(ets):
     aevents = {
             "insert": WriteRowsEvent,
@@ -48,43 +99,163 @@ def _trans_events(ets):
             }
     return [aevents[et] for et in ets]
  
-def _trigger_dumping():
-    status, output = commands.getstatusoutput(dump_command)
-    if status != 0:
-        # alarm
-        logger.error("dump failed: {}".format(output))
-    else:
-        logger.info("dump OK!")
-    return status
+# compiled once, a wrong filter stops cdc.py at startup
+_filters = rowfilter.compile_filters(table_filters)
  
-def _get_row_values(binlogevent):
+# {(schema, table): (table, primary_key, filter)} built on first sight
+_routes = {}
+ 
+def _route(binlogevent):
+    key = (binlogevent.schema, binlogevent.table)
+    route = _routes.get(key)
+    if route is None:
+        table = "%s.%s" % key
+        primary_key = (binlogevent.primary_key or
+                       tables_without_primary_key.get(table, None))
+        if not primary_key:
+            logger.error("{} has neither primary_key nor unique key configure".format(table))
+            exit(1)
+        if isinstance(primary_key, list):
+            primary_key = tuple(primary_key)
+        route = _routes[key] = (table, primary_key, _filters.get(table))
+    return route
+ 
+def _on_query(schema, query, schema_cache=None):
+    '''
+    a ddl query may change the primary key or the columns of tables, their
+    routes and cached schemas are rebuilt by their next events
+    '''
+    if schema_cache is not None:
+        schema_cache.invalidate_query(schema, query)
+    for key in schemacache.ddl_tables(schema, query, _routes.keys()):
+        _routes.pop(key, None)
+        logger.info("schema of {}.{} changed".format(*key))
+ 
+def _get_row_values(binlogevent, rows=None):
+    '''
+    rows: a part of binlogevent.rows, all of them if None
+    '''
+    _, primary_key, rfilter = _route(binlogevent)
     vals_lst = []
-    for row in binlogevent.rows:
+    for row in binlogevent.rows if rows is None else rows:
         if isinstance(binlogevent, DeleteRowsEvent):
             vals = row["values"]
-            vals['cdc_action'] = 'delete'
+            action = 'delete'
         elif isinstance(binlogevent, UpdateRowsEvent):
             vals = row["after_values"]
-            vals['cdc_action'] = 'update'
+            action = 'update'
         elif isinstance(binlogevent, WriteRowsEvent):
             vals = row["values"]
-            vals['cdc_action'] = 'insert'
+            action = 'insert'
+        if rfilter is not None:
+            action = rfilter.action(action, vals, row.get("before_values"))
+            if action is None:
+                continue
+            vals = rfilter.project(vals, primary_key)
+        vals['cdc_action'] = action
         vals['cdc_ts'] = binlogevent.timestamp
         vals_lst.append(vals)
     return vals_lst
  
+def _decode(binlogevent, rows=None):
+    vals_lst = _get_row_values(binlogevent, rows)
+    rows_total.inc(len(vals_lst), _route(binlogevent)[0])
+    return vals_lst
+ 
+def _config_path(path):
+    '''
+    relative paths of cdc_config.py are relative to its dir
+    '''
+    return os.path.join(os.path.dirname(os.path.abspath(cdc_config.__file__)),
+                        path)
+ 
+def _serve_metrics(cache, runner):
+    cache_rows.set_function(cache.table_sizes)
+    dump_triggers.set_function(lambda: {
+        "started": runner.triggered, "ignored": runner.ignored})
+    dump_running.set_function(lambda: {(): int(runner.running)})
+    dump_last_seconds.set_function(lambda: {(): runner.last_duration})
+    dump_last_rows.set_function(lambda: {(): runner.last_rows})
+    metrics.serve(registry, metrics_address)
+    logger.info("serve metrics on {}".format(metrics_address))
+ 
+def _flush(wbuf, cache, runner, interval=1):
+    '''
+    save buffered rows to cache and trigger dumping if cache is full
+    it retries by interval seconds while the dump frees the cache
+    '''
+    while 1:
+        started = time.time()
+        try:
+            saved = wbuf.flush()
+        except rcache.FullError as err:
+            # the failed save is timed too, the sleep is not
+            save_seconds.observe(time.time() - started)
+            runner.trigger("cache OOM occured: {}".format(str(err)))
+            time.sleep(interval)
+            continue
+        save_seconds.observe(time.time() - started)
+        logger.debug("flush {} buffered rows to cache".format(saved))
+        break
+    if cache_max_rows and cache.size > cache_max_rows:
+        runner.trigger("cache size:{} >= {}".format(
+           cache.size, cache_max_rows))
+ 
 def main():
     rclient = redis.from_url(redis_url)
-    cache = rcache.Rcache(cache_url, server_id)
+    cache = rcache.create(cache_url, server_id, cache_row_format,
+                          cluster=cache_cluster,
+                          change_index=cache_change_index)
+    # dumping drains the frozen generations while capture goes on
+    runner = dumper.DumpRunner(dump_command, size=lambda: cache.size,
+                               on_done=lambda status: cache.refresh_size(),
+                               logger=logger)
+    if metrics_address:
+        _serve_metrics(cache, runner)
+    capture = eventlog.EventLogWriter(capture_file) if capture_file else None
+    on_error = lambda err: logger.warning(
+        "flush buffered rows failed: {}".format(err))
+    if workers:
+        # the reader only dispatches events, workers decode and save them
+        wbuf = partition.PartitionedWriter(
+            cache, workers, _decode, worker_partition == "row",
+            buffer_max_rows, buffer_max_delay / 1000.0,
+            buffer_max_transactions,
+            flush=lambda buf: _flush(buf, cache, runner), on_error=on_error)
+        wbuf.start()
+    else:
+        wbuf = wbuffer.WriteBuffer(cache, buffer_max_rows,
+                                   buffer_max_delay / 1000.0,
+                                   buffer_max_transactions)
+        # the daemon flusher triggers dumping on OOM like the reader
+        wbuf.start(on_error, flush=lambda buf: _flush(buf, cache, runner))
  
-    log_file = rclient.get("log_file")
-    log_pos = rclient.get("log_pos")
-    log_pos = int(log_pos) if log_pos else None
+    # the binlog position is saved with the rows in cache,
+    # the one of redis_url is left by the older versions
+    log_file, log_pos = cache.checkpoint()
+    if log_file is None:
+        log_file = rclient.get("log_file")
+        log_pos = rclient.get("log_pos")
+        log_pos = int(log_pos) if log_pos else None
  
     only_events = _trans_events(events)
     only_events.append(RotateEvent)
+    only_events.append(XidEvent)
+    # non-transactional engines like MyISAM commit by a "COMMIT" query,
+    # ddl queries invalidate the cached schemas
+    only_events.append(QueryEvent)
+ 
+    reader = BinLogStreamReader
+    schema_cache = None
+    if schema_cache_file:
+        reader = CachedBinLogStreamReader
+        path = _config_path(schema_cache_file)
+        schema_cache = schemacache.SchemaCache(path)
+        reader.schema_cache = schema_cache
+        logger.info("{} table schemas cached in {}".format(
+            len(schema_cache), path))
  
-    stream = BinLogStreamReader(
+    stream = reader(
         connection_settings=mysql_settings,
         server_id=server_id,
         blocking=blocking,
@@ -98,44 +269,68 @@ def main():
     row_count = 0
  
     for binlogevent in stream:
+        runner.observe_lag(int(time.time()) - binlogevent.timestamp)
+        binlog_lag.observe(int(time.time()) - binlogevent.timestamp)
         if int(time.time()) - binlogevent.timestamp > binlog_max_latency:
             logger.warn("latency[{}] too large".format(
                 int(time.time()) - binlogevent.timestamp))
         logger.debug("catch {}".format(binlogevent.__class__.__name__))
         if isinstance(binlogevent, RotateEvent):  #listen log_file changed event
-            rclient.set("log_file", binlogevent.next_binlog)
-            rclient.set("log_pos", binlogevent.position)
+            log_file = binlogevent.next_binlog
+            wbuf.checkpoint((log_file, binlogevent.position))
+            binlog_position.clear()
+            binlog_position.set(binlogevent.position, log_file)
+            if capture:
+                capture.position(log_file, binlogevent.position)
             logger.info("log_file:{}, log_position:{}".format(
                 binlogevent.next_binlog, binlogevent.position))
+        elif isinstance(binlogevent, XidEvent) or (
+                isinstance(binlogevent, QueryEvent) and
+                binlogevent.query == "COMMIT"):  # transaction committed
+            wbuf.checkpoint((log_file, binlogevent.packet.log_pos))
+            binlog_position.set(binlogevent.packet.log_pos, log_file)
+            if capture:
+                capture.position(log_file, binlogevent.packet.log_pos)
+                # a crash loses no committed transaction of the capture
+                capture.flush()
+            if not workers and wbuf.due():
+                _flush(wbuf, cache, runner)
+        elif isinstance(binlogevent, QueryEvent):
+            _on_query(binlogevent.schema, binlogevent.query, schema_cache)
         else:
             row_count += 1
-            table = "%s.%s" % (binlogevent.schema, binlogevent.table)
-            vals_lst = _get_row_values(binlogevent)
-            if not binlogevent.primary_key:
-                binlogevent.primary_key = tables_without_primary_key.get(table, None)
-                if not binlogevent.primary_key:
-                    logger.error("{} has neither primary_key nor unique key configure".format(table))
-                    exit(1)                    
-            try:
-                cache.save(table, binlogevent.primary_key, vals_lst)
-                logger.debug("save {} {} rows to cache".format(
-                    table, len(vals_lst)))
-            except rcache.SaveIgnore as err:
-                logger.warning(str(err))
-            except rcache.FullError as err:
-                logger.info("cache OOM occured: {}.trigger dump command".format(
-                    str(err)))
-                dump_code = _trigger_dumping()
-                cache.save(table, binlogevent.primary_key, vals_lst)
-            if cache_max_rows and cache.size > cache_max_rows:
-                logger.info("cache size:{} >= {}, trigger dumping".format(
-                   cache.size, cache_max_rows))
-                _trigger_dumping()
-            rclient.set("log_pos", binlogevent.packet.log_pos)
+            table, primary_key, _ = _route(binlogevent)
+            events_total.inc(1, table)
+            if workers:
+                if capture:
+                    # rows are parsed once, workers decode the parsed rows
+                    capture.rows(table, primary_key,
+                                 _get_row_values(binlogevent))
+                wbuf.add(table, primary_key, binlogevent)
+            else:
+                vals_lst = _decode(binlogevent)
+                if capture:
+                    # before buffering, merging changes cdc_action in place
+                    capture.rows(table, primary_key, vals_lst)
+                try:
+                    wbuf.add(table, primary_key, vals_lst)
+                    logger.debug("buffer {} {} rows".format(
+                        table, len(vals_lst)))
+                except rcache.SaveIgnore as err:
+                    logger.warning(str(err))
+                if wbuf.due():
+                    _flush(wbuf, cache, runner)
         if row_count % 1000 == 0:
             logger.info("save {} changed rows".format(row_count))
  
+    if workers:
+        wbuf.stop()
+    else:
+        _flush(wbuf, cache, runner)
     stream.close()
+    if capture:
+        capture.close()
+    runner.wait()
  
 if __name__ == "__main__":
     main()      
@@ -2,10 +2,15 @@
 # encoding: utf-8
  
  
-# redis for saving binlog file and position
+# redis for saving binlog file and position by the older versions.
+# the position is saved in cache now, it is read only if cache has no one
 # please reverse the db + 1 for saving mysql changed data
 redis_url = "redis://127.0.0.1/0"
 cache_url = "redis://127.0.0.1/1"
+# shard the cache by tables if cache_url is a list of urls like:
+# ["redis://10.0.0.1/1", "redis://10.0.0.2/1"]
+# set cache_cluster True if cache_url is a node of redis cluster
+cache_cluster = False
  
 # mysql server id
 server_id = 1 
@@ -38,6 +43,39 @@ blocking = True
 # watch event setting
 events = ["insert", "update", "delete"]
  
+# the format of rows saved in cache:
+# "hash": one redis hash per row
+# "packed": one msgpack value per row, saves memory of wide tables
+# dump2csv.py must use the same row_format
+cache_row_format = "hash"
+
+# index cached rows by cdc_ts, so "dump2csv.py --until" dumps rows changed
+# before a watermark while capture goes on, and "--since" exports recent
+# changes without draining them. costs a sorted set entry per cached row
+cache_change_index = False
+
+# changed rows are merged in cdc.py before saving to cache.
+# the buffered rows of committed transactions are saved with the binlog
+# position atomically if they reach buffer_max_rows, or wait for
+# buffer_max_delay milliseconds, or buffer_max_transactions transactions
+# committed(0 for no limit). set buffer_max_transactions 1 to save every
+# transaction. a transaction larger than buffer_max_rows is saved before
+# its commit without moving the binlog position.
+# rows and position are saved by one script, all or nothing of them if
+# redis is out of memory. redis cluster saves a table by a script and the
+# position after all tables, a table saved before a failure is not saved
+# again by the retry
+buffer_max_rows = 5000
+buffer_max_delay = 100
+buffer_max_transactions = 0
+
+# decode and save changed rows by worker threads, 0 for the reading thread.
+# worker_partition: dispatch events to workers by "table", or split
+# events to workers by "row" for the hot tables. the binlog position is
+# saved after all workers saved the rows before it
+workers = 0
+worker_partition = "table"
+
 # turn off dumping trigger if set to 0
 cache_max_rows = 2000000
  
@@ -46,3 +84,27 @@ dump_command = "python dump2csv.py -c dump.conf"
 log_level = "INFO"
  
 binlog_max_latency = 60000
+
+# serve metrics in prometheus text format, "host:port" or
+# "unix:/path/of/socket", None to turn off
+metrics_address = "127.0.0.1:9308"
+
+# record changed rows and binlog positions into this file for replaying
+# by replay.py without mysql, None to turn off
+capture_file = None
+
+# keep or drop columns and rows of tables before caching them:
+# {"db.table": {"include": ("id", "name"),   # or "exclude": ("body",)
+#               "where": [("status", "!=", 0), ("type", "in", (1, 2))]}}
+# the primary key is always kept. where is a list of (column, op, value)
+# which all must be true, op: == != < <= > >= in "not in".
+# the rows true for where are mirrored: an update making a row true is
+# cached as an insert, an update making it false as a delete, and a delete
+# is kept only for a true row, the ones made false were deleted by then.
+table_filters = {}
+
+# column schemas of tables are cached in this file and read by restarts,
+# so mysql's information_schema is queried only for new or altered tables,
+# like "schema_cache.json". a relative path is relative to the dir of this
+# file. bq_schema_from_mysql.py -c can share it. None to query them every time
+schema_cache_file = None
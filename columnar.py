@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+typed parquet files of cached rows, column types are read from the
+bigquery schemas generated by bq_schema_from_mysql.py:
+  bq_schema/<system>/<sid>/<db>/<table>
+
+cached values are strings(or ints of the packed row format), they are
+converted once here, so bigquery loads the files without parsing csv.
+'''
+
+import os
+import json
+from datetime import datetime
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+
+import csvwriter
+
+
+def _to_int(value):
+    if value is None or value == "":
+        return None
+    return int(value)
+
+
+def _to_float(value):
+    if value is None or value == "":
+        return None
+    return float(value)
+
+
+def _to_timestamp(value):
+    '''
+    "yyyy-mm-dd hh:mm:ss[.ffffff]", zero dates of mysql are None
+    '''
+    if value is None or value == "" or value.startswith("0000-00-00"):
+        return None
+    if "." in value:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f")
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+
+def _to_string(value):
+    '''
+    parquet strings are utf-8, invalid bytes of blobs are replaced
+    '''
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")
+    return unicode(value)
+
+
+# {bigquery type: converter}
+_CONVERTERS = {
+    "integer": _to_int,
+    "float": _to_float,
+    "timestamp": _to_timestamp,
+    "string": _to_string,
+}
+
+
+def _arrow_type(bq_type):
+    if bq_type == "integer":
+        return pyarrow.int64()
+    if bq_type == "float":
+        return pyarrow.float64()
+    if bq_type == "timestamp":
+        return pyarrow.timestamp("us")
+    return pyarrow.string()
+
+
+def load_schema(schema_dir, table):
+    '''
+    schema_dir: the bigquery schema dir of a server like bq_schema/VTWeb/1
+    return {column: bigquery type}, None if the table has no schema
+    '''
+    path = os.path.join(schema_dir, *table.split(".", 1))
+    if not os.path.exists(path):
+        return None
+    with open(path) as fp:
+        return dict((field["name"], field["type"].lower())
+                    for field in json.load(fp))
+
+
+class _ParquetFile(object):
+    def __init__(self, path, columns, types, compression, batch_rows):
+        self.path = path
+        # exclusive, dumping processes may write the same table
+        self.raw = os.fdopen(os.open(path + ".part",
+                                     os.O_WRONLY | os.O_CREAT | os.O_EXCL),
+                             "wb")
+        self._columns = columns
+        self._converters = [_CONVERTERS.get(types.get(column), _to_string)
+                            for column in columns]
+        self._schema = pyarrow.schema(
+            [pyarrow.field(column, _arrow_type(types.get(column)))
+             for column in columns])
+        self._writer = parquet.ParquetWriter(self.raw, self._schema,
+                                             compression=compression)
+        self._batch_rows = batch_rows
+        self._batch = [[] for _ in columns]
+        self.rows = 0
+
+    def write(self, row):
+        for values, column, convert in zip(self._batch, self._columns,
+                                           self._converters):
+            values.append(convert(row[column]))
+        if len(self._batch[0]) >= self._batch_rows:
+            self._flush()
+
+    def _flush(self):
+        '''
+        write the buffered rows as a row group
+        '''
+        if not self._batch[0]:
+            return
+        arrays = [pyarrow.array(values, type=field.type)
+                  for values, field in zip(self._batch, self._schema)]
+        self._writer.write_table(
+            pyarrow.Table.from_arrays(arrays, schema=self._schema))
+        self._batch = [[] for _ in self._columns]
+
+    @property
+    def size(self):
+        '''
+        bytes of the written row groups
+        '''
+        return self.raw.tell()
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+        self.raw.close()
+
+
+class TableParquetWriter(csvwriter.TableCsvWriter):
+    '''
+    like TableCsvWriter, but rows are written to parquet files like
+    "dump_dir/yyyymmdd/db.table.timestamp.parquet" by row groups of
+    batch_rows rows. max_bytes counts the bytes of written row groups.
+
+    types: {column: bigquery type} of load_schema, columns not in it
+    are strings
+    compression: the parquet codec, like "snappy", "gzip" or "zstd"
+    '''
+
+    extension = "parquet"
+    # loaded as parquet too, the bigquery table may need to be altered
+    altered_extension = "tmp.parquet"
+
+    def __init__(self, dump_dir, table, max_rows=0, max_bytes=0,
+                 on_file=None, compression="snappy", types=None,
+                 batch_rows=10000):
+        if pyarrow is None:
+            raise ImportError("parquet format requires pyarrow")
+        super(TableParquetWriter, self).__init__(dump_dir, table, max_rows,
+                                                 max_bytes, on_file)
+        self._parquet_compression = compression
+        self._types = types or {}
+        self._batch_rows = batch_rows
+
+    def _new_file(self, path, columns):
+        return _ParquetFile(path, columns, self._types,
+                            self._parquet_compression, self._batch_rows)
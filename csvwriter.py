@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import io
+import os
+import csv
+import gzip
+import errno
+import time
+import zlib
+import operator
+from datetime import datetime
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# {compression: suffix of file}
+SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+# fast levels, compressing must not slow down draining the cache
+LEVELS = {"gzip": 1, "zstd": 1}
+
+
+def _compressor(compression):
+    if compression == "gzip":
+        # wbits 16 + 15 writes the gzip header and trailer
+        return zlib.compressobj(LEVELS["gzip"], zlib.DEFLATED, 31)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd compression requires zstandard")
+        return zstandard.ZstdCompressor(level=LEVELS["zstd"]).compressobj()
+    raise ValueError("unknown compression: {}".format(compression))
+
+
+def check_compression(compression):
+    '''
+    compression: None, "none", "gzip" or "zstd"
+    return None or the compression, raise if it can not be used
+    '''
+    if not compression or compression == "none":
+        return None
+    _compressor(compression)
+    return compression
+
+
+def open_dumped(path):
+    '''
+    open a dumped csv file for reading, compressed or not, compressed ones
+    are decompressed while read
+    '''
+    if path.endswith(SUFFIXES["gzip"]):
+        return gzip.open(path, "rb")
+    if path.endswith(SUFFIXES["zstd"]):
+        if zstandard is None:
+            raise ImportError("zstd compression requires zstandard")
+        return _Decompressed(open(path, "rb"))
+    return open(path, "rb")
+
+
+class _Decompressed(io.BufferedReader):
+    '''
+    a read only zstd file, data is decompressed while read from fp
+    '''
+
+    def __init__(self, fp):
+        super(_Decompressed, self).__init__(
+            zstandard.ZstdDecompressor().stream_reader(fp))
+        self._fp = fp
+
+    def close(self):
+        try:
+            super(_Decompressed, self).close()
+        finally:
+            self._fp.close()
+
+
+class _Compressed(object):
+    '''
+    a write only file, data is compressed before written to fp
+    '''
+
+    def __init__(self, fp, compression):
+        self._fp = fp
+        self._compressor = _compressor(compression)
+
+    def write(self, data):
+        data = self._compressor.compress(data)
+        if data:
+            self._fp.write(data)
+
+    def close(self):
+        self._fp.write(self._compressor.flush())
+        self._fp.close()
+
+
+class _File(object):
+    def __init__(self, path, columns, compression=None):
+        self.path = path
+        # exclusive, dumping processes may write the same table
+        self.raw = os.fdopen(os.open(path + ".part",
+                                     os.O_WRONLY | os.O_CREAT | os.O_EXCL),
+                             "wb")
+        self.fp = (_Compressed(self.raw, compression) if compression
+                   else self.raw)
+        self.writer = csv.writer(self.fp)
+        self.writer.writerow(columns)
+        getter = operator.itemgetter(*columns)
+        self.values = getter if len(columns) > 1 else lambda row: (getter(row),)
+        self.rows = 0
+
+    def write(self, row):
+        self.writer.writerow(self.values(row))
+
+    @property
+    def size(self):
+        '''
+        bytes written to the disk, compressed ones if compressed
+        '''
+        return self.raw.tell()
+
+    def close(self):
+        self.fp.close()
+
+
+class TableCsvWriter(object):
+    '''
+    stream rows of one table into csv files like
+    "dump_dir/yyyymmdd/db.table.timestamp.csv"
+
+    the column order of every field set is computed once, rows are
+    written as tuples of it. rows of different field sets go to
+    different files, which are suffixed by "tmp" because the table
+    may be altered. a file is closed when it reaches max_rows rows or
+    max_bytes bytes(0 for no limit), it is written as ".part" before.
+
+    compression: None, "gzip" or "zstd", files are compressed while
+    written and suffixed by ".gz" or ".zst", max_bytes counts the
+    compressed bytes
+
+    usage:
+      writer = TableCsvWriter(dump_dir, table, 1000000,
+                              on_file=lambda path, rows: upload(path))
+      try:
+          writer.write_rows(cache_rows_iterator)
+      except Exception:
+          writer.close(False)
+          raise
+      writer.close()
+    '''
+
+    # file name suffixes of a complete file and a file of altered table
+    extension = "csv"
+    altered_extension = "tmp"
+
+    def __init__(self, dump_dir, table, max_rows=0, max_bytes=0,
+                 on_file=None, compression=None):
+        self._dump_dir = dump_dir
+        self._table = table
+        self._max_rows = max_rows
+        self._max_bytes = max_bytes
+        self._on_file = on_file
+        self._compression = check_compression(compression)
+        self._suffix = SUFFIXES.get(self._compression, "")
+        # {keys of row: sorted columns}
+        self._columns = {}
+        # {sorted columns: _File}
+        self._files = {}
+        self.rows = 0
+        # bytes of closed files
+        self.bytes = 0
+
+    @property
+    def altered(self):
+        return len(set(self._columns.itervalues())) > 1
+
+    def _open(self, columns):
+        save_dir = os.path.join(
+            self._dump_dir, datetime.strftime(datetime.today(), "%Y%m%d"))
+        if not os.path.exists(save_dir):
+            try:
+                os.makedirs(save_dir)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+        while 1:
+            path = os.path.join(save_dir, "{}.{:.6f}".format(
+                self._table, time.time()))
+            try:
+                out = self._files[columns] = self._new_file(path, columns)
+                return out
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+
+    def _new_file(self, path, columns):
+        return _File(path, columns, self._compression)
+
+    def _close(self, columns):
+        out = self._files.pop(columns)
+        out.close()
+        self.bytes += os.path.getsize(out.path + ".part")
+        path = "{}.{}{}".format(out.path,
+                                self.altered_extension if self.altered
+                                else self.extension,
+                                self._suffix)
+        os.rename(out.path + ".part", path)
+        if self._on_file:
+            self._on_file(path, out.rows)
+
+    def write(self, row):
+        keys = tuple(row)
+        columns = self._columns.get(keys)
+        if columns is None:
+            columns = self._columns[keys] = tuple(sorted(keys))
+        out = self._files.get(columns)
+        if out is None:
+            out = self._open(columns)
+        out.write(row)
+        out.rows += 1
+        self.rows += 1
+        if (self._max_rows and out.rows >= self._max_rows or
+                self._max_bytes and out.size >= self._max_bytes):
+            self._close(columns)
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write(row)
+        return self.rows
+
+    def close(self, complete=True):
+        '''
+        complete: False if writing failed, the files are left as ".part"
+        '''
+        for columns in self._files.keys():
+            if complete:
+                self._close(columns)
+            else:
+                self._files.pop(columns).close()
@@ -3,8 +3,8 @@
 
 '''
 Usage:
-  dump2csv.py -s SID -u REDIS_URL -d DIR [-m COUNT] [-l DIR] [-v] [<table>...] [-g GSTORAGE]
-  dump2csv.py -c CONFIG_FILE [-v] [<table>...]
+  dump2csv.py -s SID -u REDIS_URL -d DIR [-m COUNT] [-M BYTES] [-z CODEC] [-F FORMAT] [-S SYSTEM] [--schema_dir=DIR] [-b COUNT] [-r FORMAT] [--cluster] [--change_index] [-j N] [--shard_rows=COUNT] [-l DIR] [-v] [<table>...] [-g GSTORAGE] [-U N] [-L N] [--follow [--window=SECONDS] [--follow_rows=COUNT] | --until=TS | --since=TS [--until=TS]]
+  dump2csv.py -c CONFIG_FILE [-v] [-j N] [--follow [--window=SECONDS] [--follow_rows=COUNT] | --until=TS | --since=TS [--until=TS]] [<table>...]
   dump2csv.py (-h | --help | --version)
 
 Arguments:
@@ -17,293 +17,345 @@ Options:
   -v --verbose                  Print the running status message
   -s --server_id=SID            Specify mysql server id
   -u --cache_url=REDIS_URL      Specify the redis cache url like:
-                                "redis://host:port/db"
+                                "redis://host:port/db", separate urls of
+                                the sharded cache by ","
+  --cluster                     The cache url is a node of redis cluster
+  --change_index                The cache is written with the change index of
+                                cache_change_index, for --until and --since
   -d --dump_dir=DIR             Specify the dir of dump result
   -l --log_dir=DIR              Specify the dir of logging
   -m --max_rows=COUNT           Specify max rows of one csv file [default: 1000000]
-  -g --gs_url=GSTORSGE          Specify the gs url for storaging dumping files
+  -M --max_bytes=BYTES          Specify max bytes of one csv file, 0 for no limit
+                                [default: 0]
+  -z --compression=CODEC        Specify compression of csv files: none, gzip
+                                or zstd. gzip files are suffixed by ".csv.gz"
+                                and loadable by bigquery, zstd files by
+                                ".csv.zst" are not, so not with -g
+                                [default: none]
+  -F --format=FORMAT            Specify format of dumped files: csv or parquet.
+                                parquet files are typed by the bigquery schemas
+                                of bq_schema_from_mysql.py, compressed by the
+                                codec of -z or snappy for none [default: csv]
+  -S --system=SYSTEM            Specify the app system of bigquery schemas like
+                                VTWeb, the last dir of gs_url for nothing
+  --schema_dir=DIR              Specify the dir of bigquery schemas
+                                [default: bq_schema]
+  -b --fetch_batch=COUNT        Specify rows fetched from redis by one round trip
+                                [default: 1000]
+  -r --row_format=FORMAT        Specify the row format of cache: hash or packed
+                                [default: hash]
+  -j --jobs=N                   Specify processes dumping tables in parallel,
+                                every process has its own redis connections
+                                [default: 1]
+  --shard_rows=COUNT            Split a table of more rows into shards dumped
+                                by processes in parallel, 0 for no split
+                                [default: 1000000]
+  -g --gs_url=GSTORSGE          Specify the gs url for storaging dumping files,
+                                or a local dir like "file:///data/uploads"
+  -U --upload_workers=N         Specify threads uploading files [default: 4]
+  -L --load_workers=N           Specify load jobs run in parallel after
+                                uploading, files of a table are loaded by jobs
+                                of at most 10000 files, a file of an altered
+                                table by its own job [default: 4]
+  --follow                      Keep draining tables in small increments until
+                                SIGTERM or SIGINT, without the global dumping
+                                lock. a table is drained when it has follow_rows
+                                rows or window seconds passed since it was
+                                drained, uploaded files are loaded every window
+  --window=SECONDS              Specify the time window of following [default: 60]
+  --follow_rows=COUNT           Specify rows of a table to drain it when
+                                following [default: 100000]
+  --until=TS                    Dump and remove only the rows changed at or
+                                before the watermark TS(cdc_ts) table by table,
+                                while capture goes on. needs cache_change_index
+                                of cdc_config.py and --change_index
+  --since=TS                    Export the rows changed from TS(to --until)
+                                without removing them, like "--since=-3600" for
+                                the last hour. needs cache_change_index too.
+                                export only: files are written into DIR/changes,
+                                never recorded, uploaded or loaded, the rows
+                                stay cached for the next dumping.
+                                TS is a unix timestamp, or seconds before now
+                                if it is negative
 '''
 
-import csv
 import os
 import time
+import signal
 from functools import partial
 from docopt import docopt
-from collections import defaultdict
 import json
-from Queue import Queue, Empty
-import threading
-import commands
+import multiprocessing
 
 import rcache
+import csvwriter
+import columnar
+import uploader
+import loader
+import manifest
 import mwlogger
-from datetime import datetime
 
 __version__ = "Version0.1"
 
 
-rqueue = Queue() # queue for uploading to google storage
-bqueue = Queue() # queue for loading to bigquery
+gs_uploader = None # uploading to google storage, uploader.Uploader
+dump_manifest = None # states of dumped files, manifest.Manifest
 
 glogger = None
 
-def group_by_field(rows):
+def _dispatch(gs_url, csv_file):
+    glogger.info("dispatch {} to uploader".format(csv_file))
+    gs_uploader.put(csv_file)
+
+
+def _file_info(csv_file, rows):
+    '''
+    return (csv_file, rows, bytes, md5) for the manifest
+    '''
+    return (csv_file, rows, os.path.getsize(csv_file),
+            manifest.file_md5(csv_file))
+
+
+def _written(gs_url, csv_file, rows, size, md5):
+    dump_manifest.written(csv_file, rows, size, md5)
+    if gs_url:
+        _dispatch(gs_url, csv_file)
+
+
+def _csv_done(gs_url, csv_file, rows):
+    glogger.info("{} dump Done. rows:{}".format(csv_file, rows))
+    _written(gs_url, *_file_info(csv_file, rows))
+
+
+def create_writer(output, table, on_file):
+    '''
+    output: (dump_dir, max_rows, max_bytes, compression, file_format,
+             schema_dir), schema_dir is the bigquery schema dir of the server
+    '''
+    dump_dir, max_rows, max_bytes, compression, file_format, schema_dir = output
+    if file_format == "parquet":
+        types = columnar.load_schema(schema_dir, table)
+        if types is None:
+            glogger.warn("Not found schema of {} in {}, dump strings".format(
+                table, schema_dir))
+        return columnar.TableParquetWriter(
+            dump_dir, table, max_rows, max_bytes, on_file,
+            compression or "snappy", types)
+    return csvwriter.TableCsvWriter(dump_dir, table, max_rows, max_bytes,
+                                    on_file, compression)
+
+
+def stream2csv(output, gs_url, table, rows):
     '''
-    return {(field1, field2...):[row1, row2...] ....}
+    write rows iterated from cache into csv files without loading
+    them all, files are rotated by max_rows or max_bytes
     '''
-    g_rows = defaultdict(list)
-
-    for row in rows:
-        fields = row.keys()
-        fields.sort()
-        g_rows[tuple(fields)].append(row)
-    return g_rows
-
-def save2csv(dump_dir, table, trows, gs_url):
-    """
-    save table's rows into csv_files. csv_file like
-     'db.table.timestamp.csv'
-    :param dump_dir:
-    :param table:
-    :param trows:
-    :param gs_url:
-    :return: None
-    """
+    _stream(output, partial(_csv_done, gs_url), table, rows)
+
+
+def _stream(output, on_file, table, rows):
+    writer = create_writer(output, table, on_file)
     try:
-        if len(trows) == 0:
-            glogger.info("table[{}] has no rows to dump".format(table))
-            return
-        g_rows = group_by_field(trows)
-        table_alter = False
-        if len(g_rows) > 1:
-            glogger.warn("table[{}] maybe altered.".format(table))
-            table_alter = True
-        for fieldnames, rows in g_rows.items():
-            save_dir = os.path.join(dump_dir, datetime.strftime(datetime.today(), "%Y%m%d"))
-            if not os.path.exists(save_dir):
-                os.makedirs(save_dir)
-            suffix = "tmp" if table_alter else "csv"
-            csv_file = os.path.join(save_dir,
-                "{}.{:.6f}.{}".format(table, time.time(), suffix))
-            glogger.info("dump to {}, rows:{}".format(csv_file, len(rows)))
-            exists = os.path.exists(csv_file)
-            with open(csv_file, 'ab+') as fp:
-                dict_writer = csv.DictWriter(fp, fieldnames=fieldnames)
-                if not exists:
-                    dict_writer.writeheader()
-                dict_writer.writerows(rows)
-            glogger.info("{} dump Done.".format(csv_file))
-            if gs_url:
-                glogger.info("dispatch {} to rqueue".format(csv_file))
-                rqueue.put(csv_file)
-                time.sleep(2)
-        glogger.info("table:{}, rows:{} dump OK!".format(table, len(trows)))
+        writer.write_rows(rows)
     except:
+        writer.close(False)
         glogger.error("{} dump Error".format(table), exc_info=True)
         raise
+    writer.close()
+    if writer.altered:
+        glogger.warn("table[{}] maybe altered.".format(table))
+    glogger.info("table:{}, rows:{}, bytes:{} dump OK!".format(
+        table, writer.rows, writer.bytes))
 
 
-def create_logger(log_dir, verbose):
-    log_level = "INFO"
-    if verbose:
-        log_file = None
-        log_level = "DEBUG"
-    elif log_dir:
-        log_file = os.path.join(log_dir, "dump.log")
-    else:
-        log_file = "dump.log"
+# caches of a dumping process, one per cache url
+_worker_caches = None
 
-    return mwlogger.MwLogger("dump", log_file, log_level=log_level)
 
+def _init_worker(cache_urls, server_id, row_format, fetch_batch, cluster):
+    global _worker_caches
+    _worker_caches = [rcache.create(url, server_id, row_format, fetch_batch,
+                                    cluster) for url in cache_urls]
 
-def _upload_by_date(csv_file, gs_url):
+
+def _dump_task(args):
     '''
-    -m: multi-thread
-    -n: skip files exist in gstorage
-    -L: record the file uploaded info
+    dump a shard of a table in a dumping process, the table is
+    cleared here if it is not split
+    return (index, table, gens, shards, rows, [(csv file, rows, bytes, md5)])
     '''
-    csv_pdir = os.path.dirname(csv_file)
-    date = os.path.basename(csv_pdir)
-    cmd = "gsutil -m cp -n -L {log} -r {src} {dst}".format(
-        log=os.path.join(csv_pdir, "upload.info"),
-        src=os.path.join(csv_pdir, "*.csv"),
-        dst=os.path.join(gs_url, date)
-    )
-    for tries in range(3):
-        ret, out = commands.getstatusoutput(cmd)
-        if ret == 0 or tries == 2:
-            break
-        else:
-            time.sleep(2)
-    return ret >> 8, out
+    output, (index, table, gens, shard, shards) = args
+    cache = _worker_caches[index]
+    files = []
 
+    def _done(csv_file, rows):
+        # recorded into the manifest by the parent
+        glogger.info("{} dump Done. rows:{}".format(csv_file, rows))
+        files.append(_file_info(csv_file, rows))
 
-def async_upload2gstorage_ex(gs_url):
-    while 1:
-        csv_file = rqueue.get()
-        if csv_file is None:
-            glogger.info("all csv_files upload ok, thread exit!")
-            break
-        else:
-            ret, output = _upload_by_date(csv_file, gs_url)
-            if ret != 0:
-                glogger.error("upload failed, return code:{}, out:{}".format(ret, output))
-            else:
-                glogger.info("upload ok!")
-
-
-def group_lst(csvs):
-    to_ups = []
-    pre_date = cur_date = None
-    for csv_f in csvs:
-        csv_pdir = os.path.dirname(csv_f)
-        cur_date = os.path.basename(csv_pdir)
-        if pre_date is None or pre_date == cur_date:
-            to_ups.append(csv_f)
-            if len(to_ups) >= 8:
-                to_ups = yield to_ups
-                yield  # yield to send
-        else:
-            to_ups = yield to_ups
-            yield  # yield to send
-            to_ups.append(csv)
-        pre_date = cur_date
-    to_ups = yield to_ups
-    yield  # yield to send
-
-
-def upload_csvs(gs_url, csvs):
-    loop_times = 0
-    gen = group_lst(csvs)
-    for gcsvs in gen:
-        if len(gcsvs) == 0:
-            break
-        glogger.info("start uploading {} to gstorage".format(str(gcsvs)))
-        csv_pdir = os.path.dirname(gcsvs[0])
-        date = os.path.basename(csv_pdir)
-        cmd = "gsutil -m cp -n -L {log} {src} {dst}/".format(
-            log=os.path.join(csv_pdir, "upload.info"),
-            src=' '.join(gcsvs),
-            dst=os.path.join(gs_url, date)
-        )
-        ret, out = _run_cmd_retry(cmd, 3)
-        if ret == 0:
-            glogger.info("upload successfully, files count:{}".format(len(gcsvs)))
-            gen.send([])
+    writer = create_writer(output, table, _done)
+    try:
+        writer.write_rows(cache.iter_dump_rows(table, gens, shard, shards))
+    except:
+        writer.close(False)
+        glogger.error("{} shard {}/{} dump Error".format(table, shard, shards),
+                      exc_info=True)
+        raise
+    writer.close()
+    if shards == 1:
+        cache.clear_generations(table, gens)
+    return index, table, gens, shards, writer.rows, files
+
+
+def dump_parallel(cache, pool, jobs, shard_rows, dump_tables, output, gs_url):
+    '''
+    dump tables by a pool of jobs processes, a large table is split into
+    shards by rid hash and cleared after all of its shards are dumped.
+    the dumping lock is held by this process, the pool is closed here
+    pool: created by create_pool before any thread is started
+    output: the output of create_writer
+    '''
+    try:
+        _dump_shards(cache, pool, jobs, shard_rows, dump_tables, output,
+                     gs_url)
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def _dump_shards(cache, pool, jobs, shard_rows, dump_tables, output, gs_url):
+    caches = (cache.caches if isinstance(cache, rcache.ShardedRcache)
+              else [cache])
+    for one in caches:
+        one.lock_dumping()
+    try:
+        tasks = [(index,) + task for index, one in enumerate(caches)
+                 for task in one.dump_tasks(dump_tables, shard_rows, jobs)]
+        shards_left = dict(((index, table), shards)
+                           for index, table, _, _, shards in tasks)
+        glogger.info("dump {} tables by {} shards in {} processes".format(
+            len(shards_left), len(tasks), jobs))
+        for index, table, gens, shards, rows, files in pool.imap_unordered(
+                _dump_task, [(output, task) for task in tasks]):
+            for info in files:
+                _written(gs_url, *info)
+            shards_left[(index, table)] -= 1
+            if shards > 1 and not shards_left[(index, table)]:
+                caches[index].clear_generations(table, gens)
+            glogger.info("table:{}, rows:{} of a shard dump OK!".format(
+                table, rows))
+    finally:
+        for one in caches:
+            one.unlock_dumping()
+
+
+def create_pool(jobs, worker_args):
+    '''
+    fork the dumping processes before the manifest is opened and the
+    uploader threads are started, the children inherit neither of them
+    worker_args: (cache_urls, server_id, row_format, fetch_batch, cluster)
+    '''
+    return multiprocessing.Pool(jobs, _init_worker, worker_args)
+
+
+def follow(cache, output, gs_url, dump_tables, window, follow_rows, gs_loader,
+           interval=1):
+    '''
+    drain tables one by one in small increments until SIGTERM or SIGINT,
+    the files of every increment are complete when it is drained.
+    table counters are read without scanning keys, new tables are found
+    by a scan every window
+    '''
+    stopping = []
+
+    def _stop(signum, frame):
+        glogger.info("signal {} received, stop following".format(signum))
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    callback = partial(stream2csv, output, gs_url)
+    # {table: time of the last drain}
+    drained = {}
+    scanned = loaded = 0
+    sizes = {}
+    while not stopping:
+        now = time.time()
+        if now - scanned >= window:
+            cache.refresh_size()
+            sizes = cache.table_sizes()
+            scanned = now
         else:
-            # should check and upload failed files to google cloud storage manually
-            glogger.error("{} run error. ret:{}, out:{}".format(
-                cmd, ret, out
-            ))
-            # parse success from log_file, upload.info's schema:
-            # Source,Destination,Start,End,Md5,UploadId,Source Size,Bytes Transferred,Result,Description
-            loop_times += 1
-            if loop_times < 3: # avoid endless loop
-                log = os.path.join(csv_pdir, "upload.info")
-                with open(log) as fp:
-                    _ups = list(csv.DictReader(fp))
-                sources = [up['Source'].strip("file://") for up in _ups]
-                # retry in next loop
-                gen.send(list(set(gcsvs) - set(sources)))
-            else:
-                gen.send([])
-
-        glogger.info("start load gstorage csv files to bigquery......")
-        bqueue.put(csv_pdir)
-        #load2bq(csv_pdir)
-
-
-def load2bq(upload_dir):
-    upload_log = os.path.join(upload_dir, "upload.info")
-    bq_log = os.path.join(upload_dir, "bqload.info")
-
-    to_loads = loadeds = []
-    if os.path.exists(bq_log):
-        with open(bq_log, 'r') as fp:
-            loadeds = fp.readlines()
-        loadeds = [load.strip() for load in loadeds]
-
-    with open (upload_log, 'r') as fp:
-        _ups = list(csv.DictReader(fp))
-        gs_urls = [up['Destination'] for up in _ups]
-
-    to_loads = list(set(gs_urls) - set(loadeds))
-
-    # load all uploaded files to bigquery
-    with open(bq_log, 'a') as fp:
-        for gs_url in to_loads:
-            glogger.debug(gs_url)
-            [_, system, sid, _, csv_file] = gs_url.strip("gs://").split('/')
-            db = csv_file.split('.')[0]
-            tb = csv_file.split('.')[1]
-            schema = os.path.join("bq_schema",
-                                  system,
-                                  sid,
-                                  db,
-                                  tb)
-
-            #bqDataset = "{}:{}:{}".format(system, sid, db)
-            bqDataset = db # Not support the same database name from different systems
-            ret, out = _run_cmd_retry("bq mk {}".format(bqDataset), 3)
-            glogger.debug("cmd:{}, ret={}, out={}".format("bq mk {}".format(bqDataset), ret, out))
-            if not (ret == 0 or ret == 1 and "already exists" in out):
-                glogger.error("Dataset[{}] may not exists and create it failed".format(bqDataset))
-
-            if not os.path.exists(schema):
-                glogger.warn("Not found schema: {}. Ignore it".format(schema))
-                cmd = "bq load --skip_leading_rows=1 --allow_quoted_newlines" \
-                      " {}.{} {}".format(bqDataset, tb, gs_url)
-            else:
-                cmd = "bq load  --schema={} --skip_leading_rows=1 --allow_quoted_newlines" \
-                      " {}.{} {}".format(schema, bqDataset, tb, gs_url)
-            glogger.debug("load to bigqeury command: {}".format(cmd))
-            ret, out = _run_cmd_retry(cmd, 3)
-            if ret == 0:
-                glogger.info("load {} to bigquery successfully".format(gs_url))
-                fp.write(gs_url + '\n')
+            sizes = cache.refresh_table_sizes(sizes.keys())
+        due = [table for table, rows in sizes.iteritems()
+               if rows and (not dump_tables or table in dump_tables) and
+               (rows >= follow_rows or
+                now - drained.setdefault(table, now) >= window)]
+        busy = False
+        for table in due:
+            if stopping:
+                break
+            if cache.drain_table(table, callback):
+                drained[table] = time.time()
+                busy = True
             else:
-                # should check and load failed files to bigquery manually
-                glogger.error("load {} to bigquery failed. msg is {} "
-                              "Please check command ['{}'] manually".format(gs_url, out, cmd))
+                glogger.info("table {} is being dumped by others".format(
+                    table))
+        if gs_loader and time.time() - loaded >= window:
+            gs_loader.load(dump_manifest.files(manifest.UPLOADED))
+            loaded = time.time()
+        if not busy and not stopping:
+            time.sleep(interval)
 
 
-def _run_cmd_retry(cmd, tries=1):
-    for t in range(tries):
-        ret, out = commands.getstatusoutput(cmd)
-        if ret == 0 or t == tries - 1:
-            break
-        else:
-            time.sleep(1)
-    return ret >> 8, out
-
-
-def async_upload2gstorage(gs_url):
-    csvs = []
-    while 1:
-        while not rqueue.empty():
-            csvs.append(rqueue.get_nowait())
-        if not csvs:
-            time.sleep(0.1)
-            continue
-        if csvs[-1] is None:
-            del csvs[-1]
-            break
-        upload_csvs(gs_url, csvs)
-        del csvs[:]
-    if len(csvs) > 0:
-        upload_csvs(gs_url, csvs)
-    bqueue.put(None)
-
-
-def async_load2bigquery():
-    while 1:
-        csv_dir = bqueue.get()
-        if csv_dir:
-            load2bq(csv_dir)
-        else:
-            break
+def _timestamp(value):
+    '''
+    a unix timestamp, or seconds before now if it is negative
+    '''
+    ts = float(value)
+    return time.time() + ts if ts < 0 else ts
+
+
+def _exported(csv_file, rows):
+    glogger.info("{} export Done. rows:{}".format(csv_file, rows))
 
 
+def dump_changes(cache, output, gs_url, dump_tables, since, until):
+    '''
+    drain the rows changed before the watermark until by the change index,
+    or export the rows changed between since and until without removing
+    them if since is not None. the exported rows are still cached, so their
+    files are written into dump_dir/changes and kept out of the manifest,
+    uploading and loading, which would load the rows twice
+    '''
+    if since is not None:
+        export = (os.path.join(output[0], "changes"),) + output[1:]
+        for table in dump_tables or cache.tables():
+            _stream(export, _exported, table,
+                    cache.iter_changes(table, since, until))
+        return
+    callback = partial(stream2csv, output, gs_url)
+    for table in dump_tables or cache.tables():
+        if not cache.drain_until(table, until, callback):
+            glogger.info("table {} is being dumped by others".format(table))
+
+
+def create_logger(log_dir, verbose):
+    log_level = "INFO"
+    if verbose:
+        log_file = None
+        log_level = "DEBUG"
+    elif log_dir:
+        log_file = os.path.join(log_dir, "dump.log")
+    else:
+        log_file = "dump.log"
+
+    return mwlogger.MwLogger("dump", log_file, log_level=log_level)
+
 
 def main():
 
@@ -329,45 +381,142 @@ def main():
         cache_url = cfg['cache_url']
         server_id = cfg['server_id']
         max_rows = cfg['max_rows']
+        max_bytes = cfg.get('max_bytes', 0)
+        compression = cfg.get('compression', None)
+        file_format = cfg.get('format', 'csv')
+        system = cfg.get('system', None)
+        schema_dir = cfg.get('schema_dir', 'bq_schema')
+        jobs = cfg.get('jobs', 1)
+        shard_rows = cfg.get('shard_rows', 1000000)
+        fetch_batch = cfg.get('fetch_batch', 1000)
+        row_format = cfg.get('row_format', 'hash')
+        cluster = cfg.get('cache_cluster', False)
+        change_index = cfg.get('cache_change_index', False)
         log_dir = cfg.get('log_dir', None)
         dump_dir = cfg['dump_dir']
         gs_url = cfg.get('gs_url', None)
+        upload_workers = cfg.get('upload_workers', 4)
+        load_workers = cfg.get('load_workers', 4)
+        window = cfg.get('window', 60)
+        follow_rows = cfg.get('follow_rows', 100000)
     else:
         cache_url = options['--cache_url']
         server_id = options['--server_id']
         max_rows = options['--max_rows']
+        max_bytes = options['--max_bytes']
+        compression = options['--compression']
+        file_format = options['--format']
+        system = options['--system']
+        schema_dir = options['--schema_dir']
+        shard_rows = options['--shard_rows']
+        fetch_batch = options['--fetch_batch']
+        row_format = options['--row_format']
+        cluster = options['--cluster']
+        change_index = options['--change_index']
         log_dir = options['--log_dir']
         dump_dir = options['--dump_dir']
         gs_url = options['--gs_url']
+        upload_workers = options['--upload_workers']
+        load_workers = options['--load_workers']
+        window = options['--window']
+        follow_rows = options['--follow_rows']
 
 
     dump_tables = options['<table>']
-
-    cache = rcache.Rcache(cache_url, server_id)
+    if not config_file or options['--jobs'] != '1':
+        jobs = options['--jobs']
+    jobs = int(jobs)
+    upload_workers = int(upload_workers)
+    load_workers = int(load_workers)
+
+    compression = csvwriter.check_compression(compression)
+    if file_format not in ("csv", "parquet"):
+        exit("unknown format: {}".format(file_format))
+    if gs_url and compression == "zstd" and file_format == "csv":
+        exit("uploaded files are loaded into bigquery, which can not load "
+             "zstd csv files, use gzip or none")
+    if not system and gs_url:
+        system = os.path.basename(gs_url.rstrip("/"))
+    schema_root = schema_dir
+    schema_dir = os.path.join(schema_dir, system or "", str(server_id))
+    output = (dump_dir, int(max_rows), int(max_bytes), compression,
+              file_format, schema_dir)
+    if (options['--until'] or options['--since']) and not change_index:
+        exit("--until and --since need the change index, "
+             "set cache_change_index or --change_index")
+    cache = rcache.create(cache_url, server_id, row_format, fetch_batch,
+                          cluster, change_index)
     global glogger
     glogger = create_logger(log_dir, verbose)
-
+    # rows cached before upgrading are dumped from the legacy generation
+    moved = cache.migrate_legacy()
+    if moved:
+        glogger.info("migrate {} legacy cached rows".format(moved))
+
+    pool = None
+    if jobs > 1 and not (options['--follow'] or options['--until'] or
+                         options['--since']):
+        cache_urls = (cache_url.split(",") if isinstance(cache_url, basestring)
+                      else cache_url)
+        pool = create_pool(jobs, (cache_urls, server_id, row_format,
+                                  fetch_batch, cluster))
+
+    global gs_uploader, dump_manifest
+    dump_manifest = manifest.Manifest(dump_dir)
+    # claims of crashed runs, live runs sharing dump_dir keep theirs
+    released = dump_manifest.reclaim()
+    if released:
+        glogger.info("release {} files claimed by crashed runs".format(
+            released))
+    gs_loader = None
     if gs_url:
         gs_url = os.path.join(gs_url, str(server_id))
-        upload_thr = threading.Thread(target=async_upload2gstorage, args=(gs_url,))
-        upload_thr.setDaemon(True)
-        upload_thr.start()
-        glogger.info("upload csv files to {} thread running...".format(gs_url))
-        load_thr = threading.Thread(target=async_load2bigquery)
-        load_thr.setDaemon(True)
-        load_thr.start()
-        glogger.info("load to bigquery threading running....")
+        gs_uploader = uploader.Uploader(
+            uploader.create_sink(gs_url), dump_manifest, upload_workers,
+            logger=glogger)
+        gs_loader = loader.Loader(loader.create_backend(gs_url),
+                                  dump_manifest, load_workers, schema_root,
+                                  glogger)
+        glogger.info("upload csv files to {} by {} threads running...".format(
+            gs_url, upload_workers))
+        # files written but not uploaded by the last runs, the ones
+        # claimed by a live run are skipped by the uploader
+        for csv_file, _ in dump_manifest.files(manifest.WRITTEN):
+            if os.path.exists(csv_file):
+                _dispatch(gs_url, csv_file)
 
     glogger.info("start dump from cache to csv files")
 
-    callback = partial(save2csv, dump_dir, gs_url=gs_url)
-    cache.dump_t(callback, max_rows, dump_tables)
+    if options['--follow']:
+        if config_file and options['--window'] != '60':
+            window = options['--window']
+        if config_file and options['--follow_rows'] != '100000':
+            follow_rows = options['--follow_rows']
+        glogger.info("follow tables, window:{}s, rows:{}".format(
+            window, follow_rows))
+        follow(cache, output, gs_url, dump_tables, float(window),
+               int(follow_rows), gs_loader)
+    elif options['--until'] or options['--since']:
+        since = options['--since'] and _timestamp(options['--since'])
+        until = options['--until'] and _timestamp(options['--until'])
+        glogger.info("dump changes since:{}, until:{}".format(since, until))
+        dump_changes(cache, output, gs_url, dump_tables, since, until)
+    elif pool is not None:
+        dump_parallel(cache, pool, jobs, int(shard_rows), dump_tables, output,
+                      gs_url)
+    else:
+        callback = partial(stream2csv, output, gs_url)
+        cache.dump_stream(callback, dump_tables)
     glogger.info("dump complete!")
     if gs_url:
-        glogger.info("wait uploading to gstorage and loading to bigquery threads completed......")
-        rqueue.put(None)
-        upload_thr.join()
-        load_thr.join()
+        glogger.info("wait uploading to gstorage threads completed......")
+        gs_uploader.close()
+        glogger.info("upload complete! uploaded:{}, failed:{}".format(
+            gs_uploader.uploaded, gs_uploader.failed))
+        glogger.info("start load gstorage files to bigquery......")
+        loaded, failed = gs_loader.load(dump_manifest.files(manifest.UPLOADED))
+        glogger.info("load complete! tables loaded:{}, failed:{}".format(
+            loaded, failed))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import time
+import threading
+import subprocess
+
+
+class DumpRunner(object):
+    '''
+    run the dump command as a supervised child process,
+    the binlog reading goes on while dumping.
+    a trigger is ignored if the last dump is still running.
+
+    usage:
+      runner = DumpRunner("python dump2csv.py -c dump.conf",
+                          size=lambda: cache.size,
+                          on_done=lambda status: cache.refresh_size())
+      runner.trigger("cache size too large")
+      runner.observe_lag(latency)  # binlog latency of every event
+
+    stats of the last dump: last_status, last_duration, last_rows,
+    last_max_lag; triggered and ignored count the triggers
+    '''
+
+    def __init__(self, command, size=None, on_done=None, logger=None):
+        '''
+        size(): return count of cached rows, for rows drained by dumping
+        on_done(status): called by the supervisor thread after dumping
+        '''
+        self._command = command
+        self._size = size
+        self._on_done = on_done
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._proc = None
+        self._started = None
+        self._rows_before = 0
+        self.triggered = 0
+        self.ignored = 0
+        self.max_lag = 0
+        self.last_status = None
+        self.last_duration = 0
+        self.last_rows = 0
+        self.last_max_lag = 0
+
+    @property
+    def running(self):
+        return self._proc is not None
+
+    @property
+    def duration(self):
+        '''
+        seconds of the running dump, 0 if not running
+        '''
+        started = self._started
+        return time.time() - started if started else 0
+
+    def observe_lag(self, lag):
+        if self._proc is not None and lag > self.max_lag:
+            self.max_lag = lag
+
+    def trigger(self, reason):
+        '''
+        start dumping in background
+        return False if the last dump is still running
+        '''
+        with self._lock:
+            if self._proc is not None:
+                self.ignored += 1
+                return False
+            self.triggered += 1
+            self.max_lag = 0
+            self._rows_before = self._size() if self._size else 0
+            self._started = time.time()
+            self._proc = subprocess.Popen(self._command, shell=True,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.STDOUT)
+        if self._logger:
+            self._logger.info("{}, dumping started. pid:{}".format(
+                reason, self._proc.pid))
+        supervisor = threading.Thread(target=self._wait, args=(self._proc,))
+        supervisor.setDaemon(True)
+        supervisor.start()
+        return True
+
+    def _wait(self, proc):
+        output, _ = proc.communicate()
+        status = proc.returncode
+        try:
+            if self._on_done:
+                self._on_done(status)
+        finally:
+            with self._lock:
+                self.last_status = status
+                self.last_duration = time.time() - self._started
+                self.last_max_lag = self.max_lag
+                if self._size:
+                    self.last_rows = max(self._rows_before - self._size(), 0)
+                self._started = None
+                self._proc = None
+        if not self._logger:
+            return
+        if status != 0:
+            # alarm
+            self._logger.error("dump failed: {}".format(output))
+        else:
+            self._logger.info(
+                "dump OK! duration:{:.1f}s, rows:{}, max lag:{}s".format(
+                    self.last_duration, self.last_rows, self.last_max_lag))
+
+    def wait(self, timeout=None, interval=0.5):
+        '''
+        wait for the running dump over, return True if it is over
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        while self._proc is not None:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(interval)
+        return True
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+record the changed rows of binlog events into a local file,
+and read them back for replaying without mysql.
+
+file layout: MAGIC, then frames of
+  length(4 bytes) crc32(4 bytes) msgpack record
+records:
+  ["r", table, primary_key, action, timestamp, columns, [values, ...]]
+  ["p", log_file, log_pos]  # binlog position after a transaction
+a truncated frame at the end, left by a crash, is ignored when reading
+'''
+
+import os
+import struct
+import zlib
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+import rcache
+
+MAGIC = "CDCLOG\x00\x01"
+_HEADER = struct.Struct(">II")
+
+
+class EventLogWriter(object):
+    '''
+    usage:
+      writer = EventLogWriter("/data/capture.log")
+      writer.rows(table, primary_key, vals_lst)  # rows of _get_row_values
+      writer.position(log_file, log_pos)
+      writer.close()
+    '''
+
+    def __init__(self, path):
+        if msgpack is None:
+            raise ImportError("event log requires msgpack")
+        empty = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._fp = open(path, "ab")
+        if empty:
+            self._fp.write(MAGIC)
+
+    def _write(self, record):
+        data = msgpack.packb(record, use_bin_type=False)
+        self._fp.write(_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff))
+        self._fp.write(data)
+
+    def rows(self, table, primary_key, rows):
+        '''
+        rows of one event share the action, timestamp and columns
+        '''
+        if not rows:
+            return
+        columns = sorted(col for col in rows[0]
+                         if col not in ("cdc_action", "cdc_ts"))
+        self._write(["r", table, primary_key, rows[0]["cdc_action"],
+                     rows[0]["cdc_ts"],
+                     columns,
+                     [[rcache.PackedRcache._pack_value(row.get(col))
+                       for col in columns] for row in rows]])
+
+    def position(self, log_file, log_pos):
+        self._write(["p", log_file, log_pos])
+
+    def flush(self):
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+
+def read_events(path):
+    '''
+    yield ("rows", (table, primary_key, rows)) or
+          ("position", (log_file, log_pos))
+    rows are like the ones of cdc._get_row_values
+    '''
+    with open(path, "rb") as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not an event log".format(path))
+        while 1:
+            header = fp.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            length, crc = _HEADER.unpack(header)
+            data = fp.read(length)
+            if len(data) < length:
+                return
+            if zlib.crc32(data) & 0xffffffff != crc:
+                raise ValueError("{} is corrupted at {}".format(
+                    path, fp.tell() - length))
+            record = msgpack.unpackb(data, raw=True, use_list=True)
+            if record[0] == "p":
+                yield "position", (record[1], record[2])
+                continue
+            _, table, primary_key, action, ts, columns, values_lst = record
+            if isinstance(primary_key, list):
+                primary_key = tuple(primary_key)
+            rows = []
+            for values in values_lst:
+                row = dict(zip(columns, values))
+                row["cdc_action"] = action
+                row["cdc_ts"] = ts
+                rows.append(row)
+            yield "rows", (table, primary_key, rows)
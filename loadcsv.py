@@ -4,7 +4,7 @@
 
 '''
 Usage:
-  loadcsv.py <csv_file> <primary_key> [<primary_key>...] -s SID -u REDIS_URL [-l DIR] [-v]
+  loadcsv.py <csv_file> <primary_key> [<primary_key>...] -s SID -u REDIS_URL [-r FORMAT] [--cluster] [--change_index] [-l DIR] [-v]
   loadcsv.py  <csv_file> <primary_key> [<primary_key>...] -c CONFIG_FILE [-v]
   loadcsv.py (-h | --help | --version)
 
@@ -19,7 +19,13 @@ Options:
   -v --verbose                  Print the running status message
   -s --server_id=SID            Specify mysql server id
   -u --cache_url=REDIS_URL      Specify the redis cache url like:
-                                "redis://host:port/db"
+                                "redis://host:port/db", separate urls of
+                                the sharded cache by ","
+  --cluster                     The cache url is a node of redis cluster
+  --change_index                Index the saved rows by cdc_ts like the
+                                cache_change_index of cdc_config.py
+  -r --row_format=FORMAT        Specify the row format of cache: hash or packed
+                                [default: hash]
   -l --log_dir=DIR              Specify the dir of logging
 '''
 
@@ -32,6 +38,7 @@ from collections import defaultdict
 import json
 
 import rcache
+import csvwriter
 import mwlogger
 from datetime import datetime
 
@@ -52,12 +59,19 @@ def main():
         cache_url = cfg['cache_url']
         server_id = cfg['server_id']
         log_dir = cfg.get('log_dir', None)
+        row_format = cfg.get('row_format', 'hash')
+        cluster = cfg.get('cache_cluster', False)
+        change_index = cfg.get('cache_change_index', False)
     else:
         cache_url = options['--cache_url']
         server_id = options['--server_id']
         log_dir = options['--log_dir']
+        row_format = options['--row_format']
+        cluster = options['--cluster']
+        change_index = options['--change_index']
 
-    cache = rcache.Rcache(cache_url, server_id)
+    cache = rcache.create(cache_url, server_id, row_format, cluster=cluster,
+                          change_index=change_index)
     logger = create_logger(log_dir, verbose)
 
     logger.info("start load {} to redis".format(csv_file))
@@ -82,14 +96,15 @@ def create_logger(log_dir, verbose):
 
 def _get_table_name(csv_file):
     '''
-    support csv_file like "db.table.csv" and "db.table.timestamp.csv"
+    support csv_file like "db.table.csv" and "db.table.timestamp.csv",
+    compressed ones like "db.table.timestamp.csv.gz" too
     :param csv_file:
     :return: db.table
     '''
     return ".".join(os.path.basename(csv_file).split(".")[:2])
 
 def readcsv(csv_file):
-    with open(csv_file) as fp:
+    with csvwriter.open_dumped(csv_file) as fp:
         for row in csv.DictReader(fp):
             yield row
 
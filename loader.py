@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+load uploaded files into the warehouse, one load job of at most MAX_URIS
+files per table, jobs run in parallel. a file of an altered table
+("db.table.ts.tmp") is loaded by its own job
+
+uploaded files are like "<url>/<system>/<sid>/<yyyymmdd>/db.table.ts.csv",
+the dataset is the database, loaded ones are recorded in the manifest
+of the dump dir(manifest.Manifest) and never loaded again. files of a job
+are claimed in the manifest first, the ones claimed by other processes
+sharing the dump dir are left out
+'''
+
+import os
+import json
+import time
+import pipes
+import commands
+import threading
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+import csvwriter
+
+# source uris of a bigquery load job are limited to 10000
+MAX_URIS = 10000
+
+
+def _run_cmd_retry(cmd, tries=1):
+    for t in range(tries):
+        ret, out = commands.getstatusoutput(cmd)
+        if ret == 0 or t == tries - 1:
+            break
+        else:
+            time.sleep(1)
+    return ret >> 8, out
+
+
+class BqBackend(object):
+    '''
+    bigquery by the bq command line tool
+    '''
+
+    def ensure_dataset(self, dataset):
+        ret, out = _run_cmd_retry("bq mk {}".format(dataset), 3)
+        if not (ret == 0 or ret == 1 and "already exists" in out):
+            raise IOError("Dataset[{}] may not exists and create it failed, "
+                          "out:{}".format(dataset, out))
+
+    def load(self, dataset, table, uris, source_format, schema=None):
+        if source_format == "parquet":
+            # typed columns, no schema and csv parsing needed
+            cmd = "bq load --source_format=PARQUET"
+        elif schema:
+            cmd = "bq load --schema={} --skip_leading_rows=1 " \
+                  "--allow_quoted_newlines".format(pipes.quote(schema))
+        else:
+            cmd = "bq load --skip_leading_rows=1 --allow_quoted_newlines"
+        cmd = "{} {}.{} {}".format(cmd, dataset, table, ",".join(uris))
+        ret, out = commands.getstatusoutput(cmd)
+        if ret != 0:
+            raise IOError("{} failed, return code:{}, out:{}".format(
+                cmd, ret >> 8, out))
+
+
+class LocalBackend(object):
+    '''
+    a warehouse stand-in for testing without network, every load job is
+    a json line in root/dataset/table.jobs
+    '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def ensure_dataset(self, dataset):
+        path = os.path.join(self.root, dataset)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+    def load(self, dataset, table, uris, source_format, schema=None):
+        with open(os.path.join(self.root, dataset, table + ".jobs"), "a") as fp:
+            fp.write(json.dumps({"uris": uris, "format": source_format,
+                                 "schema": schema,
+                                 "time": int(time.time())}) + "\n")
+
+
+def create_backend(url):
+    '''
+    url: the upload url, bigquery for "gs://...", else a local
+    warehouse in url/warehouse
+    '''
+    if url.startswith("gs://"):
+        return BqBackend()
+    if url.startswith("file://"):
+        url = url[len("file://"):]
+    return LocalBackend(os.path.join(url, "warehouse"))
+
+
+def parse_uri(uri):
+    '''
+    return (system, sid, db, table, source format),
+    source format is None if the file can not be loaded
+    '''
+    parts = uri.rstrip("/").split("/")
+    name = parts[-1]
+    db, table = name.split(".")[:2]
+    if name.endswith(".parquet"):
+        source_format = "parquet"
+    elif name.endswith(csvwriter.SUFFIXES["zstd"]):
+        source_format = None
+    else:
+        source_format = "csv"
+    return parts[-4], parts[-3], db, table, source_format
+
+
+def altered(uri):
+    '''
+    the file is written with the other columns of an altered table
+    '''
+    return "tmp" in uri.rstrip("/").split("/")[-1].split(".")[2:]
+
+
+class Loader(object):
+    '''
+    usage:
+      loader = Loader(create_backend(url), manifest, 4, "bq_schema", logger)
+      loaded, failed = loader.load(manifest.files(manifest.UPLOADED))
+    '''
+
+    def __init__(self, backend, manifest, workers=4, schema_dir="bq_schema",
+                 logger=None, tries=3, retry_delay=1):
+        self._backend = backend
+        self._manifest = manifest
+        self._workers = workers
+        self._schema_dir = schema_dir
+        self._logger = logger
+        self._tries = tries
+        self._retry_delay = retry_delay
+        self._lock = threading.Lock()
+        # datasets known to exist in this run
+        self._datasets = set()
+        # uris of files which can not be loaded
+        self._unloadable = set()
+
+    def _ensure_dataset(self, dataset):
+        with self._lock:
+            if dataset in self._datasets:
+                return
+        self._backend.ensure_dataset(dataset)
+        with self._lock:
+            self._datasets.add(dataset)
+
+    def jobs(self, files):
+        '''
+        files: [(path, uri), ...] uploaded
+        return [((system, sid, db, table, source format), [(path, uri)]), ...]
+        the columns of altered files differ from the others and each other,
+        so every one of them is a job
+        '''
+        tables = defaultdict(list)
+        jobs = []
+        for path, uri in files:
+            key = parse_uri(uri)
+            if key[-1] is None:
+                # dump2csv refuses zstd csv files with loading, these are
+                # left by older runs and warned once
+                if self._logger and uri not in self._unloadable:
+                    self._logger.warn("bigquery can not load zstd file: "
+                                      "{}. Ignore it".format(uri))
+                self._unloadable.add(uri)
+                continue
+            if altered(uri):
+                jobs.append((key, [(path, uri)]))
+            else:
+                tables[key].append((path, uri))
+        for key, table_files in tables.iteritems():
+            for start in xrange(0, len(table_files), MAX_URIS):
+                jobs.append((key, table_files[start:start + MAX_URIS]))
+        return jobs
+
+    def _load(self, job):
+        '''
+        return None if all files are claimed by others
+        '''
+        (system, sid, db, table, source_format), files = job
+        claimed = set(self._manifest.claim_load([path for path, _ in files]))
+        if not claimed:
+            return None
+        files = [(path, uri) for path, uri in files if path in claimed]
+        uris = [uri for _, uri in files]
+        # Not support the same database name from different systems
+        dataset = db
+        schema = None
+        if source_format == "csv":
+            schema = os.path.join(self._schema_dir, system, sid, db, table)
+            if not os.path.exists(schema):
+                if self._logger:
+                    self._logger.warn("Not found schema: {}. Ignore it".format(
+                        schema))
+                schema = None
+        for tries in range(self._tries):
+            try:
+                self._ensure_dataset(dataset)
+                self._backend.load(dataset, table, uris, source_format, schema)
+                break
+            except Exception:
+                if self._logger:
+                    # should check and load failed files manually
+                    self._logger.error("load {} files to {}.{} failed, tries:{}"
+                                       .format(len(uris), dataset, table,
+                                               tries + 1), exc_info=True)
+                if tries == self._tries - 1:
+                    self._manifest.release_load([path for path, _ in files])
+                    return False
+                time.sleep(self._retry_delay * 2 ** tries)
+        self._manifest.loaded([path for path, _ in files])
+        if self._logger:
+            self._logger.info("load {} files to {}.{} successfully".format(
+                len(uris), dataset, table))
+        return True
+
+    def load(self, files):
+        '''
+        files: [(path, uri), ...] uploaded
+        return (count of loaded jobs, count of failed jobs)
+        '''
+        jobs = self.jobs(files)
+        if not jobs:
+            return 0, 0
+        pool = ThreadPool(min(self._workers, len(jobs)))
+        try:
+            results = pool.map(self._load, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        return results.count(True), results.count(False)
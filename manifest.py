@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+states of the dumped files of a dump_dir in dump_dir/manifest.db(sqlite)
+
+a file is "written" when it is complete, "uploaded" with its destination,
+and "loaded" after it is loaded into the warehouse. files are looked up
+by path or state through indexes, so resuming never scans logs.
+
+dump2csv processes of a dump_dir(following and batch ones) share the
+manifest, a file is claimed "uploading" or "loading" by an atomic state
+transition before it is handled, so it is handled by one of them.
+a claim records its owner(host:pid), and its time is refreshed by a
+heartbeat of the owner while it is handled. a claim is reclaimed if its
+owner on this host is dead, or its heartbeat stops for CLAIM_TIMEOUT
+seconds, like the owner on another host crashed.
+'''
+
+import os
+import time
+import errno
+import socket
+import sqlite3
+import hashlib
+import threading
+
+WRITTEN = "written"
+UPLOADING = "uploading"
+UPLOADED = "uploaded"
+LOADING = "loading"
+LOADED = "loaded"
+
+CLAIM_TIMEOUT = 3600
+# seconds between heartbeats of the claims of a process
+HEARTBEAT = CLAIM_TIMEOUT / 6
+
+FILENAME = "manifest.db"
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        tbl TEXT NOT NULL,
+        state TEXT NOT NULL,
+        rows INTEGER,
+        bytes INTEGER,
+        md5 TEXT,
+        destination TEXT,
+        written_at INTEGER,
+        uploaded_at INTEGER,
+        loaded_at INTEGER,
+        claimed_at INTEGER,
+        owner TEXT
+    );
+    CREATE INDEX IF NOT EXISTS files_state ON files (state);
+"""
+
+
+def _owner():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def _dead(owner):
+    '''
+    only the owners on this host are known dead
+    '''
+    if not owner:
+        return False
+    host, pid = owner.rsplit(":", 1)
+    if host != socket.gethostname() or int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except OSError as err:
+        return err.errno == errno.ESRCH
+    return False
+
+
+def file_md5(path, block=1 << 20):
+    md5 = hashlib.md5()
+    with open(path, "rb") as fp:
+        while 1:
+            data = fp.read(block)
+            if not data:
+                return md5.hexdigest()
+            md5.update(data)
+
+
+class Manifest(object):
+    '''
+    usage:
+      manifest = Manifest(dump_dir)
+      manifest.written(path, rows, bytes, md5)
+      if manifest.claim_upload(path):
+          manifest.uploaded(path, destination)  # or release_upload(path)
+      for path in manifest.claim_load([path, ...]):
+          manifest.loaded([path, ...])  # or release_load([path, ...])
+      manifest.files(manifest.UPLOADED)  # [(path, destination), ...]
+    '''
+
+    def __init__(self, dump_dir):
+        if not os.path.exists(dump_dir):
+            os.makedirs(dump_dir)
+        self._lock = threading.Lock()
+        # shared by uploading and loading threads, serialized by _lock
+        self._conn = sqlite3.connect(os.path.join(dump_dir, FILENAME),
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.text_factory = str
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        columns = [row[1] for row in
+                   self._conn.execute("PRAGMA table_info(files)")]
+        # manifests of the versions before claiming
+        for column, column_type in (("claimed_at", "INTEGER"),
+                                    ("owner", "TEXT")):
+            if column not in columns:
+                self._conn.execute("ALTER TABLE files ADD COLUMN {} {}"
+                                   .format(column, column_type))
+        self._owner = _owner()
+        self._heartbeat = None
+
+    def written(self, path, rows, size, md5):
+        table = ".".join(os.path.basename(path).split(".")[:2])
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (path, tbl, state, rows, bytes, "
+                "md5, written_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, table, WRITTEN, rows, size, md5, int(time.time())))
+
+    def _transit(self, paths, old, new):
+        '''
+        move files from state old to new, return the moved paths
+        '''
+        now = int(time.time())
+        moved = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for path in paths:
+                    cur = self._conn.execute(
+                        "UPDATE files SET state = ?, claimed_at = ?, "
+                        "owner = ? WHERE path = ? AND state = ?",
+                        (new, now, self._owner, path, old))
+                    if cur.rowcount == 1:
+                        moved.append(path)
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            if moved and new in (UPLOADING, LOADING) and not self._heartbeat:
+                self._beat(HEARTBEAT)
+        return moved
+
+    def _beat(self, interval):
+        self._heartbeat = threading.Timer(interval, self.heartbeat,
+                                          (interval,))
+        self._heartbeat.setDaemon(True)
+        self._heartbeat.start()
+
+    def heartbeat(self, interval=None):
+        '''
+        refresh the claims of this process, again after interval seconds
+        if it is given
+        '''
+        with self._lock:
+            self._conn.execute(
+                "UPDATE files SET claimed_at = ? WHERE owner = ? AND "
+                "state IN (?, ?)",
+                (int(time.time()), self._owner, UPLOADING, LOADING))
+            if interval and self._heartbeat:
+                self._beat(interval)
+
+    def claim_upload(self, path):
+        '''
+        return False if the file is not written or claimed by others
+        '''
+        return bool(self._transit([path], WRITTEN, UPLOADING))
+
+    def release_upload(self, path):
+        self._transit([path], UPLOADING, WRITTEN)
+
+    def claim_load(self, paths):
+        '''
+        return the paths uploaded and not claimed by others
+        '''
+        return self._transit(paths, UPLOADED, LOADING)
+
+    def release_load(self, paths):
+        self._transit(paths, LOADING, UPLOADED)
+
+    def reclaim(self, timeout=CLAIM_TIMEOUT):
+        '''
+        release the claims of dead owners, and the ones not refreshed for
+        timeout seconds. return count of released files
+        '''
+        before = int(time.time()) - timeout
+        with self._lock:
+            claims = self._conn.execute(
+                "SELECT path, state, owner, claimed_at FROM files "
+                "WHERE state IN (?, ?)", (UPLOADING, LOADING)).fetchall()
+        released = 0
+        for path, state, owner, claimed_at in claims:
+            if (claimed_at or 0) < before or _dead(owner):
+                # unless the claim is refreshed or done meanwhile
+                with self._lock:
+                    released += self._conn.execute(
+                        "UPDATE files SET state = ? WHERE path = ? AND "
+                        "state = ? AND owner IS ? AND claimed_at IS ?",
+                        (WRITTEN if state == UPLOADING else UPLOADED,
+                         path, state, owner, claimed_at)).rowcount
+        return released
+
+    def uploaded(self, path, destination):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE files SET state = ?, destination = ?, uploaded_at = ? "
+                "WHERE path = ?",
+                (UPLOADED, destination, int(time.time()), path))
+
+    def loaded(self, paths):
+        now = int(time.time())
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "UPDATE files SET state = ?, loaded_at = ? WHERE path = ?",
+                    [(LOADED, now, path) for path in paths])
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def get(self, path):
+        '''
+        return {column: value} of the file, None if it is not written
+        '''
+        with self._lock:
+            cur = self._conn.execute("SELECT * FROM files WHERE path = ?",
+                                     (path,))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            return dict(zip([desc[0] for desc in cur.description], row))
+
+    def state(self, path):
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM files WHERE path = ?",
+                                     (path,)).fetchone()
+        return row[0] if row else None
+
+    def destination(self, path):
+        '''
+        None if the file is not uploaded
+        '''
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT destination FROM files WHERE path = ?",
+                (path,)).fetchone()
+        return row[0] if row else None
+
+    def files(self, state):
+        '''
+        return [(path, destination), ...] of the state
+        '''
+        with self._lock:
+            return self._conn.execute(
+                "SELECT path, destination FROM files WHERE state = ? "
+                "ORDER BY path", (state,)).fetchall()
+
+    def close(self):
+        with self._lock:
+            if self._heartbeat:
+                self._heartbeat.cancel()
+                self._heartbeat = None
+        self._conn.close()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+metrics exposed in prometheus text format over http or unix socket
+
+usage:
+  registry = Registry()
+  events = registry.register(Counter("cdc_events_total", "events", ("table",)))
+  events.inc(1, "db.table")
+  serve(registry, "127.0.0.1:9308")  # or "unix:/tmp/cdc-metrics.sock"
+'''
+
+import os
+import time
+import threading
+import SocketServer
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace(
+        '"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value))
+                          for name, value in labels) + "}"
+
+
+class Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        self._function = None
+
+    def set_function(self, function):
+        '''
+        function() returns {labelvalues: value} when scraped
+        '''
+        self._function = function
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _items(self):
+        if self._function:
+            return sorted(self._function().items())
+        with self._lock:
+            return sorted(self._values.items())
+
+    def samples(self):
+        '''
+        yield (name, [(label, value)...], value)
+        '''
+        for labelvalues, value in self._items():
+            if not isinstance(labelvalues, tuple):
+                labelvalues = (labelvalues,)
+            yield self.name, zip(self.labelnames, labelvalues), value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, value=1, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    default_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self, name, doc, labelnames=(), buckets=None):
+        super(Histogram, self).__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            counts = self._values.get(labelvalues)
+            if counts is None:
+                # [count of every bucket..., count, sum]
+                counts = self._values[labelvalues] = \
+                    [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def timed(self, func, *labelvalues):
+        '''
+        wrap func to observe seconds of every call
+        '''
+        def _timed(*args, **kwargs):
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(time.time() - started, *labelvalues)
+        return _timed
+
+    def samples(self):
+        for labelvalues, counts in self._items():
+            labels = zip(self.labelnames, labelvalues)
+            for bound, count in zip(self.buckets, counts):
+                yield (self.name + "_bucket",
+                       labels + [("le", repr(float(bound)))], count)
+            yield self.name + "_bucket", labels + [("le", "+Inf")], counts[-2]
+            yield self.name + "_count", labels, counts[-2]
+            yield self.name + "_sum", labels, counts[-1]
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.doc))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append("{}{} {}".format(name, _format_labels(labels),
+                                              repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        try:
+            body = self.server.registry.render()
+        except Exception as err:
+            self.send_error(500, str(err))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return str(self.client_address)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _UnixHTTPServer(SocketServer.ThreadingMixIn,
+                      SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        SocketServer.UnixStreamServer.server_bind(self)
+        self.server_name = self.server_address
+        self.server_port = 0
+
+
+class _TCPHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(registry, address):
+    '''
+    serve metrics by a daemon thread
+    address: "host:port" or "unix:/path/of/socket"
+    return the server
+    '''
+    if address.startswith("unix:"):
+        server = _UnixHTTPServer(address[len("unix:"):], _Handler)
+    else:
+        host, port = address.rsplit(":", 1)
+        server = _TCPHTTPServer((host, int(port)), _Handler)
+    server.registry = registry
+    thr = threading.Thread(target=server.serve_forever)
+    thr.setDaemon(True)
+    thr.start()
+    return server
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import zlib
+import threading
+from Queue import Queue, Empty
+
+import rcache
+import wbuffer
+
+_STOP = object()
+# a worker gives up the rows left after the last flush failed so many
+# times, so stop() never hangs
+_STOP_TRIES = 3
+
+
+def _raw_values(row):
+    '''
+    values of a row of binlogevent.rows, the ones after an update
+    '''
+    return row["after_values"] if "after_values" in row else row["values"]
+
+
+class PartitionedWriter(object):
+    '''
+    process binlog events by worker threads in parallel.
+    events are dispatched into per-partition queues by table,
+    or by table and rid if by_row is True. the rid is read from the
+    parsed values of the event, rows are decoded by the workers.
+    every partition has its own WriteBuffer, so the changes of a row
+    keep their order.
+
+    the binlog position is saved only after every partition has
+    flushed the rows before it, it is the low watermark of partitions.
+
+    usage:
+      writer = PartitionedWriter(cache, 4, decode, flush=flush)
+      writer.start()
+      writer.add(table, primary_key, binlogevent)
+      writer.checkpoint((log_file, log_pos))  # transaction committed
+      writer.stop()
+    '''
+
+    def __init__(self, cache, partitions, decode, by_row=False,
+                 max_rows=1000, max_delay=0.1, max_transactions=0,
+                 max_queued=10000, flush=None, on_error=None):
+        '''
+        decode(binlogevent, rows): return changed rows of the event,
+        rows is a part of binlogevent.rows or None for all of them
+        flush(wbuf): flush a partition's WriteBuffer, default is wbuf.flush
+        on_error(err): called if a partition failed, its rows are kept
+        '''
+        self._cache = cache
+        self._decode = decode
+        self._by_row = by_row
+        self._flush = flush or (lambda wbuf: wbuf.flush())
+        self._on_error = on_error
+        self._max_delay = max_delay
+        self._queues = [Queue(max_queued) for _ in xrange(partitions)]
+        self._buffers = [wbuffer.WriteBuffer(
+            cache, max_rows, max_delay, max_transactions,
+            on_flush=self._partition_flushed(index), save_position=False)
+            for index in xrange(partitions)]
+        self._workers = []
+        self._lock = threading.Lock()
+        # the sequence of checkpoints and the one saved by every partition
+        self._seq = 0
+        self._positions = {}
+        self._flushed = [0] * partitions
+        self._saved = 0
+
+    def _partition(self, key):
+        return (zlib.crc32(key) & 0xffffffff) % len(self._queues)
+
+    def add(self, table, primary_key, binlogevent):
+        if not self._by_row:
+            self._queues[self._partition(table)].put(
+                (table, primary_key, binlogevent, None))
+            return
+        parts = {}
+        gen_rid = rcache.rid_getter(primary_key)
+        for row in binlogevent.rows:
+            key = "{}#{}".format(table, gen_rid(_raw_values(row)))
+            parts.setdefault(self._partition(key), []).append(row)
+        for index, rows in parts.iteritems():
+            self._queues[index].put((table, primary_key, binlogevent, rows))
+
+    def checkpoint(self, position):
+        '''
+        every partition gets the checkpoint in its queue
+        '''
+        with self._lock:
+            self._seq += 1
+            self._positions[self._seq] = position
+            seq = self._seq
+        for queue in self._queues:
+            queue.put(seq)
+
+    def _partition_flushed(self, index):
+        def _flushed(seq):
+            with self._lock:
+                self._flushed[index] = seq
+                low = min(self._flushed)
+                if low <= self._saved:
+                    return
+                # saved in the lock, the position never goes backward
+                self._cache.save_many([], self._positions[low])
+                for old in xrange(self._saved + 1, low + 1):
+                    self._positions.pop(old, None)
+                self._saved = low
+        return _flushed
+
+    def _work(self, index):
+        queue, wbuf = self._queues[index], self._buffers[index]
+        # tries of the last flush after _STOP
+        stopping = 0
+        while 1:
+            try:
+                item = queue.get(timeout=self._max_delay)
+            except Empty:
+                item = None
+            try:
+                if item is _STOP or stopping:
+                    stopping += 1
+                    self._flush(wbuf)
+                    break
+                elif isinstance(item, tuple):
+                    table, primary_key, binlogevent, rows = item
+                    wbuf.add(table, primary_key,
+                             self._decode(binlogevent, rows))
+                elif item is not None:
+                    wbuf.checkpoint(item)
+                if wbuf.due():
+                    self._flush(wbuf)
+            except Exception as err:
+                if self._on_error:
+                    self._on_error(err)
+                if stopping >= _STOP_TRIES:
+                    break
+
+    def start(self):
+        for index in xrange(len(self._queues)):
+            worker = threading.Thread(target=self._work, args=(index,),
+                                      name="partition-{}".format(index))
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        '''
+        flush all partitions and wait for workers exit
+        '''
+        for queue in self._queues:
+            queue.put(_STOP)
+        for worker in self._workers:
+            worker.join()
@@ -5,6 +5,15 @@ import redis
 import time
 import threading
 import os
+import json
+import zlib
+import bisect
+import operator
+import itertools
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 class SaveIgnore(Exception):
     pass
@@ -12,25 +21,493 @@ class SaveIgnore(Exception):
 class FullError(Exception):
     pass
 
+
+class SaveError(Exception):
+    '''
+    saving failed after the rows of saved_tables were saved by redis
+    cluster, they must not be saved again
+    '''
+    def __init__(self, message, saved_tables):
+        super(SaveError, self).__init__(message)
+        self.saved_tables = saved_tables
+
+
+class PartialFullError(SaveError, FullError):
+    pass
+
+
+# {primary_key: rid getter}
+_rid_getters = {}
+
+
+def rid_getter(primary_key):
+    '''
+    return getter(row) of the rid like Rcache._gen_rid, compiled once
+    per primary key, or None if no primary key.
+    the rid of a single key is its value, values of a composite key
+    are joined by "&"
+    '''
+    if isinstance(primary_key, list):
+        primary_key = tuple(primary_key)
+    getter = _rid_getters.get(primary_key)
+    if getter is None and primary_key is not None:
+        if not isinstance(primary_key, tuple):
+            getter = operator.itemgetter(primary_key)
+        elif len(primary_key) == 1:
+            key_getter = operator.itemgetter(primary_key[0])
+            getter = lambda row: str(key_getter(row))
+        else:
+            keys_getter = operator.itemgetter(*primary_key)
+            getter = lambda row: '&'.join(map(str, keys_getter(row)))
+        _rid_getters[primary_key] = getter
+    return getter
+
+
+# the generation of rows cached by the versions before generations,
+# older than all others, see Rcache.migrate_legacy
+LEGACY_GENERATION = -1
+
+
+# Delete the keys of a drained generation and its count of rows atomically.
+# KEYS[1]: rows counter key of the table
+# KEYS[2...]: keys of the drained generation
+# ARGV[1]: count of rows of the drained generation
+# return count of the table's cached rows
+DROP_SCRIPT = """
+local unpack = unpack or table.unpack
+for i = 2, #KEYS, 5000 do
+    redis.call('DEL', unpack(KEYS, i, math.min(i + 4999, #KEYS)))
+end
+return redis.call('DECRBY', KEYS[1], ARGV[1])
+"""
+
+
+# Apply the _merge_row rules to a batch of rows of tables, and save the
+# binlog position after them, in one round trip by SAVE_SCRIPT.
+# Rows are written into the table's current generation, so a dumping
+# swap never waits for or blocks the writers.
+# The merging of a table:
+# KEYS[1]: generation key of the table
+# KEYS[2]: rows counter key of the table
+# ARGV[1]: row key prefix like "{sid}#{{table}}#"
+# ARGV[2]: row ids key prefix like "{sid}#row_ids#{{table}}#"
+# ARGV[3]: change index key prefix like "{sid}#changes#{{table}}#",
+#          "" if the change index is disabled
+# ARGV[4...]: rid, field count, "cdc_action", action, field, value, ...
+# return {count of saved rows, count of the table's cached rows}
+MERGE_TABLE = """
+local unpack = unpack or table.unpack
+local gen = redis.call('GET', KEYS[1]) or '0'
+local prefix, row_ids_key = ARGV[1] .. gen .. '.', ARGV[2] .. gen
+local changes_key = ARGV[3] ~= '' and ARGV[3] .. gen or nil
+local i, saved, added = 4, 0, 0
+while i <= #ARGV do
+    local rid = ARGV[i]
+    local last = i + 1 + tonumber(ARGV[i + 1]) * 2
+    local key = prefix .. rid
+    local new_act = ARGV[i + 3]
+    local old_act = redis.call('HGET', key, 'cdc_action')
+    if old_act and new_act == 'delete' and old_act == 'insert' then
+        redis.call('DEL', key)
+        redis.call('SREM', row_ids_key, rid)
+        if changes_key then
+            redis.call('ZREM', changes_key, rid)
+        end
+        added = added - 1
+    else
+        if not old_act then
+            added = added + 1
+        else
+            if new_act == 'update' and old_act == 'insert' then
+                new_act = 'insert'
+            elseif new_act == 'insert' and (old_act == 'delete' or
+                    old_act == 'update') then
+                new_act = 'update'
+            end
+        end
+        local fields = {}
+        for j = i + 2, last do
+            fields[#fields + 1] = ARGV[j]
+        end
+        fields[2] = new_act
+        redis.call('HMSET', key, unpack(fields))
+        redis.call('SADD', row_ids_key, rid)
+        if changes_key then
+            for j = 1, #fields, 2 do
+                if fields[j] == 'cdc_ts' then
+                    redis.call('ZADD', changes_key, fields[j + 1], rid)
+                    break
+                end
+            end
+        end
+    end
+    saved = saved + 1
+    i = last + 1
+end
+return {saved, redis.call('INCRBY', KEYS[2], added)}
+"""
+
+
+# Merge tables by a merging script of one table like MERGE_TABLE, and
+# save the binlog position at last. redis refuses the first write of a
+# script by OOM, so all of them are saved or nothing is saved.
+# KEYS[2n - 1], KEYS[2n]: KEYS of the merging of the nth table
+# KEYS[2 * tables + 1]: binlog position key, if the position is saved
+# ARGV[1]: count of tables
+# ARGV[...]: count of ARGV of the merging of a table, the ARGV, ... of
+#            every table
+# ARGV[-2], ARGV[-1]: log_file, log_pos, if the position is saved
+# return {count of saved rows, count of the table's cached rows, ...}
+SAVE_SCRIPT = """
+local function merge(KEYS, ARGV)
+%s
+end
+local results = {}
+local i = 2
+for t = 1, tonumber(ARGV[1]) do
+    local count = tonumber(ARGV[i])
+    local args = {}
+    for j = i + 1, i + count do
+        args[#args + 1] = ARGV[j]
+    end
+    local result = merge({KEYS[t * 2 - 1], KEYS[t * 2]}, args)
+    results[#results + 1] = result[1]
+    results[#results + 1] = result[2]
+    i = i + count + 1
+end
+if i < #ARGV then
+    redis.call('HMSET', KEYS[#KEYS], 'log_file', ARGV[i],
+               'log_pos', ARGV[i + 1])
+end
+return results
+"""
+
+MERGE_SCRIPT = SAVE_SCRIPT % MERGE_TABLE
+
+
+# The packed row format of PackedRcache, merged like MERGE_TABLE and
+# saved by SAVE_SCRIPT too.
+# A row is stored in the hash "{sid}#packed#{{table}}#{gen}" as
+# action code("i"/"u"/"d") + msgpack([columns_id, cdc_ts, value1, ...])
+# KEYS[1]: generation key of the table
+# KEYS[2]: rows counter key of the table
+# ARGV[1]: packed rows key prefix like "{sid}#packed#{{table}}#"
+# ARGV[2]: change index key prefix like MERGE_TABLE
+# ARGV[3...]: rid, cdc_ts, packed row, ...
+# return {count of saved rows, count of the table's cached rows}
+PACKED_MERGE_TABLE = """
+local gen = redis.call('GET', KEYS[1]) or '0'
+local rows_key = ARGV[1] .. gen
+local changes_key = ARGV[2] ~= '' and ARGV[2] .. gen or nil
+local saved, added = 0, 0
+for i = 3, #ARGV, 3 do
+    local rid, value = ARGV[i], ARGV[i + 2]
+    local new_act = string.sub(value, 1, 1)
+    local old = redis.call('HGET', rows_key, rid)
+    if not old then
+        added = added + 1
+    else
+        local old_act = string.sub(old, 1, 1)
+        if new_act == 'd' and old_act == 'i' then
+            value = nil
+        elseif new_act == 'u' and old_act == 'i' then
+            value = 'i' .. string.sub(value, 2)
+        elseif new_act == 'i' and (old_act == 'd' or old_act == 'u') then
+            value = 'u' .. string.sub(value, 2)
+        end
+    end
+    if value then
+        redis.call('HSET', rows_key, rid, value)
+        if changes_key then
+            redis.call('ZADD', changes_key, ARGV[i + 1], rid)
+        end
+    else
+        redis.call('HDEL', rows_key, rid)
+        if changes_key then
+            redis.call('ZREM', changes_key, rid)
+        end
+        added = added - 1
+    end
+    saved = saved + 1
+end
+return {saved, redis.call('INCRBY', KEYS[2], added)}
+"""
+
+PACKED_MERGE_SCRIPT = SAVE_SCRIPT % PACKED_MERGE_TABLE
+
+
+# Remove the dumped rows of a frozen generation by the change index.
+# KEYS[1]: change index key of the generation
+# KEYS[2]: row ids key of the generation(packed rows key of PackedRcache)
+# KEYS[3]: rows counter key of the table
+# ARGV[1]: row key prefix of the generation like "{sid}#{{table}}#{gen}.",
+#          "" for the packed row format
+# ARGV[2...]: rids
+# return count of the table's cached rows
+REMOVE_CHANGES_SCRIPT = """
+local removed = 0
+for i = 2, #ARGV do
+    local rid = ARGV[i]
+    if redis.call('ZREM', KEYS[1], rid) == 1 then
+        if ARGV[1] ~= '' then
+            redis.call('DEL', ARGV[1] .. rid)
+            redis.call('SREM', KEYS[2], rid)
+        else
+            redis.call('HDEL', KEYS[2], rid)
+        end
+        removed = removed + 1
+    end
+end
+return redis.call('DECRBY', KEYS[3], removed)
+"""
+
+
+# One SSCAN step of the row ids of a shard, or one HSCAN step of the
+# packed rows of a shard, the rows of other shards are filtered out by
+# redis instead of sent back. rids are hashed by
+# (h * 31 + byte) % 2147483647, lua of redis has no crc32
+# KEYS[1]: row ids key of the generation(packed rows key of PackedRcache)
+# ARGV[1]: cursor
+# ARGV[2]: count
+# ARGV[3]: shard
+# ARGV[4]: shards
+# ARGV[5]: "SSCAN" or "HSCAN"
+# return {next cursor, rid, ...} or {next cursor, rid, packed row, ...}
+SHARD_SCAN_SCRIPT = """
+local reply = redis.call(ARGV[5], KEYS[1], ARGV[1], 'COUNT', ARGV[2])
+local shard = tonumber(ARGV[3])
+local shards = tonumber(ARGV[4])
+local step = ARGV[5] == 'HSCAN' and 2 or 1
+local fields = reply[2]
+local rows = {reply[1]}
+for i = 1, #fields, step do
+    local rid = fields[i]
+    local h = 0
+    for j = 1, #rid do
+        h = (h * 31 + string.byte(rid, j)) % 2147483647
+    end
+    if h % shards == shard then
+        for j = i, i + step - 1 do
+            rows[#rows + 1] = fields[j]
+        end
+    end
+end
+return rows
+"""
+
+
 class Rcache(object):
-    def __init__(self, redis_url, mysql_server_id):
+    _merge_source = MERGE_SCRIPT
+    _row_ids_name = "row_ids"
+
+    def __init__(self, redis_url, mysql_server_id, fetch_batch=1000,
+                 cluster=False, change_index=False, client=None):
+        '''
+        fetch_batch: rows fetched by one pipelined round trip when iterating
+        cluster: redis_url is a node of redis cluster
+        change_index: index rows by cdc_ts in a sorted set per generation
+        for drain_until and iter_changes
+        client: a connected redis client used instead of redis_url
+        every key of a table has the hash tag "{table}" for redis cluster
+        '''
         self._redis_url = redis_url
-        self._client = redis.from_url(redis_url)
+        self._cluster = cluster
+        if client is not None:
+            self._client = client
+        elif cluster:
+            self._client = redis.RedisCluster.from_url(redis_url)
+        else:
+            self._client = redis.from_url(redis_url)
         self._server_id = mysql_server_id
         self._key_prefix = "{}#".format(mysql_server_id)
         self._locking_key = "{}#locking".format(mysql_server_id)
-        self._row_ids_prefix = "{}#row_ids#".format(mysql_server_id)
+        self._table_locking_prefix = "{}#locking#".format(mysql_server_id)
+        self._row_ids_prefix = "{}#{}#".format(mysql_server_id,
+                                               self._row_ids_name)
+        self._generation_prefix = "{}#generation#".format(mysql_server_id)
+        self._rows_prefix = "{}#rows#".format(mysql_server_id)
+        self._binlog_key = "{}#binlog".format(mysql_server_id)
+        # row ids keys of the versions before generations, like
+        # "{sid}#row_ids#table" without hash tag and generation
+        self._legacy_prefix = "{}#row_ids#".format(mysql_server_id)
+        self._changes_prefix = "{}#changes#".format(mysql_server_id)
+        self._change_index = change_index
+        self._table_rows = None
+        # {table: (merge script keys, row key prefix, row ids key prefix,
+        #          change index key prefix or "")}
+        self._table_keys = {}
+        self._fetch_batch = max(int(fetch_batch), 1)
         self._table_key_offset = len(self._row_ids_prefix)
         self._lock_timer = None
+        # {table: [timer refreshing the table lock]} of the tables locked by
+        # lock_table
+        self._table_holdings = {}
+        self._table_holdings_lock = threading.Lock()
+        # {table: generations} scanned once, older ones are left by broken
+        # dumpings, see _table_generations
+        self._generations = None
+        # {table: the last generation counted into self._generations}
+        self._last_generations = {}
+        self._merge_script = self._client.register_script(self._merge_source)
+        # loaded into the primaries of redis cluster before pipelining
+        self._scripts_loaded = False
+        self._drop_script = self._client.register_script(DROP_SCRIPT)
+        self._remove_changes_script = self._client.register_script(
+            REMOVE_CHANGES_SCRIPT)
+        self._shard_scan_script = self._client.register_script(
+            SHARD_SCAN_SCRIPT)
 
     @property
     def size(self):
-        return self._client.dbsize()
+        '''
+        count of cached rows of all tables
+        kept up to date by save() without querying redis
+        '''
+        if self._table_rows is None:
+            self.refresh_size()
+        return sum(self._table_rows.itervalues())
 
 
     def table_size(self, table):
-        row_ids_key = self._row_ids_prefix + table
-        return self._client.scard(row_ids_key)
+        if self._table_rows is None:
+            self.refresh_size()
+        return self._table_rows.get(table, 0)
+
+
+    def table_sizes(self):
+        '''
+        return {table: count of cached rows}
+        '''
+        if self._table_rows is None:
+            self.refresh_size()
+        return dict(self._table_rows)
+
+
+    def refresh_size(self):
+        '''
+        reload the rows counters, the cache may be drained by other process
+        return count of cached rows of all tables
+        '''
+        keys = list(self._client.scan_iter(
+            match="{}*".format(self._rows_prefix), count=100))
+        # the counters may be on different slots of redis cluster
+        pipe = self._client.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+        counts = pipe.execute() if keys else []
+        offset = len(self._rows_prefix)
+        self._table_rows = dict((self._untag(key[offset:]), int(count or 0))
+                                for key, count in zip(keys, counts))
+        return sum(self._table_rows.itervalues())
+
+
+    def refresh_table_sizes(self, tables):
+        '''
+        reload the rows counters of tables only, without scanning keys
+        return {table: count of cached rows}
+        '''
+        if self._table_rows is None:
+            self._table_rows = {}
+        tables = list(tables)
+        pipe = self._client.pipeline(transaction=False)
+        for table in tables:
+            pipe.get(self._rows_key(table))
+        for table, count in zip(tables, pipe.execute() if tables else []):
+            self._table_rows[table] = int(count or 0)
+        return dict((table, self._table_rows[table]) for table in tables)
+
+
+    @staticmethod
+    def _tag(table):
+        '''
+        hash tag keeps all keys of table on one slot of redis cluster
+        '''
+        return "{" + table + "}"
+
+
+    @staticmethod
+    def _untag(tag):
+        return tag[1:-1]
+
+
+    def _rows_key(self, table):
+        return "{}{}".format(self._rows_prefix, self._tag(table))
+
+
+    def _generation_key(self, table):
+        return "{}{}".format(self._generation_prefix, self._tag(table))
+
+
+    def _row_ids_key(self, table, gen):
+        return "{}{}#{}".format(self._row_ids_prefix, self._tag(table), gen)
+
+
+    def _row_key(self, table, gen, rid):
+        return "{}{}#{}.{}".format(self._key_prefix, self._tag(table), gen, rid)
+
+
+    def _row_prefix(self, table, gen):
+        '''
+        the prefix of row keys of a generation for REMOVE_CHANGES_SCRIPT
+        '''
+        return self._row_key(table, gen, "")
+
+
+    def _changes_key(self, table, gen):
+        return "{}{}#{}".format(self._changes_prefix, self._tag(table), gen)
+
+
+    def _merge_keys(self, table):
+        '''
+        keys and key prefixes of the table for the merge scripts,
+        built on first sight of the table
+        '''
+        keys = self._table_keys.get(table)
+        if keys is None:
+            tag = self._tag(table)
+            keys = self._table_keys[table] = (
+                [self._generation_key(table), self._rows_key(table)],
+                "{}{}#".format(self._key_prefix, tag),
+                "{}{}#".format(self._row_ids_prefix, tag),
+                "{}{}#".format(self._changes_prefix, tag)
+                if self._change_index else "")
+        return keys
+
+
+    def generation(self, table):
+        '''
+        return the generation which the table's rows are written into
+        '''
+        return int(self._client.get(self._generation_key(table)) or 0)
+
+
+    def _swap_generation(self, table):
+        '''
+        switch the writers of table to a new generation atomically
+        return the frozen generation
+        '''
+        return self._client.incr(self._generation_key(table)) - 1
+
+
+    def _freeze(self, tables=None):
+        '''
+        swap generations of tables(all cached tables if None)
+        return {table: [frozen_gen1, frozen_gen2...]}
+        the older generations left by a broken dumping are included,
+        tables being drained by drain_table are skipped
+        '''
+        cached = self._scan_generations()
+        tables = tables or cached.keys()
+        locked = self._locked_tables(tables)
+        frozen = {}
+        for table in tables:
+            if table in locked:
+                continue
+            gen = self._swap_generation(table)
+            gens = set(g for g in cached.get(table, ()) if g < gen)
+            gens.add(gen)
+            frozen[table] = sorted(gens)
+        return frozen
 
 
     def _lock(self, ex=60):
@@ -46,6 +523,185 @@ class Rcache(object):
         self._client.delete(self._locking_key)
 
 
+    def _table_locking_key(self, table):
+        return "{}{}".format(self._table_locking_prefix, self._tag(table))
+
+
+    def _locked_tables(self, tables):
+        pipe = self._client.pipeline(transaction=False)
+        for table in tables:
+            pipe.exists(self._table_locking_key(table))
+        return set(table for table, locked in
+                   zip(tables, pipe.execute() if tables else []) if locked)
+
+
+    def lock_table(self, table, ex=600):
+        '''
+        keep dumpers holding the global locking key away from table,
+        fail if one of them holds it.
+        the table lock is set before the global one is checked and dumpers
+        check table locks after setting the global one, so they never
+        drain a table together
+        '''
+        key = self._table_locking_key(table)
+        if not self._client.set(key, "", ex=ex, nx=True):
+            return False
+        if self._client.exists(self._locking_key):
+            self._client.delete(key)
+            return False
+        holding = []
+        with self._table_holdings_lock:
+            self._table_holdings[table] = holding
+        self._fresh_table_lock(table, ex, holding)
+        return True
+
+
+    def _fresh_table_lock(self, table, ex, holding):
+        '''
+        keep the table lock while a long draining goes on, until the
+        holding is ended by unlock_table
+        '''
+        with self._table_holdings_lock:
+            if self._table_holdings.get(table) is not holding:
+                return
+            self._client.expire(self._table_locking_key(table), ex)
+            timer = threading.Timer(ex - 10, self._fresh_table_lock,
+                                    (table, ex, holding))
+            timer.setDaemon(True)
+            holding[:] = [timer]
+            timer.start()
+
+
+    def unlock_table(self, table):
+        with self._table_holdings_lock:
+            holding = self._table_holdings.pop(table, None)
+        if holding:
+            holding[0].cancel()
+        self._client.delete(self._table_locking_key(table))
+
+
+    def drain_table(self, table, callback):
+        '''
+        callback args: (table, rows iterator)
+        freeze and dump one table under its own lock, the global locking
+        key is not held, so tables are drained one by one while other
+        tables are dumped
+        return False if the table is locked by another dumper
+        '''
+        if not self.lock_table(table):
+            return False
+        try:
+            gens = self._table_generations(table, self._swap_generation(table))
+            callback(table, self.iter_dump_rows(table, gens))
+            self.clear_generations(table, gens)
+            self._generations[table].difference_update(gens)
+        finally:
+            self.unlock_table(table)
+        return True
+
+
+    def _table_generations(self, table, last):
+        '''
+        return sorted generations of the cached rows of table up to last,
+        all tables are scanned once, generations swapped after the scan,
+        by this or other dumpers, are counted from the last counted one,
+        so a long running dumper finds them without scanning again
+        '''
+        if self._generations is None:
+            self._generations = self._scan_generations()
+            self._last_generations = dict(
+                (tbl, max(gens)) for tbl, gens in self._generations.iteritems()
+                if gens)
+        gens = self._generations.setdefault(table, set())
+        first = self._last_generations.get(table, last - 1) + 1
+        gens.update(xrange(first, last + 1))
+        self._last_generations[table] = max(first - 1, last)
+        return sorted(g for g in gens if g <= last)
+
+
+    def _check_change_index(self):
+        if not self._change_index:
+            raise ValueError("the change index is disabled, enable "
+                             "cache_change_index of the writers and dumpers")
+
+
+    def _iter_changes(self, table, gen, start, end, rids=None):
+        '''
+        rows of a generation changed between start and end by the change
+        index, in the order of cdc_ts. rids of the rows are appended to
+        rids if it is given
+        '''
+        changes_key = self._changes_key(table, gen)
+        offset = 0
+        while 1:
+            page = self._client.zrangebyscore(changes_key, start, end,
+                                              start=offset,
+                                              num=self._fetch_batch)
+            if not page:
+                return
+            offset += len(page)
+            if rids is not None:
+                rids.extend(page)
+            for row in self._fetch_rows(table, gen, page):
+                yield row
+
+
+    def _remove_changes(self, table, gen, rids):
+        '''
+        remove the dumped rows of a frozen generation by fetch_batch rids
+        '''
+        keys = [self._changes_key(table, gen), self._row_ids_key(table, gen),
+                self._rows_key(table)]
+        prefix = self._row_prefix(table, gen)
+        for i in xrange(0, len(rids), self._fetch_batch):
+            rows = self._remove_changes_script(
+                keys=keys, args=[prefix] + rids[i:i + self._fetch_batch])
+            if self._table_rows is not None:
+                self._table_rows[table] = rows
+
+
+    def iter_changes(self, table, start=None, end=None):
+        '''
+        rows of table changed between start and end(cdc_ts, None for no
+        bound) by the change index, nothing is removed, like the last hour
+        of changes: iter_changes(table, time.time() - 3600)
+        '''
+        self._check_change_index()
+        start = float("-inf") if start is None else float(start)
+        end = float("inf") if end is None else float(end)
+        for gen in self._table_generations(table, self.generation(table)):
+            for row in self._iter_changes(table, gen, start, end):
+                yield row
+
+
+    def drain_until(self, table, watermark, callback):
+        '''
+        callback args: (table, rows iterator)
+        dump and remove the rows of table changed at or before watermark
+        (cdc_ts) under its own lock. the generation is swapped first, so
+        capture keeps writing, rows after watermark are left in the frozen
+        generations for later dumpings.
+        rows are found by the change index, which must be enabled by the
+        writers of the cache
+        return False if the table is locked by another dumper
+        '''
+        self._check_change_index()
+        if not self.lock_table(table):
+            return False
+        try:
+            gens = self._table_generations(table, self._swap_generation(table))
+            rids = dict((g, []) for g in gens)
+            watermark = float(watermark)
+            callback(table, itertools.chain.from_iterable(
+                self._iter_changes(table, g, float("-inf"), watermark,
+                                   rids[g]) for g in gens))
+            for g in gens:
+                self._remove_changes(table, g, rids[g])
+        finally:
+            self.unlock_table(table)
+        return True
+
+
     def _fresh_lock(self, ex=60):
         self._client.expire(self._locking_key, ex),
         self._lock_timer = threading.Timer(ex - 10,
@@ -64,49 +720,128 @@ class Rcache(object):
         try:
             self._get_lock()
             self._fresh_lock()
-            for (table, row) in self:
-                callback(table, row)
-            self.clear()
+            frozen = self._freeze()
+            for table, gens in frozen.iteritems():
+                for gen in gens:
+                    for row in self._iter_table_rows(table, gen):
+                        callback(table, row)
+            for table, gens in frozen.iteritems():
+                for gen in gens:
+                    self._clear_table(table, gen)
         finally:
             self._unfresh_lock()
             self._free_lock()
 
 
 
-    def _clear_table(self, table):
-        row_ids_key = self._row_ids_prefix + table
+    def _clear_table(self, table, gen):
+        row_ids_key = self._row_ids_key(table, gen)
         rids = self._client.smembers(row_ids_key)
-        keys = ["{}{}.{}".format(self._key_prefix, table, rid) for rid in rids]
-        keys.append(row_ids_key)
-        self._client.delete(*keys)
+        keys = [self._row_key(table, gen, rid) for rid in rids]
+        keys.extend((row_ids_key, self._changes_key(table, gen)))
+        self._drop_generation(table, keys, len(rids))
+
+
+    def _drop_generation(self, table, keys, count):
+        '''
+        delete keys of the drained generation and its count of rows
+        '''
+        rows = self._drop_script(keys=[self._rows_key(table)] + keys,
+                                 args=[count])
+        if self._table_rows is not None:
+            self._table_rows[table] = rows
 
     def dump_t(self, callback, max_rows=0, dump_tables=None):
         '''
         callback args: (table, rows)
         dump data table by table
+        the locking key only keeps dumpers away from each other,
+        rows saved while dumping go to the new generation
         '''
         if not callable(callback):
             return
         try:
             self._get_lock()
             self._fresh_lock()
-            if not dump_tables:
-                for (over, table, rows) in self.iter_rows(max_rows):
-                    callback(table, rows)
-                    if over:
-                        self._clear_table(table)
-            else:
-                for table in dump_tables:
-                    for over, rows in self.iter_rows_by_table(table):
+            for table, gens in self._freeze(dump_tables).iteritems():
+                for gen in gens:
+                    for over, rows in self.iter_rows_by_table(
+                            table, max_rows, gen):
                         callback(table, rows)
                         if over:
-                            self._clear_table(table)
+                            self._clear_table(table, gen)
         finally:
             self._unfresh_lock()
             self._free_lock()
 
-    def clear(self):
-        self._client.flushdb()
+    def dump_stream(self, callback, dump_tables=None):
+        '''
+        callback args: (table, rows iterator)
+        rows of all frozen generations of a table are streamed by one
+        callback, they are cleared after the callback returns
+        '''
+        self.lock_dumping()
+        try:
+            for table, gens in self._freeze(dump_tables).iteritems():
+                callback(table, self.iter_dump_rows(table, gens))
+                self.clear_generations(table, gens)
+        finally:
+            self.unlock_dumping()
+
+    def lock_dumping(self):
+        '''
+        keep other dumpers away until unlock_dumping()
+        '''
+        self._get_lock()
+        self._fresh_lock()
+
+    def unlock_dumping(self):
+        self._unfresh_lock()
+        self._free_lock()
+
+    def _generation_size(self, table, gen):
+        return self._client.scard(self._row_ids_key(table, gen))
+
+    def dump_tasks(self, dump_tables=None, shard_rows=0, max_shards=1):
+        '''
+        freeze tables for dumping by other processes, the caller holds
+        the dumping lock. a table of more than shard_rows rows is split
+        into at most max_shards shards by the hash of rids
+        return [(table, gens, shard, shards), ...]
+        '''
+        tasks = []
+        for table, gens in self._freeze(dump_tables).iteritems():
+            shards = 1
+            if shard_rows and max_shards > 1:
+                rows = sum(self._generation_size(table, gen) for gen in gens)
+                shards = max(min(max_shards, -(-rows // shard_rows)), 1)
+            tasks.extend((table, gens, shard, shards)
+                         for shard in xrange(shards))
+        return tasks
+
+    def iter_dump_rows(self, table, gens, shard=0, shards=1):
+        '''
+        rows of a shard of the frozen generations
+        '''
+        for gen in gens:
+            for row in self._iter_table_rows(table, gen, shard, shards):
+                yield row
+
+    def clear_generations(self, table, gens):
+        '''
+        drop the dumped generations, after all shards of them are dumped
+        '''
+        for gen in gens:
+            self._clear_table(table, gen)
+
+    def clear(self, tables=None):
+        '''
+        drop the cached rows of tables(all tables if None)
+        rows saved after the generation swap are kept
+        '''
+        for table, gens in self._freeze(tables).iteritems():
+            for gen in gens:
+                self._clear_table(table, gen)
 
     def _unfresh_lock(self):
         if self._lock_timer:
@@ -120,24 +855,138 @@ class Rcache(object):
                 count=100)
 
 
+    def _scan_generations(self):
+        '''
+        return {table: set([gen1, gen2...])} of all cached rows
+        '''
+        cached = {}
+        for row_ids in self._iter_row_ids():
+            tag_gen = row_ids[self._table_key_offset:]
+            if not tag_gen.startswith("{"):
+                # a legacy key left for migrate_legacy
+                continue
+            tag, gen = tag_gen.rsplit("#", 1)
+            cached.setdefault(self._untag(tag), set()).add(int(gen))
+        return cached
+
+
+    def _legacy_tables(self):
+        '''
+        return [(row ids key, table)] cached by the versions before
+        generations
+        '''
+        offset = len(self._legacy_prefix)
+        return [(key, key[offset:]) for key in self._client.scan_iter(
+                    match="{}*".format(self._legacy_prefix), count=100)
+                if not key[offset:].startswith("{")]
+
+
+    def _put_legacy_rows(self, pipe, table, rows):
+        '''
+        rows: [(rid, row)], written into the legacy generation
+        '''
+        for rid, row in rows:
+            pipe.hmset(self._row_key(table, LEGACY_GENERATION, rid), row)
+        pipe.sadd(self._row_ids_key(table, LEGACY_GENERATION),
+                  *[rid for rid, _ in rows])
+
+
+    def migrate_legacy(self):
+        '''
+        move the rows cached by the versions before generations into
+        LEGACY_GENERATION of their tables, it is older than all others and
+        dumped first. the rows of fetch_batch rids are moved atomically
+        return count of moved rows
+        '''
+        moved = 0
+        for row_ids_key, table in self._legacy_tables():
+            rids = list(self._client.sscan_iter(row_ids_key,
+                                                count=self._fetch_batch))
+            for i in xrange(0, len(rids), self._fetch_batch):
+                batch = rids[i:i + self._fetch_batch]
+                keys = ["{}{}.{}".format(self._key_prefix, table, rid)
+                        for rid in batch]
+                pipe = self._client.pipeline(transaction=False)
+                for key in keys:
+                    pipe.hgetall(key)
+                rows = [(rid, row) for rid, row in zip(batch, pipe.execute())
+                        if row]
+                pipe = self._client.pipeline(transaction=not self._cluster)
+                if rows:
+                    self._put_legacy_rows(pipe, table, rows)
+                    pipe.incrby(self._rows_key(table), len(rows))
+                pipe.delete(*keys)
+                pipe.srem(row_ids_key, *batch)
+                pipe.execute()
+                moved += len(rows)
+        if moved and self._table_rows is not None:
+            self.refresh_size()
+        return moved
+
+
     def tables(self):
         '''
         return [schema.table1, schema.table2, .....]
         '''
-        keys = list(self._iter_row_ids())
-        return [table[self._table_key_offset:] for table in keys]
+        return self._scan_generations().keys()
+
+
+    def _fetch_rows(self, table, gen, rids):
+        pipe = self._client.pipeline(transaction=False)
+        for rid in rids:
+            pipe.hgetall(self._row_key(table, gen, rid))
+        # a row of the current generation may be merged away after sscan
+        return [row for row in pipe.execute() if row]
+
+
+    def _shard_scan(self, key, command, shard, shards):
+        '''
+        iterate the replies of SHARD_SCAN_SCRIPT without the cursors
+        '''
+        cursor = 0
+        while True:
+            reply = self._shard_scan_script(
+                keys=[key],
+                args=[cursor, self._fetch_batch, shard, shards, command])
+            yield reply[1:]
+            cursor = int(reply[0])
+            if not cursor:
+                break
+
+
+    def _iter_table_rows(self, table, gen, shard=0, shards=1):
+        '''
+        fetch rows by pipelined HGETALLs of fetch_batch row ids
+        only the row ids of the shard are sent back by SHARD_SCAN_SCRIPT
+        if shards > 1
+        '''
+        row_ids_key = self._row_ids_key(table, gen)
+        if shards > 1:
+            scanned = itertools.chain.from_iterable(self._shard_scan(
+                row_ids_key, "SSCAN", shard, shards))
+        else:
+            scanned = self._client.sscan_iter(row_ids_key,
+                                              count=self._fetch_batch)
+        rids = []
+        for rid in scanned:
+            rids.append(rid)
+            if len(rids) >= self._fetch_batch:
+                for row in self._fetch_rows(table, gen, rids):
+                    yield row
+                del rids[:]
+        if rids:
+            for row in self._fetch_rows(table, gen, rids):
+                yield row
 
 
     def __iter__(self):
         """
         return a generator like (table, row)
         """
-        for row_ids in self._iter_row_ids():
-            for row_id in self._client.sscan_iter(row_ids, count=1000):
-                table = row_ids[self._table_key_offset:]
-                row_key = "{}{}.{}".format(self._key_prefix, table, row_id)
-                row = self._client.hgetall(row_key)
-                yield (table, row)
+        for table, gens in self._scan_generations().iteritems():
+            for gen in sorted(gens):
+                for row in self._iter_table_rows(table, gen):
+                    yield (table, row)
 
 
     def iter_rows(self, max_rows=0):
@@ -146,28 +995,22 @@ class Rcache(object):
         set max_rows for avoid OOM
         yield (iter_over_flag, table, rows)
         '''
-        for row_ids in self._iter_row_ids():
-            rows = []
-            table = row_ids[self._table_key_offset:]
-            for row_id in self._client.sscan_iter(row_ids, count=1000):
-                row_key = "{}{}.{}".format(self._key_prefix, table, row_id)
-                row = self._client.hgetall(row_key)
-                rows.append(row)
-                if max_rows and len(rows) >= max_rows:
-                    yield (False, table, rows)
-                    del rows[:]
-            yield (True, table, rows)
+        for table, gens in self._scan_generations().iteritems():
+            for gen in sorted(gens):
+                for over, rows in self.iter_rows_by_table(table, max_rows, gen):
+                    yield (over, table, rows)
 
 
-    def iter_rows_by_table(self, table, max_row=0):
+    def iter_rows_by_table(self, table, max_row=0, gen=None):
         '''
         return a generator like [row1, row2...]
+        iterate the current generation if gen is None
         '''
+        if gen is None:
+            gen = self.generation(table)
         rows = []
-        row_ids_key = "{}{}".format(self._row_ids_prefix, table)
-        for row_id in self._client.sscan_iter(row_ids_key, count=1000):
-            row_key = "{}{}.{}".format(self._key_prefix, table, row_id)
-            rows.append(self._client.hgetall(row_key))
+        for row in self._iter_table_rows(table, gen):
+            rows.append(row)
             if max_row and len(rows) >= max_row:
                 yield False, rows
                 del rows[:]
@@ -221,6 +1064,24 @@ class Rcache(object):
             new["cdc_action"] = "update"  # maybe truncate table happened
         return new
 
+    def _merge_args(self, table, primary_key, rows):
+        '''
+        flatten rows into the MERGE_SCRIPT arguments
+        '''
+        _, row_prefix, row_ids_prefix, changes_prefix = self._merge_keys(
+            table)
+        gen_rid = rid_getter(primary_key)
+        if gen_rid is None:
+            raise SaveIgnore(
+                "Do not support table[{}] without primary_key".format(table))
+        args = [row_prefix, row_ids_prefix, changes_prefix]
+        for row in rows:
+            args.extend((gen_rid(row), len(row), "cdc_action", row["cdc_action"]))
+            for field, value in row.iteritems():
+                if field != "cdc_action":
+                    args.extend((field, value))
+        return args
+
     def save(self, table, primary_key, rows):
         '''
         save changed data
@@ -228,38 +1089,521 @@ class Rcache(object):
         row must has two columns:
           "cdc_action": "delete/insert/update"
           "cdc_ts": timestamp
+        all rows are merged by MERGE_SCRIPT in one round trip,
+        it also returns the table's rows counter for size
         return size of  saved rows
         '''
+        if not isinstance(rows, list):
+            rows = [rows]
+        if not rows:
+            return 0
+        keys, args, _ = self._save_args([(table, primary_key, rows)])
         try:
-            self._get_lock()
-            table_key = "{}{}".format(self._key_prefix, table)
-            row_ids_key = "{}{}".format(self._row_ids_prefix, table)
-            if not isinstance(rows, list):
-                rows = [rows]
-
-            for row in rows:
-                rid = self._gen_rid(row, primary_key)
-                if rid is None:
-                    raise SaveIgnore(
-                        "Do not support table[{}] without primary_key".format(
-                            table))
-                key = "{}.{}".format(table_key, rid)
-                old_row = self._client.hgetall(key)
-                merged_row = self._merge_row(old_row, row)
-                if merged_row:
-                    self._client.hmset(key, merged_row)
-                    self._client.sadd(row_ids_key, rid)
-                else:
-                    self._client.delete(key)
-                    self._client.srem(row_ids_key, rid)
+            saved, rows = self._merge_script(keys=keys, args=args)
         except redis.ResponseError, err:
             if "OOM command not allowed" in str(err):
                 raise FullError(str(err))
-        finally:
-            self._free_lock()
+        else:
+            if self._table_rows is not None:
+                self._table_rows[table] = rows
+            return saved
+
+    def checkpoint(self):
+        '''
+        return (log_file, log_pos) saved by save_many
+        or (None, None) if nothing saved
+        '''
+        binlog = self._client.hgetall(self._binlog_key)
+        if not binlog:
+            return None, None
+        return binlog["log_file"], int(binlog["log_pos"])
+
+    def _load_scripts(self):
+        '''
+        pipelines of redis cluster send EVALSHA without loading the script
+        like the ones of redis, load it into every primary once
+        '''
+        if not self._scripts_loaded:
+            self._client.execute_command(
+                "SCRIPT LOAD", self._merge_source,
+                target_nodes=redis.RedisCluster.PRIMARIES)
+            self._scripts_loaded = True
+
+    def _save_args(self, batches):
+        '''
+        return (keys, args, tables) of SAVE_SCRIPT without the position
+        '''
+        keys, args, tables = [], [0], []
+        for table, primary_key, rows in batches:
+            if rows:
+                table_args = self._merge_args(table, primary_key, rows)
+                keys.extend(self._merge_keys(table)[0])
+                args.append(len(table_args))
+                args.extend(table_args)
+                tables.append(table)
+        args[0] = len(tables)
+        return keys, args, tables
+
+    def _saved(self, tables, results):
+        saved = 0
+        for i, table in enumerate(tables):
+            saved += results[i * 2]
+            if self._table_rows is not None:
+                self._table_rows[table] = results[i * 2 + 1]
+        return saved
+
+    def save_many(self, batches, position=None):
+        '''
+        save changed data of tables and the binlog position atomically
+        by one SAVE_SCRIPT
+        batches: [(table, primary_key, rows), ...]
+        position: (log_file, log_pos) or None
+        redis cluster saves tables by a script per table, the position
+        is written after all of them are saved. SaveError tells the tables
+        saved before a failure
+        return size of saved rows
+        '''
+        if self._cluster:
+            return self._save_cluster(batches, position)
+        keys, args, tables = self._save_args(batches)
+        if not tables and position is None:
+            return 0
+        if position is not None:
+            keys.append(self._binlog_key)
+            args.extend(position)
+        try:
+            results = self._merge_script(keys=keys, args=args)
+        except redis.ResponseError, err:
+            if "OOM command not allowed" in str(err):
+                raise FullError(str(err))
+            raise
+        return self._saved(tables, results)
+
+    def _save_cluster(self, batches, position):
+        self._load_scripts()
+        pipe = self._client.pipeline(transaction=False)
+        tables = []
+        for batch in batches:
+            keys, args, saving = self._save_args([batch])
+            if saving:
+                self._merge_script(keys=keys, args=args, client=pipe)
+                tables.extend(saving)
+        results = pipe.execute(raise_on_error=False) if tables else []
+        errors = [result for result in results
+                  if isinstance(result, Exception)]
+        if errors:
+            saved_tables = [table for table, result in zip(tables, results)
+                            if not isinstance(result, Exception)]
+            self._saved(saved_tables, list(itertools.chain.from_iterable(
+                result for result in results
+                if not isinstance(result, Exception))))
+            if any(isinstance(err, redis.exceptions.NoScriptError)
+                   for err in errors):
+                # a failed over primary, loaded again by the next saving
+                self._scripts_loaded = False
+            if any("OOM command not allowed" in str(err) for err in errors):
+                raise PartialFullError(str(errors[0]), saved_tables)
+            raise SaveError(str(errors[0]), saved_tables)
+        if position is not None:
+            self._client.hmset(self._binlog_key,
+                               {"log_file": position[0],
+                                "log_pos": position[1]})
+        return self._saved(tables, list(itertools.chain.from_iterable(
+            results)))
+
+
+class PackedRcache(Rcache):
+    '''
+    Rcache stores every row as one packed value in a per-table hash.
+    The column names are registered once per table in
+    "{sid}#columns#{{table}}" instead of repeated by every row.
+    Iterators decode rows to dicts like Rcache
+    '''
+    _merge_source = PACKED_MERGE_SCRIPT
+    _row_ids_name = "packed"
+    _actions = {"insert": "i", "update": "u", "delete": "d"}
+    _action_names = dict((v, k) for k, v in _actions.iteritems())
+
+    def __init__(self, redis_url, mysql_server_id, fetch_batch=1000,
+                 cluster=False, change_index=False, client=None):
+        if msgpack is None:
+            raise ImportError("packed row format requires msgpack")
+        super(PackedRcache, self).__init__(redis_url, mysql_server_id,
+                                           fetch_batch, cluster, change_index,
+                                           client)
+        self._columns_prefix = "{}#columns#".format(mysql_server_id)
+        # {table: {columns: columns_id}} registered by this process
+        self._columns_ids = {}
+        # {table: {columns_id: columns}} loaded for decoding
+        self._columns = {}
+
+
+    @staticmethod
+    def _pack_value(value):
+        '''
+        keep the value like it is saved into redis hash
+        '''
+        if value is None or type(value) in (int, long, str):
+            return value
+        elif isinstance(value, unicode):
+            return value.encode("utf-8")
+        else:
+            return str(value)
+
+
+    def _register_columns(self, table, columns):
+        ids = self._columns_ids.setdefault(table, {})
+        if columns not in ids:
+            columns_id = zlib.crc32(json.dumps(columns)) & 0xffffffff
+            try:
+                self._client.hset(self._columns_prefix + self._tag(table),
+                                  columns_id,
+                                  json.dumps(columns))
+            except redis.ResponseError, err:
+                # a full cache must trigger dumping like the merge script
+                if "OOM command not allowed" in str(err):
+                    raise FullError(str(err))
+                raise
+            ids[columns] = columns_id
+        return ids[columns]
+
+
+    def _merge_args(self, table, primary_key, rows):
+        '''
+        flatten rows into the PACKED_MERGE_SCRIPT arguments
+        '''
+        gen_rid = rid_getter(primary_key)
+        if gen_rid is None:
+            raise SaveIgnore(
+                "Do not support table[{}] without primary_key".format(table))
+        keys = self._merge_keys(table)
+        args = [keys[2], keys[3]]
+        for row in rows:
+            args.extend((gen_rid(row), row["cdc_ts"],
+                         self._pack_row(table, row)))
+        return args
+
+
+    def _pack_row(self, table, row):
+        '''
+        return action code + msgpack([columns_id, cdc_ts, value1, ...])
+        '''
+        columns = tuple(sorted(field for field in row
+                               if field not in ("cdc_action", "cdc_ts")))
+        values = [self._register_columns(table, columns), row["cdc_ts"]]
+        values.extend(self._pack_value(row[col]) for col in columns)
+        return (self._actions[row["cdc_action"]] +
+                msgpack.packb(values, use_bin_type=False))
+
+
+    def _put_legacy_rows(self, pipe, table, rows):
+        pipe.hmset(self._row_ids_key(table, LEGACY_GENERATION),
+                   dict((rid, self._pack_row(table, row))
+                        for rid, row in rows))
+
+
+    def _load_columns(self, table):
+        columns = self._client.hgetall(self._columns_prefix + self._tag(table))
+        self._columns[table] = dict(
+            (int(columns_id), [name.encode("utf-8")
+                               for name in json.loads(names)])
+            for columns_id, names in columns.iteritems())
+        return self._columns[table]
+
+
+    def _decode_row(self, table, value):
+        values = msgpack.unpackb(value[1:], raw=True)
+        columns = self._columns.get(table, {}).get(values[0])
+        if columns is None:
+            columns = self._load_columns(table)[values[0]]
+        row = dict(zip(columns, values[2:]))
+        row["cdc_action"] = self._action_names[value[0]]
+        row["cdc_ts"] = values[1]
+        return row
+
+
+    def _iter_table_rows(self, table, gen, shard=0, shards=1):
+        '''
+        HSCAN returns the packed rows with their ids, no more round trips
+        the rows of a shard are filtered by SHARD_SCAN_SCRIPT if shards > 1,
+        so every shard only receives its own rows
+        '''
+        rows_key = self._row_ids_key(table, gen)
+        if shards == 1:
+            for rid, value in self._client.hscan_iter(rows_key,
+                                                      count=self._fetch_batch):
+                yield self._decode_row(table, value)
+            return
+        for rows in self._shard_scan(rows_key, "HSCAN", shard, shards):
+            for value in rows[1::2]:
+                yield self._decode_row(table, value)
+
+
+    def _fetch_rows(self, table, gen, rids):
+        return [self._decode_row(table, value) for value in
+                self._client.hmget(self._row_ids_key(table, gen), rids)
+                if value]
+
+
+    def _row_prefix(self, table, gen):
+        '''
+        rows are fields of the packed rows key, no key per row
+        '''
+        return ""
+
+
+    def _generation_size(self, table, gen):
+        return self._client.hlen(self._row_ids_key(table, gen))
+
+
+    def _clear_table(self, table, gen):
+        rows_key = self._row_ids_key(table, gen)
+        self._drop_generation(table, [rows_key, self._changes_key(table, gen)],
+                              self._client.hlen(rows_key))
+
+
+class ShardedRcache(object):
+    '''
+    Rcache over multiple redis instances.
+    Tables are routed to the caches by consistent hashing of the table name,
+    so adding a cache only moves a part of tables.
+    Dumping drains all caches in parallel
+    '''
+    def __init__(self, caches, replicas=160):
+        self._caches = caches
+        self._ring = []
+        for index, cache in enumerate(caches):
+            for replica in xrange(replicas):
+                point = "{}#{}".format(cache._redis_url, replica)
+                self._ring.append((self._hash(point), index))
+        self._ring.sort()
+        self._points = [hashed for hashed, _ in self._ring]
+        self._routes = {}
+
+
+    @staticmethod
+    def _hash(key):
+        return zlib.crc32(key) & 0xffffffff
+
+
+    def _cache(self, table):
+        '''
+        return the cache which table is routed to
+        '''
+        if table not in self._routes:
+            pos = bisect.bisect(self._points, self._hash(table))
+            self._routes[table] = self._caches[
+                self._ring[pos % len(self._ring)][1]]
+        return self._routes[table]
+
+
+    @property
+    def size(self):
+        return sum(cache.size for cache in self._caches)
+
+
+    def table_size(self, table):
+        return sum(cache.table_size(table) for cache in self._caches)
+
+
+    def table_sizes(self):
+        sizes = {}
+        for cache in self._caches:
+            for table, rows in cache.table_sizes().iteritems():
+                sizes[table] = sizes.get(table, 0) + rows
+        return sizes
+
+
+    def refresh_size(self):
+        return sum(cache.refresh_size() for cache in self._caches)
+
+
+    def migrate_legacy(self):
+        return sum(cache.migrate_legacy() for cache in self._caches)
+
+
+    def refresh_table_sizes(self, tables):
+        tables = list(tables)
+        sizes = dict.fromkeys(tables, 0)
+        for cache in self._caches:
+            for table, rows in cache.refresh_table_sizes(tables).iteritems():
+                sizes[table] += rows
+        return sizes
+
+
+    def generation(self, table):
+        return self._cache(table).generation(table)
+
+
+    def tables(self):
+        tables = set()
+        for cache in self._caches:
+            tables.update(cache.tables())
+        return list(tables)
+
+
+    def save(self, table, primary_key, rows):
+        return self._cache(table).save(table, primary_key, rows)
+
+
+    def checkpoint(self):
+        return self._caches[0].checkpoint()
+
+
+    def save_many(self, batches, position=None):
+        '''
+        the position is kept by the first cache. it is saved atomically
+        with the rows of the first cache only, after the other caches.
+        SaveError tells the tables saved by the other caches before a
+        failure
+        '''
+        shards = {}
+        for batch in batches:
+            shards.setdefault(self._cache(batch[0]), []).append(batch)
+        saved = 0
+        saved_tables = []
+        try:
+            for cache in self._caches[1:]:
+                if cache in shards:
+                    saved += cache.save_many(shards[cache])
+                    saved_tables.extend(batch[0] for batch in shards[cache])
+            return saved + self._caches[0].save_many(
+                shards.get(self._caches[0], []), position)
+        except Exception as err:
+            if not saved_tables:
+                raise
+            saved_tables.extend(getattr(err, "saved_tables", ()))
+            if isinstance(err, FullError):
+                raise PartialFullError(str(err), saved_tables)
+            raise SaveError(str(err), saved_tables)
+
+
+    def __iter__(self):
+        for cache in self._caches:
+            for (table, row) in cache:
+                yield (table, row)
+
+
+    def iter_rows(self, max_rows=0):
+        for cache in self._caches:
+            for (over, table, rows) in cache.iter_rows(max_rows):
+                yield (over, table, rows)
+
+
+    def iter_rows_by_table(self, table, max_row=0):
+        '''
+        the rows of table may be left in other caches after resharding
+        '''
+        for cache in self._caches:
+            for over, rows in cache.iter_rows_by_table(table, max_row):
+                yield over, rows
+
+
+    def clear(self, tables=None):
+        for cache in self._caches:
+            cache.clear(tables)
+
+
+    def dump_r(self, callback):
+        for cache in self._caches:
+            cache.dump_r(callback)
+
+
+    def drain_table(self, table, callback):
+        '''
+        the rows of table may be left in other caches after resharding
+        return False if the table is locked in any cache
+        '''
+        drained = True
+        for cache in self._caches:
+            if cache.table_size(table) or cache is self._cache(table):
+                drained = cache.drain_table(table, callback) and drained
+        return drained
+
+
+    def drain_until(self, table, watermark, callback):
+        '''
+        like drain_table, the rows of table in every cache
+        '''
+        drained = True
+        for cache in self._caches:
+            if cache.table_size(table) or cache is self._cache(table):
+                drained = (cache.drain_until(table, watermark, callback) and
+                           drained)
+        return drained
+
+
+    def iter_changes(self, table, start=None, end=None):
+        for cache in self._caches:
+            for row in cache.iter_changes(table, start, end):
+                yield row
+
+
+    @property
+    def caches(self):
+        return list(self._caches)
+
+
+    def _each_cache(self, method, *args):
+        '''
+        call method of every cache by one thread per cache
+        raise the first error of the caches after all threads over
+        '''
+        errors = []
+
+        def _call(cache):
+            try:
+                getattr(cache, method)(*args)
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=_call, args=(cache,))
+                   for cache in self._caches]
+        for thr in threads:
+            thr.setDaemon(True)
+            thr.start()
+        for thr in threads:
+            thr.join()
+        if errors:
+            raise errors[0]
+
+
+    def dump_t(self, callback, max_rows=0, dump_tables=None):
+        '''
+        callback is called by one thread per cache
+        '''
+        self._each_cache("dump_t", callback, max_rows, dump_tables)
 
 
+    def dump_stream(self, callback, dump_tables=None):
+        self._each_cache("dump_stream", callback, dump_tables)
 
 
+ROW_FORMATS = {
+    "hash": Rcache,
+    "packed": PackedRcache
+}
 
 
+def create(redis_url, mysql_server_id, row_format="hash", fetch_batch=1000,
+           cluster=False, change_index=False, client=None):
+    '''
+    create the cache of row_format: "hash" or "packed"
+    redis_url: a url, or a list or comma separated urls for ShardedRcache
+    cluster: redis_url is a node of redis cluster
+    change_index: index rows by cdc_ts for watermark dumpings
+    client: a connected redis client of the only redis_url
+    '''
+    if row_format not in ROW_FORMATS:
+        raise ValueError("unknown row format: {}".format(row_format))
+    if isinstance(redis_url, basestring):
+        redis_url = redis_url.split(",")
+    if client is not None and len(redis_url) > 1:
+        raise ValueError("a client is only for one redis url")
+    caches = [ROW_FORMATS[row_format](url.strip(), mysql_server_id,
+                                      fetch_batch, cluster, change_index,
+                                      client)
+              for url in redis_url]
+    if len(caches) == 1:
+        return caches[0]
+    return ShardedRcache(caches)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+Usage:
+  replay.py <event_log>... -s SID -u REDIS_URL [-r FORMAT] [--cluster] [--change_index] [-b ROWS] [--no_position] [-l DIR] [-v]
+  replay.py <event_log>... -c CONFIG_FILE [-b ROWS] [--no_position] [-v]
+  replay.py (-h | --help | --version)
+
+Arguments:
+  <event_log>                   Specify event logs recorded by cdc.py(capture_file),
+                                replayed in order
+
+Options:
+  -h --help                     Show this help message and exit
+  --version                     Show version and exit
+  -c --config_file=CONFIG_FILE  Specify config file
+  -v --verbose                  Print the running status message
+  -s --server_id=SID            Specify mysql server id
+  -u --cache_url=REDIS_URL      Specify the redis cache url like:
+                                "redis://host:port/db", separate urls of
+                                the sharded cache by ","
+  --cluster                     The cache url is a node of redis cluster
+  --change_index                Index the saved rows by cdc_ts like the
+                                cache_change_index of cdc_config.py
+  -r --row_format=FORMAT        Specify the row format of cache: hash or packed
+                                [default: hash]
+  -b --buffer_rows=ROWS         Specify rows buffered before saving [default: 5000]
+  --no_position                 Do not save the recorded binlog position,
+                                for load testing on a copy of the cache
+  -l --log_dir=DIR              Specify the dir of logging
+'''
+
+import os
+import time
+import json
+from docopt import docopt
+
+import rcache
+import wbuffer
+import eventlog
+import mwlogger
+
+__version__ = "v0.1"
+
+
+def replay(cache, event_logs, buffer_rows, save_position=True):
+    '''
+    save the recorded rows by the save path of cdc.py at full speed
+    return (count of rows, count of transactions)
+    '''
+    # no time limit, only buffer_rows and transactions decide flushing
+    wbuf = wbuffer.WriteBuffer(cache, buffer_rows, float("inf"),
+                               save_position=save_position)
+    rows = transactions = 0
+    for event_log in event_logs:
+        for kind, record in eventlog.read_events(event_log):
+            if kind == "position":
+                wbuf.checkpoint(record)
+                transactions += 1
+            else:
+                table, primary_key, trows = record
+                wbuf.add(table, primary_key, trows)
+                rows += len(trows)
+            if wbuf.due():
+                wbuf.flush()
+    wbuf.flush()
+    return rows, transactions
+
+
+def create_logger(log_dir, verbose):
+    if verbose:
+        log_file = None
+    elif log_dir:
+        log_file = os.path.join(log_dir, "replay.log")
+    else:
+        log_file = "replay.log"
+
+    return mwlogger.MwLogger("replay", log_file)
+
+
+def main():
+    options = docopt(__doc__, version=__version__)
+    config_file = options['--config_file']
+    verbose = options['--verbose']
+
+    if config_file:
+        cfg = json.load(file(config_file))
+        cache_url = cfg['cache_url']
+        server_id = cfg['server_id']
+        log_dir = cfg.get('log_dir', None)
+        row_format = cfg.get('row_format', 'hash')
+        cluster = cfg.get('cache_cluster', False)
+        change_index = cfg.get('cache_change_index', False)
+    else:
+        cache_url = options['--cache_url']
+        server_id = options['--server_id']
+        log_dir = options['--log_dir']
+        row_format = options['--row_format']
+        cluster = options['--cluster']
+        change_index = options['--change_index']
+
+    cache = rcache.create(cache_url, server_id, row_format, cluster=cluster,
+                          change_index=change_index)
+    logger = create_logger(log_dir, verbose)
+
+    event_logs = options['<event_log>']
+    logger.info("start replay {}".format(", ".join(event_logs)))
+    start = time.time()
+    rows, transactions = replay(cache, event_logs,
+                                int(options['--buffer_rows']),
+                                not options['--no_position'])
+    cost = time.time() - start
+    logger.info("replay ok, rows:{}, transactions:{}, {:.1f}s, {:.0f} rows/sec, "
+                "position:{}".format(rows, transactions, cost,
+                                     rows / cost if cost else 0,
+                                     cache.checkpoint()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+per-table column projection and row predicates, compiled once
+
+config like table_filters of cdc_config.py:
+  {"db.table": {"include": ("id", "name"),
+                "exclude": ("body",),
+                "where": [("status", "!=", 0), ("type", "in", (1, 2))]}}
+'''
+
+import operator
+
+_OPS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda value, values: value in values,
+    "not in": lambda value, values: value not in values,
+}
+
+
+class TableFilter(object):
+    '''
+    include: keep only these columns
+    exclude: drop these columns
+    the primary key is always kept
+    where: (column, op, value) or a list of them, all must be true
+    '''
+
+    def __init__(self, include=None, exclude=None, where=None):
+        if include and exclude:
+            raise ValueError("set include or exclude, not both")
+        self._include = frozenset(include) if include else None
+        self._exclude = frozenset(exclude) if exclude else None
+        if where and isinstance(where[0], basestring):
+            where = [where]
+        self._where = []
+        for column, op, value in where or ():
+            if op not in _OPS:
+                raise ValueError("unknown operator: {}".format(op))
+            self._where.append((column, _OPS[op], value))
+        # {primary_key: columns to keep or drop}
+        self._keeps = {}
+
+    def test(self, values):
+        for column, op, value in self._where:
+            if not op(values.get(column), value):
+                return False
+        return True
+
+    def action(self, action, values, before_values=None):
+        '''
+        return the action to cache for a row change, None to drop it.
+        rows true for where are mirrored: an update moving a row into
+        where is an insert, moving it out is a delete, a delete is kept
+        only if the row is true, the ones moved out were deleted by then.
+        an update without the before image is taken as from a true row
+        '''
+        if not self._where:
+            return action
+        if not self.test(values):
+            if action == "update" and (before_values is None or
+                                       self.test(before_values)):
+                return "delete"
+            return None
+        if (action == "update" and before_values is not None and
+                not self.test(before_values)):
+            return "insert"
+        return action
+
+    def _columns(self, primary_key):
+        pk = (primary_key if isinstance(primary_key, (tuple, list))
+              else (primary_key,))
+        if self._include is not None:
+            return self._include.union(pk)
+        return self._exclude.difference(pk)
+
+    def project(self, values, primary_key):
+        if self._include is None and self._exclude is None:
+            return values
+        columns = self._keeps.get(primary_key)
+        if columns is None:
+            columns = self._keeps[primary_key] = self._columns(primary_key)
+        if self._include is not None:
+            return dict((col, value) for col, value in values.iteritems()
+                        if col in columns)
+        return dict((col, value) for col, value in values.iteritems()
+                    if col not in columns)
+
+
+def compile_filters(config):
+    '''
+    return {table: TableFilter}
+    '''
+    return dict((table, TableFilter(cfg.get("include"), cfg.get("exclude"),
+                                    cfg.get("where")))
+                for table, cfg in (config or {}).iteritems())
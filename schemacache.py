@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+local persisted column schemas of mysql tables, shared by cdc.py and
+bq_schema_from_mysql.py. columns are the rows of COLUMNS_SQL, which
+BinLogStreamReader queries for every table it meets.
+
+file layout(json): {"schema.table": [{"COLUMN_NAME": ..., ...}, ...]}
+'''
+
+import os
+import re
+import json
+import threading
+
+import pymysql
+
+COLUMNS_SQL = """
+    SELECT
+        COLUMN_NAME, COLLATION_NAME, CHARACTER_SET_NAME,
+        COLUMN_COMMENT, COLUMN_TYPE, COLUMN_KEY
+    FROM
+        information_schema.columns
+    WHERE
+        table_schema = %s AND table_name = %s
+    ORDER BY ORDINAL_POSITION
+"""
+
+_DDL = re.compile(r"^\s*(ALTER|CREATE|DROP|RENAME|TRUNCATE)\b", re.I)
+_DATABASE_DDL = re.compile(
+    r"^\s*(ALTER|DROP)\s+(DATABASE|SCHEMA)\s+(IF\s+EXISTS\s+)?`?(\w+)", re.I)
+_WORD = re.compile(r"\w+")
+
+
+def data_type(column_type):
+    '''
+    "int(11) unsigned" -> "int"
+    '''
+    return column_type.split("(")[0].split(" ")[0].lower()
+
+
+def ddl_tables(schema, query, tables):
+    '''
+    tables: [(schema, table), ...]
+    return the tables which a ddl query of schema may change, the tables
+    named in the query are returned even if they are not changed
+    '''
+    if not _DDL.match(query):
+        return []
+    database = _DATABASE_DDL.match(query)
+    if database:
+        return [key for key in tables if key[0] == database.group(4)]
+    words = set(_WORD.findall(query))
+    return [(kschema, ktable) for kschema, ktable in tables
+            if ktable in words and (kschema == schema or kschema in words)]
+
+
+def query_columns(connection, schema, table):
+    cur = connection.cursor(pymysql.cursors.DictCursor)
+    try:
+        cur.execute(COLUMNS_SQL, (schema, table))
+        return list(cur.fetchall())
+    finally:
+        cur.close()
+
+
+class SchemaCache(object):
+    '''
+    usage:
+      cache = SchemaCache("schema_cache.json")
+      columns = cache.get("db", "table")  # None if not cached
+      cache.put("db", "table", columns)
+      cache.invalidate_query("db", "ALTER TABLE t ADD c int")
+    '''
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._tables = {}
+        if os.path.exists(path):
+            with open(path) as fp:
+                self._tables = json.load(fp)
+
+    def __len__(self):
+        return len(self._tables)
+
+    def get(self, schema, table):
+        return self._tables.get("{}.{}".format(schema, table))
+
+    def put(self, schema, table, columns):
+        '''
+        an empty columns, the table is not found, is not cached
+        '''
+        if not columns:
+            return
+        with self._lock:
+            self._tables["{}.{}".format(schema, table)] = list(columns)
+            self._save()
+
+    def fetch(self, connection, schema, table):
+        '''
+        return cached columns, or query and cache them
+        '''
+        columns = self.get(schema, table)
+        if columns is None:
+            columns = query_columns(connection, schema, table)
+            self.put(schema, table, columns)
+        return columns
+
+    def invalidate(self, keys):
+        '''
+        keys: ["schema.table", ...]
+        '''
+        with self._lock:
+            dropped = [key for key in keys if self._tables.pop(key, None)]
+            if dropped:
+                self._save()
+        return dropped
+
+    def invalidate_query(self, schema, query):
+        '''
+        drop the tables which a ddl query may change, the tables named
+        in the query are dropped even if they are not changed.
+        return [(schema, table), ...] dropped
+        '''
+        keys = ddl_tables(schema, query, [tuple(key.split(".", 1))
+                                          for key in self._tables.keys()])
+        return [tuple(key.split(".", 1)) for key in
+                self.invalidate(["{}.{}".format(*key) for key in keys])]
+
+    def _save(self):
+        tmp = "{}.tmp".format(self._path)
+        with open(tmp, "w") as fp:
+            json.dump(self._tables, fp)
+        os.rename(tmp, self._path)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+tests of the routes of tables in cdc.py, without mysql
+
+usage:
+  python -m unittest test_cdc
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import cdc
+except ImportError:
+    cdc = None
+
+import rcache
+import schemacache
+
+
+class _Event(object):
+    '''
+    the attributes of a rows event which routes are built by
+    '''
+
+    def __init__(self, schema, table, primary_key):
+        self.schema = schema
+        self.table = table
+        self.primary_key = primary_key
+
+
+@unittest.skipIf(cdc is None, "pymysqlreplication is not installed")
+class RouteTest(unittest.TestCase):
+
+    def setUp(self):
+        cdc._routes.clear()
+
+    def tearDown(self):
+        cdc._routes.clear()
+
+    def test_route_is_cached(self):
+        self.assertEqual(cdc._route(_Event("db", "t", "id"))[:2],
+                         ("db.t", "id"))
+        self.assertEqual(cdc._route(_Event("db", "t", "other"))[1], "id")
+
+    def test_ddl_drops_route(self):
+        cdc._route(_Event("db", "t", "id"))
+        cdc._route(_Event("db", "u", "id"))
+        cdc._on_query("db", "ALTER TABLE t DROP PRIMARY KEY, "
+                            "ADD PRIMARY KEY (id, k)")
+        self.assertEqual(cdc._route(_Event("db", "t", ["id", "k"]))[1],
+                         ("id", "k"))
+        self.assertEqual(cdc._route(_Event("db", "u", "k"))[1], "id")
+
+    def test_ddl_of_other_schema(self):
+        cdc._route(_Event("db", "t", "id"))
+        cdc._on_query("other", "ALTER TABLE t ADD PRIMARY KEY (k)")
+        self.assertEqual(cdc._route(_Event("db", "t", "k"))[1], "id")
+        cdc._on_query("other", "ALTER TABLE db.t ADD PRIMARY KEY (k)")
+        self.assertEqual(cdc._route(_Event("db", "t", "k"))[1], "k")
+
+    def test_drop_database(self):
+        cdc._route(_Event("db", "t", "id"))
+        cdc._on_query("db", "DROP DATABASE db")
+        self.assertEqual(cdc._route(_Event("db", "t", "k"))[1], "k")
+
+    def test_dml_keeps_route(self):
+        cdc._route(_Event("db", "t", "id"))
+        cdc._on_query("db", "BEGIN")
+        cdc._on_query("db", "UPDATE t SET k = 1")
+        self.assertEqual(cdc._route(_Event("db", "t", "k"))[1], "id")
+
+    def test_schema_cache_invalidated(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            cache = schemacache.SchemaCache(os.path.join(tmp, "schema.json"))
+            cache.put("db", "t", [{"COLUMN_NAME": "id"}])
+            cdc._route(_Event("db", "t", "id"))
+            cdc._on_query("db", "alter table t add k int", cache)
+            self.assertIsNone(cache.get("db", "t"))
+            self.assertEqual(cdc._route(_Event("db", "t", "k"))[1], "k")
+        finally:
+            shutil.rmtree(tmp)
+
+
+class _Buffer(object):
+    '''
+    a write buffer which flush fails by FullError once
+    '''
+
+    def __init__(self):
+        self.failed = False
+
+    def flush(self):
+        if not self.failed:
+            self.failed = True
+            raise rcache.FullError("OOM")
+        return 1
+
+
+class _Cache(object):
+    size = 0
+
+
+class _Runner(object):
+
+    def __init__(self):
+        self.reasons = []
+
+    def trigger(self, reason):
+        self.reasons.append(reason)
+
+
+@unittest.skipIf(cdc is None, "pymysqlreplication is not installed")
+class FlushTest(unittest.TestCase):
+
+    def test_sleep_is_not_timed(self):
+        observed = []
+        observe, sleep = cdc.save_seconds.observe, cdc.time.sleep
+        cdc.save_seconds.observe = observed.append
+        cdc.time.sleep = lambda seconds: None
+        runner = _Runner()
+        try:
+            cdc._flush(_Buffer(), _Cache(), runner, interval=60)
+        finally:
+            cdc.save_seconds.observe, cdc.time.sleep = observe, sleep
+        self.assertEqual(len(observed), 2)
+        self.assertTrue(all(seconds < 1 for seconds in observed))
+        self.assertEqual(len(runner.reasons), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+tests of the typed parquet files written by columnar
+
+usage:
+  python -m unittest test_columnar
+'''
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import columnar
+
+def _micros(value):
+    return int((value - datetime(1970, 1, 1)).total_seconds()) * 1000000
+
+
+SCHEMA = [{"name": "id", "type": "INTEGER"},
+          {"name": "price", "type": "FLOAT"},
+          {"name": "created", "type": "TIMESTAMP"}]
+
+
+@unittest.skipIf(columnar.pyarrow is None, "pyarrow is not installed")
+class TableParquetWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.schema_dir = os.path.join(self.tmp, "bq_schema")
+        os.makedirs(os.path.join(self.schema_dir, "db"))
+        with open(os.path.join(self.schema_dir, "db", "t"), "w") as fp:
+            json.dump(SCHEMA, fp)
+        self.files = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, rows, **kwargs):
+        writer = columnar.TableParquetWriter(
+            os.path.join(self.tmp, "dump"), "db.t",
+            on_file=lambda path, rows: self.files.append((path, rows)),
+            types=columnar.load_schema(self.schema_dir, "db.t"), **kwargs)
+        writer.write_rows(rows)
+        writer.close()
+
+    def test_load_schema(self):
+        self.assertEqual(columnar.load_schema(self.schema_dir, "db.t"),
+                         {"id": "integer", "price": "float",
+                          "created": "timestamp"})
+        self.assertIsNone(columnar.load_schema(self.schema_dir, "db.u"))
+
+    def test_typed_columns(self):
+        rows = [{"id": str(rid), "price": "1.5", "name": "\xff" * rid,
+                 "created": "2020-01-02 03:04:05"} for rid in range(5)]
+        rows.append({"id": "5", "price": "", "name": None,
+                     "created": "0000-00-00 00:00:00"})
+        self.write(rows, max_rows=4, batch_rows=3)
+        self.assertEqual([count for _, count in self.files], [4, 2])
+        read = []
+        for path, _ in self.files:
+            self.assertTrue(path.endswith(".parquet"), path)
+            read.extend(columnar.parquet.read_table(
+                path, columns=["id"]).column("id").to_pylist())
+        self.assertEqual(read, range(6))
+        table = columnar.parquet.read_table(self.files[-1][0])
+        self.assertEqual(table.column("created").type,
+                         columnar.pyarrow.timestamp("us"))
+        created = table.column("created").cast(columnar.pyarrow.int64())
+        self.assertEqual(created.to_pylist(),
+                         [_micros(datetime(2020, 1, 2, 3, 4, 5)), None])
+        columns = table.drop(["created"]).to_pydict()
+        self.assertEqual(columns["price"], [1.5, None])
+        self.assertEqual(columns["name"], [u"\ufffd" * 4, None])
+
+    def test_altered_table(self):
+        self.write([{"id": "1", "price": "1"},
+                    {"id": "2", "price": "2",
+                     "created": "2020-01-01 00:00:00"}])
+        self.assertEqual(len(self.files), 2)
+        for path, rows in self.files:
+            self.assertTrue(path.endswith(".tmp.parquet"), path)
+            self.assertEqual(rows, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
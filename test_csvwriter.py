@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+tests of the csv files written by csvwriter and read back by loadcsv
+
+usage:
+  python -m unittest test_csvwriter
+'''
+
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+import csvwriter
+
+
+def _rows(count):
+    return [{"id": str(rid), "v": "v" * (rid % 7)} for rid in range(count)]
+
+
+class TableCsvWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dump_dir = tempfile.mkdtemp()
+        self.files = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dump_dir)
+
+    def write(self, rows, **kwargs):
+        writer = csvwriter.TableCsvWriter(
+            self.dump_dir, "db.t",
+            on_file=lambda path, rows: self.files.append((path, rows)),
+            **kwargs)
+        writer.write_rows(rows)
+        writer.close()
+        return writer
+
+    def read(self, path):
+        with csvwriter.open_dumped(path) as fp:
+            return list(csv.DictReader(fp))
+
+    def check_compressed(self, compression, suffix):
+        rows = _rows(5000)
+        self.write(rows, max_rows=3000, compression=compression)
+        self.assertEqual([count for _, count in self.files], [3000, 2000])
+        read = []
+        for path, _ in self.files:
+            self.assertTrue(path.endswith(".csv" + suffix), path)
+            read.extend(self.read(path))
+        self.assertEqual(read, rows)
+
+    def test_plain(self):
+        self.check_compressed(None, "")
+
+    def test_gzip(self):
+        self.check_compressed("gzip", ".gz")
+
+    @unittest.skipIf(csvwriter.zstandard is None,
+                     "zstandard is not installed")
+    def test_zstd(self):
+        self.check_compressed("zstd", ".zst")
+
+    def test_altered_table(self):
+        rows = [{"id": "1", "v": "a"}, {"id": "2"}, {"id": "3", "v": "c"}]
+        writer = self.write(rows)
+        self.assertTrue(writer.altered)
+        self.assertEqual(sorted(count for _, count in self.files), [1, 2])
+        for path, _ in self.files:
+            self.assertTrue(path.endswith(".tmp"), path)
+        # each file has its own header
+        read = sorted((row for path, _ in self.files
+                       for row in self.read(path)), key=lambda r: r["id"])
+        self.assertEqual(read, rows)
+
+    def test_failed_files_left_as_part(self):
+        writer = csvwriter.TableCsvWriter(self.dump_dir, "db.t")
+        writer.write_rows(_rows(3))
+        writer.close(False)
+        date_dir = os.path.join(self.dump_dir, os.listdir(self.dump_dir)[0])
+        self.assertTrue(all(name.endswith(".part")
+                            for name in os.listdir(date_dir)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+tests of the event log recorded by cdc.py and replayed by replay.py
+
+usage:
+  python -m unittest test_eventlog
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+import eventlog
+import rcache
+
+
+def _row(rid, action, ts):
+    return {"id": rid, "name": "n{}".format(rid), "cdc_action": action,
+            "cdc_ts": ts}
+
+
+@unittest.skipIf(eventlog.msgpack is None, "msgpack is not installed")
+class EventLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "capture.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def record(self):
+        writer = eventlog.EventLogWriter(self.path)
+        writer.rows("db.t", "id", [_row(1, "insert", 10),
+                                   _row(2, "insert", 10)])
+        writer.position("bin.000001", 4)
+        writer.rows("db.u", ["id", "k"], [dict(_row(1, "update", 11), k=7)])
+        writer.rows("db.u", "id", [])
+        writer.position("bin.000001", 8)
+        writer.close()
+
+    def test_round_trip(self):
+        self.record()
+        # appended by a restart, without another magic
+        writer = eventlog.EventLogWriter(self.path)
+        writer.rows("db.t", "id", [_row(1, "delete", 12)])
+        writer.close()
+        events = list(eventlog.read_events(self.path))
+        self.assertEqual([kind for kind, _ in events],
+                         ["rows", "position", "rows", "position", "rows"])
+        self.assertEqual(events[1][1], ("bin.000001", 4))
+        table, primary_key, rows = events[0][1]
+        self.assertEqual((table, primary_key), ("db.t", "id"))
+        self.assertEqual([(int(row["id"]), row["name"], row["cdc_action"],
+                           row["cdc_ts"]) for row in rows],
+                         [(1, "n1", "insert", 10), (2, "n2", "insert", 10)])
+        self.assertEqual(events[2][1][1], ("id", "k"))
+        self.assertEqual(events[4][1][2][0]["cdc_action"], "delete")
+
+    def test_truncated_frame_ignored(self):
+        self.record()
+        size = os.path.getsize(self.path)
+        for cut in (3, 9):
+            with open(self.path, "r+b") as fp:
+                fp.truncate(size - cut)
+            self.assertEqual([kind for kind, _ in
+                              eventlog.read_events(self.path)],
+                             ["rows", "position", "rows"])
+
+    def test_corrupt_frame(self):
+        self.record()
+        with open(self.path, "r+b") as fp:
+            fp.seek(len(eventlog.MAGIC) + eventlog._HEADER.size + 2)
+            byte = fp.read(1)
+            fp.seek(-1, os.SEEK_CUR)
+            fp.write(chr(ord(byte) ^ 0xff))
+        with self.assertRaises(ValueError):
+            list(eventlog.read_events(self.path))
+
+    def test_not_event_log(self):
+        with open(self.path, "wb") as fp:
+            fp.write("id,name\n")
+        with self.assertRaises(ValueError):
+            list(eventlog.read_events(self.path))
+
+    @unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+    def test_replay(self):
+        try:
+            import replay
+        except ImportError:
+            self.skipTest("docopt is not installed")
+        self.record()
+        client = fakeredis.FakeStrictRedis()
+        client.flushall()
+        cache = rcache.create("redis://fakeredis", 1, client=client)
+        self.assertEqual(replay.replay(cache, [self.path], 2), (3, 2))
+        self.assertEqual(cache.checkpoint(), ("bin.000001", 8))
+        self.assertEqual(sorted(int(row["id"]) for table, row in cache
+                                if table == "db.t"), [1, 2])
+        self.assertEqual(cache.table_size("db.u"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
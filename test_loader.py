@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+tests of the load jobs of loader, and the files dumped, uploaded and
+loaded without network
+
+usage:
+  python -m unittest test_loader
+'''
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import csvwriter
+import loader
+import manifest
+import uploader
+
+
+class _Logger(object):
+
+    def __init__(self):
+        self.warnings = []
+
+    def warn(self, message):
+        self.warnings.append(message)
+
+
+class _BrokenSink(object):
+
+    def upload(self, path, date):
+        raise IOError("network is down")
+
+
+def _uploaded(*names):
+    return [("/dumps/20200101/" + name,
+             "gs://b/sys/1/20200101/" + name) for name in names]
+
+
+class JobsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = _Logger()
+        self.loader = loader.Loader(None, None, logger=self.logger)
+
+    def test_altered_files_alone(self):
+        files = _uploaded("db.t.1.csv", "db.t.2.tmp", "db.t.3.csv.gz",
+                          "db.t.4.tmp.gz", "db.u.1.parquet")
+        jobs = sorted((key, [path.rsplit("/", 1)[1] for path, _ in files])
+                      for key, files in self.loader.jobs(files))
+        self.assertEqual(jobs, [
+            (("sys", "1", "db", "t", "csv"), ["db.t.1.csv", "db.t.3.csv.gz"]),
+            (("sys", "1", "db", "t", "csv"), ["db.t.2.tmp"]),
+            (("sys", "1", "db", "t", "csv"), ["db.t.4.tmp.gz"]),
+            (("sys", "1", "db", "u", "parquet"), ["db.u.1.parquet"])])
+
+    def test_max_uris(self):
+        files = _uploaded(*["db.t.{}.csv".format(ts)
+                            for ts in range(loader.MAX_URIS + 1)])
+        self.assertEqual([len(files) for _, files in self.loader.jobs(files)],
+                         [loader.MAX_URIS, 1])
+
+    def test_zstd_warned_once(self):
+        files = _uploaded("db.t.1.csv.zst", "db.t.2.csv")
+        for _ in range(3):
+            self.assertEqual([len(files) for _, files
+                              in self.loader.jobs(files)], [1])
+        self.assertEqual(len(self.logger.warnings), 1)
+
+
+class UploadLoadTest(unittest.TestCase):
+    '''
+    dumped files uploaded by LocalDirSink and loaded by LocalBackend
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dump_dir = os.path.join(self.tmp, "dump")
+        # like dump2csv: <url>/<sid>, files in <url>/<sid>/<yyyymmdd>/
+        self.url = os.path.join(self.tmp, "uploads", "sys", "1")
+        self.manifest = manifest.Manifest(self.dump_dir)
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.tmp)
+
+    def dump(self, rows):
+        paths = []
+
+        def _on_file(path, count):
+            self.manifest.written(path, count, os.path.getsize(path), "md5")
+            paths.append(path)
+
+        writer = csvwriter.TableCsvWriter(self.dump_dir, "db.t",
+                                          on_file=_on_file)
+        writer.write_rows(rows)
+        writer.close()
+        return paths
+
+    def upload(self, paths):
+        up = uploader.Uploader(uploader.create_sink("file://" + self.url),
+                               self.manifest, workers=2, retry_delay=0)
+        for path in paths:
+            up.put(path)
+        up.close()
+        return up
+
+    def test_upload_and_load(self):
+        paths = self.dump([{"id": "1"}, {"id": "2", "v": "b"}])
+        self.assertEqual(self.upload(paths).uploaded, 2)
+        # uploaded once
+        self.assertEqual(self.upload(paths).uploaded, 0)
+        uploaded = self.manifest.files(manifest.UPLOADED)
+        self.assertEqual(sorted(path for path, _ in uploaded), sorted(paths))
+        for path, uri in uploaded:
+            with open(path) as src, open(uri) as dst:
+                self.assertEqual(src.read(), dst.read())
+        load = loader.Loader(loader.create_backend(self.url), self.manifest,
+                             schema_dir=os.path.join(self.tmp, "bq_schema"),
+                             retry_delay=0)
+        self.assertEqual(load.load(uploaded), (2, 0))
+        self.assertEqual(load.load(uploaded), (0, 0))
+        self.assertEqual(self.manifest.files(manifest.UPLOADED), [])
+        with open(os.path.join(self.url, "warehouse", "db", "t.jobs")) as fp:
+            jobs = [json.loads(line) for line in fp]
+        self.assertEqual(sorted(uri for job in jobs for uri in job["uris"]),
+                         sorted(uri for _, uri in uploaded))
+        self.assertEqual(set(job["format"] for job in jobs), set(["csv"]))
+
+    def test_failed_upload_released(self):
+        paths = self.dump([{"id": "1"}])
+        up = uploader.Uploader(_BrokenSink(), self.manifest, workers=1,
+                               tries=2, retry_delay=0)
+        up.put(paths[0])
+        up.close()
+        self.assertEqual((up.uploaded, up.failed), (0, 1))
+        self.assertEqual(self.manifest.state(paths[0]), manifest.WRITTEN)
+        self.assertEqual(self.upload(paths).uploaded, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
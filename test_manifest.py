@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+tests of the states and claims of the manifest of a dump dir
+
+usage:
+  python -m unittest test_manifest
+'''
+
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import unittest
+
+import manifest
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dump_dir = tempfile.mkdtemp()
+        self.manifest = manifest.Manifest(self.dump_dir)
+        self.path = self.dump_dir + "/20200101/db.t.1.000000.csv"
+        self.manifest.written(self.path, 10, 100, "md5")
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.dump_dir)
+
+    def set_claim(self, owner, claimed_at):
+        conn = sqlite3.connect(self.dump_dir + "/" + manifest.FILENAME)
+        conn.execute("UPDATE files SET owner = ?, claimed_at = ? "
+                     "WHERE path = ?", (owner, claimed_at, self.path))
+        conn.commit()
+        conn.close()
+
+    def test_states(self):
+        self.assertEqual(self.manifest.state(self.path), manifest.WRITTEN)
+        self.assertTrue(self.manifest.claim_upload(self.path))
+        self.assertEqual(self.manifest.state(self.path), manifest.UPLOADING)
+        self.manifest.uploaded(self.path, "gs://b/db.t.1.000000.csv")
+        self.assertEqual(self.manifest.files(manifest.UPLOADED),
+                         [(self.path, "gs://b/db.t.1.000000.csv")])
+        self.assertEqual(self.manifest.claim_load([self.path, "other"]),
+                         [self.path])
+        self.manifest.loaded([self.path])
+        info = self.manifest.get(self.path)
+        self.assertEqual(info["state"], manifest.LOADED)
+        self.assertEqual((info["tbl"], info["rows"], info["bytes"]),
+                         ("db.t", 10, 100))
+
+    def test_claimed_once(self):
+        other = manifest.Manifest(self.dump_dir)
+        try:
+            self.assertTrue(self.manifest.claim_upload(self.path))
+            self.assertFalse(other.claim_upload(self.path))
+            self.manifest.release_upload(self.path)
+            self.assertTrue(other.claim_upload(self.path))
+            other.uploaded(self.path, "gs://b/f")
+            self.assertEqual(other.claim_load([self.path]), [self.path])
+            self.assertEqual(self.manifest.claim_load([self.path]), [])
+            other.release_load([self.path])
+            self.assertEqual(self.manifest.state(self.path),
+                             manifest.UPLOADED)
+        finally:
+            other.close()
+
+    def test_not_written_not_claimed(self):
+        self.assertFalse(self.manifest.claim_upload("missing"))
+
+    def test_live_claim_kept(self):
+        self.assertTrue(self.manifest.claim_upload(self.path))
+        self.assertEqual(self.manifest.reclaim(), 0)
+        # refreshed by the heartbeat of its owner
+        self.set_claim(manifest._owner(), 1)
+        self.manifest.heartbeat()
+        self.assertEqual(self.manifest.reclaim(), 0)
+        self.assertEqual(self.manifest.state(self.path), manifest.UPLOADING)
+
+    def test_reclaim_dead_owner(self):
+        proc = subprocess.Popen(["true"])
+        proc.wait()
+        self.assertTrue(self.manifest.claim_upload(self.path))
+        self.set_claim("{}:{}".format(manifest.socket.gethostname(),
+                                      proc.pid), int(manifest.time.time()))
+        self.assertEqual(self.manifest.reclaim(), 1)
+        self.assertEqual(self.manifest.state(self.path), manifest.WRITTEN)
+
+    def test_reclaim_stale_claim(self):
+        self.assertTrue(self.manifest.claim_upload(self.path))
+        self.manifest.uploaded(self.path, "gs://b/f")
+        self.assertEqual(self.manifest.claim_load([self.path]), [self.path])
+        self.set_claim("otherhost:1", int(manifest.time.time()))
+        self.assertEqual(self.manifest.reclaim(), 0)
+        self.set_claim("otherhost:1", 1)
+        self.assertEqual(self.manifest.reclaim(), 1)
+        self.assertEqual(self.manifest.state(self.path), manifest.UPLOADED)
+
+    def test_old_manifest(self):
+        self.manifest.close()
+        conn = sqlite3.connect(self.dump_dir + "/" + manifest.FILENAME)
+        conn.execute("ALTER TABLE files RENAME TO old")
+        conn.execute("CREATE TABLE files AS SELECT path, tbl, state, rows, "
+                     "bytes, md5, destination, written_at, uploaded_at, "
+                     "loaded_at FROM old")
+        conn.commit()
+        conn.close()
+        self.manifest = manifest.Manifest(self.dump_dir)
+        self.assertTrue(self.manifest.claim_upload(self.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
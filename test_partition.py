@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+tests of the binlog position saved by PartitionedWriter, the lowest one
+flushed by all partitions
+
+usage:
+  python -m unittest test_partition
+'''
+
+import threading
+import unittest
+
+import partition
+
+
+class _Cache(object):
+    '''
+    records saved rows and positions
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.positions = []
+
+    def save_many(self, batches, position=None):
+        with self.lock:
+            for table, _, rows in batches:
+                for row in rows:
+                    self.rows[(table, row["id"])] = row
+            if position is not None:
+                self.positions.append(position)
+
+
+class _Event(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+
+
+def _decode(binlogevent, rows=None):
+    return [dict(row["values"], cdc_action="insert", cdc_ts=1)
+            for row in (binlogevent.rows if rows is None else rows)]
+
+
+class PartitionedWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = _Cache()
+
+    def test_lowest_flushed_position(self):
+        writer = partition.PartitionedWriter(self.cache, 3, _decode)
+        for log_pos in (4, 8, 12):
+            writer.checkpoint(("bin.000001", log_pos))
+        flushed = [writer._partition_flushed(index) for index in range(3)]
+        flushed[0](3)
+        flushed[1](2)
+        self.assertEqual(self.cache.positions, [])
+        flushed[2](1)
+        self.assertEqual(self.cache.positions, [("bin.000001", 4)])
+        flushed[2](3)
+        self.assertEqual(self.cache.positions[-1], ("bin.000001", 8))
+        # a partition flushed again without new checkpoints
+        flushed[0](3)
+        self.assertEqual(len(self.cache.positions), 2)
+        flushed[1](3)
+        self.assertEqual(self.cache.positions[-1], ("bin.000001", 12))
+        self.assertEqual(writer._positions, {})
+
+    def test_rows_and_position_saved_by_stop(self):
+        writer = partition.PartitionedWriter(self.cache, 4, _decode,
+                                             by_row=True, max_rows=10,
+                                             max_delay=0.01)
+        writer.start()
+        for start in range(0, 100, 10):
+            for table in ("db.a", "db.b"):
+                writer.add(table, "id", _Event(
+                    [{"values": {"id": rid}}
+                     for rid in range(start, start + 10)]))
+            writer.checkpoint(("bin.000001", start + 10))
+        writer.stop()
+        self.assertEqual(len(self.cache.rows), 200)
+        self.assertEqual(self.cache.positions[-1], ("bin.000001", 100))
+        self.assertEqual(self.cache.positions,
+                         sorted(self.cache.positions,
+                                key=lambda position: position[1]))
+
+
+if __name__ == "__main__":
+    unittest.main()
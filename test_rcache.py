@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+tests of the merging and draining of rcache on fakeredis in process
+
+usage:
+  python -m unittest test_rcache
+'''
+
+import unittest
+
+import redis
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+import rcache
+
+TABLE = "db.t"
+
+# (actions of a row, merged action or None if the row is merged away)
+MERGES = [
+    (("insert",), "insert"),
+    (("insert", "delete"), None),
+    (("insert", "update"), "insert"),
+    (("insert", "update", "update"), "insert"),
+    (("delete", "insert"), "update"),
+    (("update", "insert"), "update"),
+    (("update", "update"), "update"),
+    (("update", "delete"), "delete"),
+    (("insert", "delete", "insert"), "insert"),
+]
+
+
+def _row(rid, action, ts):
+    return {"id": rid, "v": "{}-{}".format(rid, ts), "cdc_action": action,
+            "cdc_ts": ts}
+
+
+def _changes(first_id=0):
+    '''
+    rows of MERGES, the row of the nth merge has the id first_id + n
+    '''
+    rows = []
+    ts = 0
+    for rid, (actions, _) in enumerate(MERGES, first_id):
+        for action in actions:
+            ts += 1
+            rows.append(_row(rid, action, ts))
+    return rows
+
+
+def _by_id(rows):
+    return dict((int(row["id"]), row) for row in rows)
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class HashRcacheTest(unittest.TestCase):
+    row_format = "hash"
+
+    def setUp(self):
+        self.client = fakeredis.FakeStrictRedis()
+        self.client.flushall()
+        self.cache = self.create()
+
+    def create(self, change_index=True):
+        return rcache.create("redis://fakeredis", 1, self.row_format,
+                             fetch_batch=3, change_index=change_index,
+                             client=self.client)
+
+    def cached(self):
+        return _by_id(row for _, row in self.cache)
+
+    def check_merged(self, cached, first_id=0):
+        for rid, (actions, action) in enumerate(MERGES, first_id):
+            if action is None:
+                self.assertNotIn(rid, cached, actions)
+            else:
+                self.assertEqual(cached[rid]["cdc_action"], action, actions)
+                self.assertEqual(str(cached[rid]["v"]),
+                                 "{}-{}".format(rid, cached[rid]["cdc_ts"]))
+
+    def test_merge_in_one_call(self):
+        self.cache.save(TABLE, ["id"], _changes())
+        self.check_merged(self.cached())
+        self.assertEqual(self.cache.table_size(TABLE),
+                         sum(1 for _, action in MERGES if action))
+
+    def test_merge_by_calls(self):
+        for row in _changes():
+            self.cache.save(TABLE, ["id"], [row])
+        self.check_merged(self.cached())
+        self.assertEqual(self.cache.table_size(TABLE),
+                         sum(1 for _, action in MERGES if action))
+
+    def test_merge_like_merge_row(self):
+        rows = _changes()
+        expected = {}
+        for row in rows:
+            merged = rcache.Rcache._merge_row(expected.get(row["id"]),
+                                              dict(row))
+            if merged is None:
+                del expected[row["id"]]
+            else:
+                expected[row["id"]] = merged
+        self.cache.save(TABLE, ["id"], rows)
+        cached = self.cached()
+        self.assertEqual(sorted(cached), sorted(expected))
+        for rid, row in expected.iteritems():
+            self.assertEqual(cached[rid]["cdc_action"], row["cdc_action"])
+
+    def test_swap_generation(self):
+        self.cache.save(TABLE, ["id"], _changes())
+        drained = []
+
+        def _callback(table, rows):
+            # rows captured while draining go to the new generation
+            self.cache.save(TABLE, ["id"], _changes(100))
+            drained.extend(rows)
+
+        self.assertTrue(self.cache.drain_table(TABLE, _callback))
+        self.check_merged(_by_id(drained))
+        self.assertTrue(all(int(row["id"]) < 100 for row in drained))
+        self.assertEqual(self.cache.generation(TABLE), 1)
+        cached = self.cached()
+        self.assertTrue(all(rid >= 100 for rid in cached))
+        self.check_merged(cached, 100)
+        self.assertEqual(self.cache.table_size(TABLE), len(cached))
+
+    def test_drain_generations_left_by_others(self):
+        drained = []
+        _callback = lambda table, rows: drained.extend(rows)
+        self.cache.save(TABLE, ["id"], [_row(1, "insert", 1)])
+        self.assertTrue(self.cache.drain_table(TABLE, _callback))
+        # another dumper freezes a generation after the first scan and
+        # breaks before dumping it
+        self.cache.save(TABLE, ["id"], [_row(2, "insert", 2)])
+        self.create()._swap_generation(TABLE)
+        self.cache.save(TABLE, ["id"], [_row(3, "insert", 3)])
+        self.assertTrue(self.cache.drain_table(TABLE, _callback))
+        self.assertEqual(sorted(_by_id(drained)), [1, 2, 3])
+        self.assertEqual(self.cache.table_size(TABLE), 0)
+        self.assertEqual(self.cache._table_generations(
+            TABLE, self.cache.generation(TABLE)), [3])
+
+    def test_locked_table_is_not_drained(self):
+        other = self.create()
+        self.assertTrue(other.lock_table(TABLE))
+        try:
+            self.assertFalse(self.cache.drain_table(TABLE, None))
+        finally:
+            other.unlock_table(TABLE)
+
+    def test_drain_until(self):
+        rows = [_row(rid, "insert", rid) for rid in range(10)]
+        self.cache.save(TABLE, ["id"], rows)
+        drained = []
+        self.assertTrue(self.cache.drain_until(
+            TABLE, 4, lambda table, rows: drained.extend(rows)))
+        self.assertEqual(sorted(_by_id(drained)), range(5))
+        self.assertEqual(sorted(self.cached()), range(5, 10))
+        self.assertEqual(self.cache.table_size(TABLE), 5)
+        # later changes are written into the new generation, the older
+        # version of row 7 is drained and the newer one is left
+        self.cache.save(TABLE, ["id"], [_row(10, "insert", 10),
+                                         _row(7, "update", 11)])
+        drained = []
+        self.cache.drain_until(TABLE, 10,
+                               lambda table, rows: drained.extend(rows))
+        self.assertEqual(sorted(_by_id(drained)), range(5, 11))
+        cached = self.cached()
+        self.assertEqual(sorted(cached), [7])
+        self.assertEqual(int(cached[7]["cdc_ts"]), 11)
+        self.assertEqual(self.cache.table_size(TABLE), 1)
+
+    def test_iter_changes(self):
+        self.cache.save(TABLE, ["id"],
+                        [_row(rid, "insert", rid) for rid in range(10)])
+        changes = list(self.cache.iter_changes(TABLE, 3, 6))
+        self.assertEqual([int(row["id"]) for row in changes], range(3, 7))
+        self.assertEqual(self.cache.table_size(TABLE), 10)
+
+    def test_no_change_index(self):
+        cache = self.create(change_index=False)
+        with self.assertRaises(ValueError):
+            list(cache.iter_changes(TABLE))
+        with self.assertRaises(ValueError):
+            cache.drain_until(TABLE, 0, None)
+
+    def test_save_with_position(self):
+        saved = self.cache.save_many(
+            [(TABLE, ["id"], _changes()),
+             ("db.u", ["id"], [_row(1, "insert", 1)])], ("bin.000002", 77))
+        self.assertEqual(saved, len(_changes()) + 1)
+        self.assertEqual(self.cache.checkpoint(), ("bin.000002", 77))
+        self.check_merged(_by_id(row for table, row in self.cache
+                                 if table == TABLE))
+        self.assertEqual(self.cache.table_size("db.u"), 1)
+        self.assertEqual(self.cache.save_many([], ("bin.000003", 4)), 0)
+        self.assertEqual(self.cache.checkpoint(), ("bin.000003", 4))
+
+    def test_cluster_save_failed(self):
+        # a script per table like redis cluster, the second one fails
+        self.cache._cluster = True
+        self.cache._scripts_loaded = True
+        self.client.script_load(self.cache._merge_source)
+        pipeline = self.client.pipeline
+
+        def _pipeline(transaction=True):
+            pipe = pipeline(transaction)
+            # fakeredis has no SCRIPT EXISTS, the script is loaded above
+            pipe.load_scripts = lambda: None
+            return pipe
+
+        self.client.pipeline = _pipeline
+        self.client.rpush("1#generation#{db.u}", "x")
+        with self.assertRaises(rcache.SaveError) as ctx:
+            self.cache.save_many(
+                [(TABLE, ["id"], [_row(1, "insert", 1)]),
+                 ("db.u", ["id"], [_row(1, "insert", 1)])],
+                ("bin.000002", 77))
+        self.assertEqual(ctx.exception.saved_tables, [TABLE])
+        self.assertEqual(self.cache.checkpoint(), (None, None))
+        self.assertEqual(self.cache.table_size(TABLE), 1)
+
+    def test_shards(self):
+        self.cache.save(TABLE, ["id"],
+                        [_row(rid, "insert", rid) for rid in range(50)])
+        tasks = self.cache.dump_tasks(shard_rows=10, max_shards=4)
+        self.assertEqual(len(tasks), 4)
+        rids = []
+        for table, gens, shard, shards in tasks:
+            shard_rids = _by_id(self.cache.iter_dump_rows(table, gens, shard,
+                                                          shards))
+            self.assertTrue(shard_rids)
+            rids.extend(shard_rids)
+        self.assertEqual(sorted(rids), range(50))
+
+    def test_migrate_legacy(self):
+        for rid in range(3):
+            self.client.hmset("1#{}.{}".format(TABLE, rid),
+                              _row(rid, "insert", rid))
+            self.client.sadd("1#row_ids#{}".format(TABLE), rid)
+        self.assertEqual(self.cache.migrate_legacy(), 3)
+        self.assertEqual(sorted(self.cached()), range(3))
+        self.assertFalse(self.client.exists("1#row_ids#{}".format(TABLE)))
+        drained = []
+        self.cache.drain_table(TABLE, lambda table, rows: drained.extend(rows))
+        self.assertEqual(sorted(_by_id(drained)), range(3))
+        self.assertEqual(self.cache.table_size(TABLE), 0)
+
+
+@unittest.skipIf(rcache.msgpack is None, "msgpack is not installed")
+class PackedRcacheTest(HashRcacheTest):
+    row_format = "packed"
+
+    def test_full_when_registering_columns(self):
+        def _hset(*args):
+            raise redis.ResponseError(
+                "OOM command not allowed when used memory > 'maxmemory'.")
+
+        self.client.hset = _hset
+        with self.assertRaises(rcache.FullError):
+            self.cache.save_many([(TABLE, ["id"], [_row(1, "insert", 1)])])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+tests of the columns and rows kept by rowfilter
+
+usage:
+  python -m unittest test_rowfilter
+'''
+
+import unittest
+
+import rcache
+import rowfilter
+
+
+def _merged(changes):
+    '''
+    changes: [(action, values, before_values)] of a row with id 1, return
+    the merged action cached by filtering them, None if nothing is cached
+    '''
+    rfilter = rowfilter.TableFilter(where=("status", "==", 1))
+    merged = None
+    for ts, (action, values, before) in enumerate(changes):
+        action = rfilter.action(action, values, before)
+        if action is not None:
+            row = dict(values, id=1, cdc_action=action, cdc_ts=ts)
+            merged = rcache.Rcache._merge_row(merged, row)
+    return merged and merged["cdc_action"]
+
+
+class TableFilterTest(unittest.TestCase):
+
+    def test_where(self):
+        rfilter = rowfilter.TableFilter(where=[("status", "!=", 0),
+                                               ("type", "in", (1, 2))])
+        self.assertTrue(rfilter.test({"status": 1, "type": 2}))
+        self.assertFalse(rfilter.test({"status": 0, "type": 2}))
+        self.assertFalse(rfilter.test({"status": 1, "type": 3}))
+        with self.assertRaises(ValueError):
+            rowfilter.TableFilter(where=("status", "~", 0))
+
+    def test_actions(self):
+        rfilter = rowfilter.TableFilter(where=("status", "==", 1))
+        true, false = {"status": 1}, {"status": 0}
+        self.assertEqual(rfilter.action("insert", true), "insert")
+        self.assertIsNone(rfilter.action("insert", false))
+        self.assertEqual(rfilter.action("update", true, true), "update")
+        self.assertEqual(rfilter.action("update", true, false), "insert")
+        self.assertEqual(rfilter.action("update", false, true), "delete")
+        self.assertIsNone(rfilter.action("update", false, false))
+        self.assertEqual(rfilter.action("update", false), "delete")
+        self.assertEqual(rfilter.action("delete", true), "delete")
+        self.assertIsNone(rfilter.action("delete", false))
+        self.assertEqual(rowfilter.TableFilter().action("delete", false),
+                         "delete")
+
+    def test_rows_moved_across_where(self):
+        true, false = {"status": 1}, {"status": 0}
+        # updated out of where then deleted
+        self.assertEqual(_merged([("insert", true, None),
+                                  ("update", false, true),
+                                  ("delete", false, None)]), None)
+        self.assertEqual(_merged([("update", false, true),
+                                  ("delete", false, None)]), "delete")
+        # updated into where, then changed within it
+        self.assertEqual(_merged([("update", true, false),
+                                  ("update", true, true)]), "insert")
+        # out and back in
+        self.assertEqual(_merged([("update", false, true),
+                                  ("update", true, false)]), "update")
+        self.assertEqual(_merged([("insert", false, None),
+                                  ("update", false, false),
+                                  ("delete", false, None)]), None)
+
+    def test_project(self):
+        include = rowfilter.TableFilter(include=("name",))
+        self.assertEqual(include.project({"id": 1, "name": "a", "body": "b"},
+                                         "id"), {"id": 1, "name": "a"})
+        exclude = rowfilter.TableFilter(exclude=("body", "id"))
+        self.assertEqual(exclude.project({"id": 1, "name": "a", "body": "b"},
+                                         "id"), {"id": 1, "name": "a"})
+        self.assertEqual(exclude.project({"k": 1, "body": "b"}, ("k",)),
+                         {"k": 1})
+        with self.assertRaises(ValueError):
+            rowfilter.TableFilter(include=("a",), exclude=("b",))
+
+    def test_compile_filters(self):
+        filters = rowfilter.compile_filters(
+            {"db.t": {"where": ("status", "==", 1)}})
+        self.assertEqual(sorted(filters), ["db.t"])
+        self.assertIsNone(filters["db.t"].action("insert", {"status": 0}))
+        self.assertEqual(rowfilter.compile_filters(None), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
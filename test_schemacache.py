@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+tests of the column schemas cached by schemacache and the tables ddl
+queries change
+
+usage:
+  python -m unittest test_schemacache
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import schemacache
+
+COLUMNS = [{"COLUMN_NAME": "id", "COLUMN_TYPE": "int(11) unsigned"}]
+TABLES = [("db", "t"), ("db", "u"), ("other", "t")]
+
+
+class DdlTablesTest(unittest.TestCase):
+
+    def check(self, schema, query, expected):
+        self.assertEqual(sorted(schemacache.ddl_tables(schema, query, TABLES)),
+                         expected)
+
+    def test_tables_of_schema(self):
+        self.check("db", "ALTER TABLE t ADD c int", [("db", "t")])
+        self.check("db", "alter table `u` add c int", [("db", "u")])
+        self.check("db", "RENAME TABLE t TO t2, u TO u2",
+                   [("db", "t"), ("db", "u")])
+        self.check("x", "TRUNCATE TABLE other.t", [("other", "t")])
+        self.check("x", "ALTER TABLE t ADD c int", [])
+
+    def test_database(self):
+        self.check("x", "DROP DATABASE IF EXISTS `db`",
+                   [("db", "t"), ("db", "u")])
+        self.check("x", "ALTER SCHEMA other CHARACTER SET utf8mb4",
+                   [("other", "t")])
+
+    def test_not_ddl(self):
+        self.check("db", "BEGIN", [])
+        self.check("db", "INSERT INTO t SELECT * FROM u", [])
+
+    def test_data_type(self):
+        self.assertEqual(schemacache.data_type("int(11) unsigned"), "int")
+        self.assertEqual(schemacache.data_type("DATETIME"), "datetime")
+
+
+class _Cursor(object):
+
+    def __init__(self, queries):
+        self.queries = queries
+
+    def execute(self, sql, args):
+        self.queries.append(args)
+
+    def fetchall(self):
+        return COLUMNS
+
+    def close(self):
+        pass
+
+
+class _Connection(object):
+
+    def __init__(self):
+        self.queries = []
+
+    def cursor(self, cursor_class=None):
+        return _Cursor(self.queries)
+
+
+class SchemaCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "schema_cache.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_persisted(self):
+        cache = schemacache.SchemaCache(self.path)
+        cache.put("db", "t", COLUMNS)
+        cache.put("db", "missing", [])
+        cache = schemacache.SchemaCache(self.path)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get("db", "t"), COLUMNS)
+        self.assertIsNone(cache.get("db", "missing"))
+
+    def test_fetch_once(self):
+        cache = schemacache.SchemaCache(self.path)
+        connection = _Connection()
+        for _ in range(2):
+            self.assertEqual(cache.fetch(connection, "db", "t"), COLUMNS)
+        self.assertEqual(connection.queries, [("db", "t")])
+
+    def test_invalidate_query(self):
+        cache = schemacache.SchemaCache(self.path)
+        for schema, table in TABLES:
+            cache.put(schema, table, COLUMNS)
+        query = "ALTER TABLE t ADD c int"
+        self.assertEqual(cache.invalidate_query("db", query), [("db", "t")])
+        self.assertEqual(cache.invalidate_query("db", query), [])
+        cache = schemacache.SchemaCache(self.path)
+        self.assertIsNone(cache.get("db", "t"))
+        self.assertEqual(cache.get("other", "t"), COLUMNS)
+        self.assertEqual(cache.invalidate(["db.u", "db.x"]), ["db.u"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+tests of the write buffer of cdc.py by a cache recording its savings
+
+usage:
+  python -m unittest test_wbuffer
+'''
+
+import unittest
+
+import rcache
+import wbuffer
+
+
+def _row(rid, action, ts=1):
+    return {"id": rid, "cdc_action": action, "cdc_ts": ts}
+
+
+class _Cache(object):
+    '''
+    records save_many, or raises error once
+    '''
+
+    def __init__(self):
+        self.saves = []
+        self.error = None
+
+    def save_many(self, batches, position=None):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        self.saves.append((dict((table, sorted(rows, key=lambda r: r["id"]))
+                                for table, _, rows in batches), position))
+        return sum(len(rows) for _, _, rows in batches)
+
+
+class WriteBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = _Cache()
+        self.buf = wbuffer.WriteBuffer(self.cache, max_rows=100,
+                                       max_delay=3600)
+
+    def test_merged_in_buffer(self):
+        self.buf.add("db.a", "id", [_row(1, "insert", 1), _row(1, "update", 2),
+                                    _row(2, "insert", 1), _row(2, "delete", 2),
+                                    _row(3, "update", 1)])
+        self.buf.add("db.a", "id", [_row(3, "delete", 3), _row(4, "delete", 3),
+                                    _row(4, "insert", 4)])
+        self.assertEqual(len(self.buf), 3)
+        self.assertEqual(self.buf.flush(), 3)
+        tables, _ = self.cache.saves[0]
+        self.assertEqual([(row["id"], row["cdc_action"], row["cdc_ts"])
+                          for row in tables["db.a"]],
+                         [(1, "insert", 2), (3, "delete", 3),
+                          (4, "update", 4)])
+
+    def test_position_after_its_rows(self):
+        self.buf.add("db.a", "id", [_row(1, "insert")])
+        self.buf.checkpoint(("bin.000001", 4))
+        # a transaction not committed yet, its rows are saved without
+        # moving the position past them
+        self.buf.add("db.a", "id", [_row(2, "insert")])
+        self.assertEqual(self.buf.flush(), 2)
+        self.assertEqual(self.cache.saves[-1][1], ("bin.000001", 4))
+        self.buf.add("db.a", "id", [_row(3, "insert")])
+        self.assertEqual(self.buf.flush(), 1)
+        self.assertIsNone(self.cache.saves[-1][1])
+        self.buf.checkpoint(("bin.000001", 8))
+        self.assertEqual(self.buf.flush(), 0)
+        self.assertEqual(self.cache.saves[-1], ({}, ("bin.000001", 8)))
+
+    def test_due_at_transaction_boundary(self):
+        buf = wbuffer.WriteBuffer(self.cache, max_rows=2, max_delay=0,
+                                  max_transactions=2)
+        buf.add("db.a", "id", [_row(1, "insert")])
+        self.assertFalse(buf.due())
+        buf.checkpoint(("bin.000001", 4))
+        self.assertTrue(buf.due())
+        buf.add("db.a", "id", [_row(2, "insert")])
+        # max_rows flushes a huge transaction before its commit
+        self.assertTrue(buf.due())
+
+    def test_on_flush(self):
+        flushed = []
+        buf = wbuffer.WriteBuffer(self.cache, on_flush=flushed.append,
+                                  save_position=False)
+        buf.add("db.a", "id", [_row(1, "insert")])
+        buf.flush()
+        buf.checkpoint(("bin.000001", 4))
+        buf.flush()
+        self.assertEqual(flushed, [("bin.000001", 4)])
+        self.assertEqual([position for _, position in self.cache.saves],
+                         [None, None])
+
+    def test_saved_tables_not_saved_again(self):
+        self.buf.add("db.a", "id", [_row(1, "insert")])
+        self.buf.add("db.b", "id", [_row(1, "insert"), _row(2, "insert")])
+        self.buf.checkpoint(("bin.000001", 4))
+        self.cache.error = rcache.PartialFullError("OOM", ["db.a"])
+        with self.assertRaises(rcache.FullError):
+            self.buf.flush()
+        self.assertEqual(len(self.buf), 2)
+        self.assertEqual(self.buf.flush(), 2)
+        tables, position = self.cache.saves[0]
+        self.assertEqual(sorted(tables), ["db.b"])
+        self.assertEqual(position, ("bin.000001", 4))
+
+    def test_failed_flush_keeps_rows(self):
+        self.buf.add("db.a", "id", [_row(1, "insert")])
+        self.buf.checkpoint(("bin.000001", 4))
+        self.cache.error = rcache.FullError("OOM")
+        with self.assertRaises(rcache.FullError):
+            self.buf.flush()
+        self.assertEqual(self.buf.flush(), 1)
+        self.assertEqual(self.cache.saves[0][1], ("bin.000001", 4))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+'''
+upload dumped files by a pool of threads while dumping goes on
+
+sinks put a file to "<url>/<yyyymmdd>/<file name>" and return the
+destination, uploaded files are recorded in the manifest of the dump
+dir(manifest.Manifest) and never uploaded again. a file is claimed in
+the manifest before uploading, files claimed by other processes sharing
+the dump dir are skipped
+'''
+
+import os
+import time
+import pipes
+import shutil
+import commands
+import threading
+from Queue import Queue
+
+
+class GsutilSink(object):
+    '''
+    upload to google cloud storage by gsutil
+    '''
+
+    def __init__(self, url):
+        self.url = url
+
+    def upload(self, path, date):
+        destination = "/".join((self.url.rstrip("/"), date,
+                                os.path.basename(path)))
+        ret, out = commands.getstatusoutput("gsutil -q cp {} {}".format(
+            pipes.quote(path), pipes.quote(destination)))
+        if ret != 0:
+            raise IOError("gsutil cp {} failed, return code:{}, out:{}".format(
+                path, ret >> 8, out))
+        return destination
+
+
+class LocalDirSink(object):
+    '''
+    copy to a local dir, for testing the upload stage without network
+    '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def upload(self, path, date):
+        date_dir = os.path.join(self.root, date)
+        if not os.path.isdir(date_dir):
+            try:
+                os.makedirs(date_dir)
+            except OSError:
+                if not os.path.isdir(date_dir):
+                    raise
+        destination = os.path.join(date_dir, os.path.basename(path))
+        shutil.copyfile(path, destination + ".part")
+        os.rename(destination + ".part", destination)
+        return destination
+
+
+def create_sink(url):
+    '''
+    url: "gs://bucket/path", "file:///path" or a local dir
+    '''
+    if url.startswith("gs://"):
+        return GsutilSink(url)
+    if url.startswith("file://"):
+        return LocalDirSink(url[len("file://"):])
+    return LocalDirSink(url)
+
+
+class Uploader(object):
+    '''
+    files are uploaded by workers threads as soon as they are put,
+    a failed file is tried tries times, waiting retry_delay * 2 ** n
+    seconds between tries
+
+    usage:
+      uploader = Uploader(create_sink(url), manifest, 4,
+                          on_uploaded=callback)
+      uploader.put("/dumps/20160608/db.table.1465387200.000000.csv")
+      uploader.close()  # wait for all put files
+    '''
+
+    def __init__(self, sink, manifest, workers=4, tries=3, retry_delay=1,
+                 on_uploaded=None, logger=None):
+        self._sink = sink
+        self._manifest = manifest
+        self._tries = tries
+        self._retry_delay = retry_delay
+        self._on_uploaded = on_uploaded
+        self._logger = logger
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self.uploaded = self.failed = 0
+        self._threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, path):
+        self._queue.put(path)
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while 1:
+            path = self._queue.get()
+            if path is None:
+                return
+            self._upload(path)
+
+    def _upload(self, path):
+        destination = self._manifest.destination(path)
+        if destination is None:
+            if not self._manifest.claim_upload(path):
+                if self._logger:
+                    self._logger.info("{} is uploaded by others".format(path))
+                return
+            date = os.path.basename(os.path.dirname(path))
+            for tries in range(self._tries):
+                try:
+                    destination = self._sink.upload(path, date)
+                    break
+                except Exception:
+                    if self._logger:
+                        self._logger.error("upload {} failed, tries:{}".format(
+                            path, tries + 1), exc_info=True)
+                    if tries == self._tries - 1:
+                        self._manifest.release_upload(path)
+                        with self._lock:
+                            self.failed += 1
+                        return
+                    time.sleep(self._retry_delay * 2 ** tries)
+            self._manifest.uploaded(path, destination)
+            with self._lock:
+                self.uploaded += 1
+            if self._logger:
+                self._logger.info("upload {} to {} ok".format(path,
+                                                              destination))
+        if self._on_uploaded:
+            self._on_uploaded(path, destination)
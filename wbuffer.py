@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import time
+import threading
+
+import rcache
+
+
+class WriteBuffer(object):
+    '''
+    coalesce changed rows in process before saving them to cache.
+    rows are keyed by table and rid, and merged by Rcache._merge_row
+    like they are merged in redis, so a hot row updated many times
+    costs one write per flush.
+
+    usage:
+      buf = WriteBuffer(cache, 1000, 0.1, 10)
+      buf.add(table, primary_key, rows)
+      buf.checkpoint((log_file, log_pos))  # transaction committed
+      if buf.due():
+          buf.flush()
+
+    the buffered rows and the last position passed to checkpoint()
+    are saved by one Rcache.save_many, so the position never goes
+    ahead of the saved rows. the tables saved before a failed saving
+    (rcache.SaveError of redis cluster) are dropped from the buffer, and
+    are never merged into the cache twice.
+    on_flush(position) is called after they are saved
+    '''
+
+    def __init__(self, cache, max_rows=1000, max_delay=0.1,
+                 max_transactions=0, on_flush=None, save_position=True):
+        '''
+        flush at the transaction boundary if:
+          max_rows: count of buffered rows reaches it, the rows of
+                    a huge transaction are flushed before its commit
+                    without moving the position
+          max_delay: the oldest buffered change waits for it(seconds)
+          max_transactions: count of committed transactions reaches it,
+                    0 for no limit
+        save_position: save the position with rows, or leave it to on_flush
+        '''
+        self._cache = cache
+        self._max_rows = max_rows
+        self._max_delay = max_delay
+        self._max_transactions = max_transactions
+        self._on_flush = on_flush
+        self._save_position = save_position
+        self._lock = threading.RLock()
+        # {table: (primary_key, {rid: row})}
+        self._tables = {}
+        self._rows = 0
+        self._since = None
+        self._position = None
+        self._transactions = 0
+        self._in_transaction = False
+        self._flusher = None
+
+    def __len__(self):
+        return self._rows
+
+    def add(self, table, primary_key, rows):
+        '''
+        merge rows into the buffer
+        '''
+        gen_rid = rcache.rid_getter(primary_key)
+        if gen_rid is None:
+            raise rcache.SaveIgnore(
+                "Do not support table[{}] without primary_key".format(table))
+        with self._lock:
+            _, trows = self._tables.setdefault(table, (primary_key, {}))
+            for row in rows:
+                rid = gen_rid(row)
+                merged_row = rcache.Rcache._merge_row(trows.get(rid), row)
+                if merged_row:
+                    if rid not in trows:
+                        self._rows += 1
+                    trows[rid] = merged_row
+                elif rid in trows:
+                    del trows[rid]
+                    self._rows -= 1
+            self._in_transaction = True
+            if self._since is None:
+                self._since = time.time()
+
+    def checkpoint(self, position):
+        '''
+        position: (log_file, log_pos) after a committed transaction
+        or a rotated binlog
+        '''
+        with self._lock:
+            self._position = position
+            self._transactions += 1
+            self._in_transaction = False
+            if self._since is None:
+                self._since = time.time()
+
+    def due(self):
+        with self._lock:
+            if self._rows >= self._max_rows:
+                return True
+            if self._in_transaction or self._since is None:
+                return False
+            return (time.time() - self._since >= self._max_delay or
+                    bool(self._max_transactions) and
+                    self._transactions >= self._max_transactions)
+
+    def flush(self):
+        '''
+        save buffered rows and the position by one Rcache.save_many,
+        the buffer is kept if it failed.
+        return count of saved rows
+        '''
+        with self._lock:
+            batches = [(table, primary_key, trows.values())
+                       for table, (primary_key, trows)
+                       in self._tables.iteritems()]
+            position = self._position
+            try:
+                self._cache.save_many(
+                    batches, position if self._save_position else None)
+            except rcache.SaveError as err:
+                for table in err.saved_tables:
+                    _, trows = self._tables.pop(table, (None, {}))
+                    self._rows -= len(trows)
+                raise
+            saved = self._rows
+            self._tables.clear()
+            self._rows = 0
+            self._transactions = 0
+            self._position = None
+            self._since = time.time() if self._in_transaction else None
+            if self._on_flush and position is not None:
+                self._on_flush(position)
+            return saved
+
+    def start(self, on_error=None, flush=None):
+        '''
+        flush the buffer by a daemon thread when it is due,
+        rows will not wait for the next binlog event while mysql is idle
+        on_error(err) is called if flush failed,
+        the rows are kept and flushed again later
+        flush(wbuf): flush the buffer, default is WriteBuffer.flush
+        '''
+        flush = flush or WriteBuffer.flush
+
+        def _flush_loop():
+            while 1:
+                time.sleep(self._max_delay)
+                try:
+                    if self.due():
+                        flush(self)
+                except Exception as err:
+                    if on_error:
+                        on_error(err)
+
+        self._flusher = threading.Thread(target=_flush_loop)
+        self._flusher.setDaemon(True)
+        self._flusher.start()